@@ -0,0 +1,263 @@
+import io
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+COLOUR_BITS = 3
+BACKGROUND_LEVEL = 240  # pixels with every channel above this count as background
+DB_BANDS = 8  # indexed 8-bit slices of the hash; a match within DB_BANDS - 1 bits shares one
+DB_PURGE_INTERVAL = 64  # puts between sweeps of expired and surplus sqlite rows
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def _flattened(image_bytes: bytes) -> Image.Image:
+    # Transparent cutouts go onto white so the signature describes the
+    # garment rather than its alpha.
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", (DCT_SIZE * 4, DCT_SIZE * 4))
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    return image.convert("RGB")
+
+
+def _phash(image: Image.Image) -> int:
+    pixels = np.asarray(image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    bits = low[1:] > np.median(low[1:])  # the DC term only tracks overall brightness
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def _colour(image: Image.Image) -> int:
+    pixels = np.asarray(image.resize((DCT_SIZE, DCT_SIZE), Image.BOX), dtype=np.float64).reshape(-1, 3)
+    foreground = pixels[pixels.min(axis=1) < BACKGROUND_LEVEL]
+    if len(foreground) < len(pixels) // 20:
+        foreground = pixels  # a white garment, or nothing but background
+    levels = np.minimum(np.median(foreground, axis=0) // (256 >> COLOUR_BITS), (1 << COLOUR_BITS) - 1).astype(int)
+    return (int(levels[0]) << (2 * COLOUR_BITS)) | (int(levels[1]) << COLOUR_BITS) | int(levels[2])
+
+
+def image_signature(image_bytes: bytes) -> Tuple[int, int]:
+    """
+    (pHash, colour) from a single decode. The pHash has one bit per low DCT
+    frequency (the lowest 8x8 of a 32x32 grayscale thumbnail, minus the DC
+    term) saying whether it is above their median, so re-encoding, resizing
+    and small edits flip only a few bits. It is grayscale, so a red and a navy
+    shirt of the same cut hash alike; the colour is the median of the non-white
+    pixels, COLOUR_BITS per channel, and has to match exactly as well.
+    """
+    image = _flattened(image_bytes)
+    return _phash(image), _colour(image)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def hash_bands(phash: int) -> Tuple[int, ...]:
+    return tuple((phash >> (8 * band)) & 0xFF for band in range(DB_BANDS))
+
+
+class AnalysisCache:
+    """
+    Cache of Gemini clothing analyses keyed by the perceptual hash and
+    colour signature of the image, so retries, duplicate uploads and the
+    same product photo used by several people skip the model call. A lookup
+    matches any stored entry of the same colour whose hash is within
+    max_distance bits. Two tiers, both expiring entries after ttl_seconds:
+
+    * memory: LRU bounded to max_entries, searched linearly (cheap at a few
+      thousand 64-bit hashes)
+    * sqlite (optional): one row per analysis in db_path, so results survive
+      restarts and can be shared by several server processes on one host.
+      Rows carry the hash split into indexed bands; a lookup only compares
+      rows sharing a band with it (any hash within DB_BANDS - 1 bits does).
+      Every DB_PURGE_INTERVAL puts, expired rows and all but the newest
+      db_max_rows are deleted.
+
+    namespace should change whenever the model or prompt does, so stale
+    analyses are never served for a different question.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int = 2048,
+        ttl_seconds: float = 7 * 24 * 3600,
+        max_distance: int = 4,
+        db_path: Optional[str] = None,
+        db_max_rows: int = 100_000,
+    ):
+        self.namespace = namespace
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max(0, max_distance)
+        self.db_max_rows = max(0, db_max_rows)
+
+        self._memory = OrderedDict()  # (hash, colour) -> (result, stored_at)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()  # the sqlite tier never holds up memory lookups
+        self._db_puts = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(analyses)")]
+            if columns and "band0" not in columns:
+                self._db.execute("DROP TABLE analyses")  # older layout without colour or bands
+            bands = [f"band{band}" for band in range(DB_BANDS)]
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "namespace TEXT, phash TEXT, colour INTEGER, result TEXT, stored_at REAL, "
+                + "".join(f"{band} INTEGER, " for band in bands)
+                + "PRIMARY KEY (namespace, phash, colour))"
+            )
+            for band in bands:
+                self._db.execute(f"CREATE INDEX IF NOT EXISTS analyses_{band} ON analyses (namespace, colour, {band})")
+            self._db.execute("CREATE INDEX IF NOT EXISTS analyses_stored_at ON analyses (stored_at)")
+            self._purge_db(time.time())
+            self._db.commit()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, phash: int, colour: int) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            match = self._find_memory(phash, colour, now)
+            if match is not None:
+                self.memory_hits += 1
+                return dict(match)
+
+        row = self._find_db(phash, colour, now)
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.db_hits += 1
+            stored_hash, result, stored_at = row
+            self._put_memory((stored_hash, colour), result, stored_at)
+            return dict(result)
+
+    def put(self, phash: int, colour: int, result: dict):
+        now = time.time()
+        with self._lock:
+            self._put_memory((phash, colour), dict(result), now)
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO analyses VALUES ({', '.join('?' * (5 + DB_BANDS))})",
+                (self.namespace, f"{phash:016x}", colour, json.dumps(result), now) + hash_bands(phash),
+            )
+            self._db_puts += 1
+            if self._db_puts % DB_PURGE_INTERVAL == 0:
+                self._purge_db(now)
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "max_distance": self.max_distance,
+            }
+
+    # -----------------------------
+    # Internals
+    # -----------------------------
+    def _find_memory(self, phash: int, colour: int, now: float) -> Optional[dict]:
+        # Caller holds _lock
+        best = None
+        for key, (result, stored_at) in list(self._memory.items()):
+            if now - stored_at > self.ttl_seconds:
+                del self._memory[key]
+                continue
+            if key[1] != colour:
+                continue
+            distance = hamming(phash, key[0])
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, key, result)
+                if distance == 0:
+                    break
+        if best is None:
+            return None
+        self._memory.move_to_end(best[1])
+        return best[2]
+
+    def _put_memory(self, key: Tuple[int, int], result: dict, stored_at: float):
+        if self.max_entries == 0:
+            return
+        self._memory[key] = (result, stored_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _find_db(self, phash: int, colour: int, now: float):
+        if self._db is None:
+            return None
+        if self.max_distance < DB_BANDS:
+            # One indexed lookup per band; sqlite won't use several indexes for an OR
+            query = " UNION ".join(
+                "SELECT phash, result, stored_at FROM analyses "
+                f"WHERE namespace = ? AND colour = ? AND band{band} = ? AND stored_at > ?"
+                for band in range(DB_BANDS)
+            )
+            params = tuple(
+                value for band in hash_bands(phash)
+                for value in (self.namespace, colour, band, now - self.ttl_seconds)
+            )
+        else:
+            # Too loose for the bands to prefilter: compare every row of this colour
+            query = (
+                "SELECT phash, result, stored_at FROM analyses "
+                "WHERE namespace = ? AND colour = ? AND stored_at > ?"
+            )
+            params = (self.namespace, colour, now - self.ttl_seconds)
+        with self._db_lock:
+            rows = self._db.execute(query, params).fetchall()
+        best = None
+        for stored_hash, result, stored_at in rows:
+            stored_hash = int(stored_hash, 16)
+            distance = hamming(phash, stored_hash)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, stored_hash, result, stored_at)
+        if best is None:
+            return None
+        return best[1], json.loads(best[2]), best[3]
+
+    def _purge_db(self, now: float):
+        # Caller holds _db_lock (or is the constructor)
+        self._db.execute("DELETE FROM analyses WHERE stored_at < ?", (now - self.ttl_seconds,))
+        if self.db_max_rows:
+            self._db.execute(
+                "DELETE FROM analyses WHERE rowid IN "
+                "(SELECT rowid FROM analyses ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+                (self.db_max_rows,),
+            )
@@ -0,0 +1,422 @@
+"""
+Load generator for the wardrobe API (image_to_text.py).
+
+    python benchmark_metadata.py                                    # fake backends, served locally
+    python benchmark_metadata.py --rps 2,5,10,20 --duration 30
+    python benchmark_metadata.py --users 500 --wardrobe-sizes 20,150,800 --new-users 0.2
+    python benchmark_metadata.py --url http://localhost:8000        # e.g. a server with METADATA_BACKEND=fake
+    python benchmark_metadata.py --compare benchmarks/previous.json
+
+Without --url the service is started in this process on the fakes from
+fake_backends.py (METADATA_BACKEND=fake; its FAKE_* variables set each
+dependency's latency and error rate) with the analysis cache off. --users
+users are seeded with wardrobes drawn from --wardrobe-sizes; a --new-users
+fraction of them have no name counter yet, so their first upload pays for
+the display-name backfill scan over their whole wardrobe.
+
+Requests to /categorize and /upload_outfit (split by --mix) arrive
+open-loop at each --rps level for --duration seconds, Poisson-distributed
+unless --uniform, each carrying a synthetic garment cutout from a pool of
+--images distinct ones. Latency is measured from a request's scheduled
+start, so a server that falls behind shows up in the tail rather than
+slowing the generator down. For every level and endpoint the run reports
+throughput, failures, p50/p95/p99/max latency and mean per-stage
+milliseconds from Server-Timing. For a local server it also reports each
+fake dependency's calls, errors and service time. It also reports
+event-loop lag, sampled every 10ms on the server's loop: anything that
+blocks the loop shows up there. Results are written as JSON so runs can
+be compared with --compare. Service logs are discarded unless --verbose.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+from PIL import Image
+
+ENDPOINTS = ("categorize", "upload_outfit")
+LAG_INTERVAL_SECONDS = 0.01
+
+
+# -----------------------------
+# Corpus
+# -----------------------------
+def garment_cutout(side: int, seed: int) -> bytes:
+    """An RGBA PNG like a segmentation cutout: a smoothly textured garment shape on transparency."""
+    rng = np.random.default_rng(seed)
+    texture = Image.fromarray(rng.integers(0, 256, size=(6, 6, 3), dtype=np.uint8)).resize((side, side), Image.BICUBIC)
+    yy, xx = np.mgrid[0:side, 0:side] / side - 0.5
+    rx, ry = rng.uniform(0.3, 0.48, size=2)
+    alpha = ((xx / rx) ** 2 + (yy / ry) ** 2 <= 1.0).astype(np.uint8) * 255
+    image = np.dstack((np.asarray(texture), alpha))
+    buffer = io.BytesIO()
+    Image.fromarray(image, "RGBA").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def build_corpus(count: int, seed: int):
+    rng = random.Random(seed)
+    return [garment_cutout(rng.choice((384, 512, 768)), seed + idx) for idx in range(count)]
+
+
+# -----------------------------
+# Local server
+# -----------------------------
+def import_service():
+    """Import image_to_text.py on the fake backends, with the analysis cache off."""
+    os.environ["METADATA_BACKEND"] = "fake"
+    os.environ["GEMINI_CACHE_MAX_ENTRIES"] = "0"
+    os.environ.pop("GEMINI_CACHE_DB", None)
+    import image_to_text
+
+    return image_to_text
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_locally(app):
+    """
+    Run app on a local port on its own event loop and wait until /readyz
+    passes. Returns its URL, that loop and a function that shuts it down
+    once in-flight requests and their background tasks have finished.
+    """
+    import httpx
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(
+        target=loop.run_until_complete, args=(server.serve(),), name="benchmark-server", daemon=True
+    )
+    thread.start()
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            response = httpx.get(f"{url}/readyz")
+            if response.status_code == 200:
+                return url, loop, stop
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Local metadata server did not become ready")
+
+
+def seed_users(fakes, users: int, wardrobe_sizes, new_users: float, seed: int):
+    """Give every user a wardrobe; a new_users fraction get no name counter document."""
+    rng = random.Random(seed)
+    user_ids = [f"loadtest-{idx:05d}" for idx in range(users)]
+    for user_id in user_ids:
+        fakes.seed_wardrobe(user_id, rng.choice(wardrobe_sizes), with_counters=rng.random() >= new_users)
+    return user_ids
+
+
+class LoopLagProbe:
+    """Samples how late the server loop wakes from a LAG_INTERVAL_SECONDS sleep."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._samples = []
+        self._lock = threading.Lock()
+        self._running = True
+        asyncio.run_coroutine_threadsafe(self._run(), loop)
+
+    async def _run(self):
+        while self._running:
+            started = self.loop.time()
+            await asyncio.sleep(LAG_INTERVAL_SECONDS)
+            lag_ms = (self.loop.time() - started - LAG_INTERVAL_SECONDS) * 1000.0
+            with self._lock:
+                self._samples.append(max(0.0, lag_ms))
+
+    def take(self) -> dict:
+        """Lag since the last take()."""
+        with self._lock:
+            samples, self._samples = self._samples, []
+        return {
+            "samples": len(samples),
+            "p50_ms": percentile(samples, 50),
+            "p99_ms": percentile(samples, 99),
+            "max_ms": round(max(samples), 2) if samples else None,
+        }
+
+    def stop(self):
+        self._running = False
+
+
+# -----------------------------
+# Load
+# -----------------------------
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if params.startswith("dur=") and name != "total":
+            stages[name] = float(params[4:])
+    return stages
+
+
+def percentile(values, pct: float):
+    return round(float(np.percentile(values, pct)), 2) if values else None
+
+
+async def send(client, endpoint: str, user_id: str, image: bytes, scheduled: float) -> dict:
+    data = {"outfit_name": "Load test outfit"} if endpoint == "upload_outfit" else None
+    error = None
+    stages = {}
+    try:
+        response = await client.post(
+            f"/{endpoint}/{user_id}",
+            files={"file": ("item.png", image, "image/png")},
+            data=data,
+            headers={"X-Trace-Timing": "1"},
+        )
+        stages = parse_server_timing(response.headers.get("server-timing", ""))
+        if response.status_code != 200:
+            error = f"HTTP {response.status_code}"
+        else:
+            error = response.json().get("error")
+    except Exception as e:
+        error = type(e).__name__
+    return {
+        "endpoint": endpoint,
+        "ok": error is None,
+        "error": error,
+        "latency_ms": (time.perf_counter() - scheduled) * 1000.0,
+        "stages": stages,
+    }
+
+
+async def run_level(url: str, rps: float, duration: float, mix: dict, user_ids, corpus, uniform: bool, rng: random.Random):
+    """Offer rps requests/sec for duration seconds and wait for all of them to finish."""
+    import httpx
+
+    endpoints, weights = zip(*mix.items())
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=256)
+    async with httpx.AsyncClient(base_url=url, timeout=600.0, limits=limits) as client:
+        tasks = []
+        started = time.perf_counter()
+        offset = 0.0
+        while offset < duration:
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            endpoint = rng.choices(endpoints, weights)[0]
+            tasks.append(asyncio.create_task(
+                send(client, endpoint, rng.choice(user_ids), corpus[len(tasks) % len(corpus)], scheduled)
+            ))
+            offset += 1.0 / rps if uniform else rng.expovariate(rps)
+        records = await asyncio.gather(*tasks)
+        wall = time.perf_counter() - started
+    return records, wall
+
+
+def summarize(records, wall: float) -> dict:
+    latencies = [record["latency_ms"] for record in records]
+    stages = defaultdict(list)
+    for record in records:
+        for stage, duration in record["stages"].items():
+            stages[stage].append(duration)
+    errors = Counter(record["error"] for record in records if not record["ok"])
+    return {
+        "requests": len(records),
+        "failures": sum(errors.values()),
+        "throughput_rps": round(sum(1 for record in records if record["ok"]) / wall, 3),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": round(max(latencies), 2) if latencies else None,
+        "stages_mean_ms": {stage: round(float(np.mean(values)), 2) for stage, values in stages.items()},
+        "top_errors": dict(errors.most_common(3)),
+    }
+
+
+def print_level(result: dict, out):
+    for endpoint, summary in result["endpoints"].items():
+        print(
+            f"{result['rps']:>6g} rps  {endpoint:<14} {summary['throughput_rps']:>7.2f} ok/s  "
+            f"p50 {summary['p50_ms']:>8.1f}ms  p95 {summary['p95_ms']:>8.1f}ms  p99 {summary['p99_ms']:>8.1f}ms  "
+            f"failures {summary['failures']}/{summary['requests']}",
+            file=out,
+        )
+        stages = "  ".join(f"{stage} {ms:.0f}" for stage, ms in summary["stages_mean_ms"].items())
+        print(f"{'':>11}stages(ms): {stages}", file=out)
+    for operation, stats in result.get("dependencies", {}).get("operations", {}).items():
+        print(
+            f"{'':>11}{operation:<30} {stats['calls']:>6} calls  mean {stats['mean_ms']:>8.1f}ms  "
+            f"p95 {stats['p95_ms']:>8.1f}ms  errors {stats['errors']}",
+            file=out,
+        )
+    for event, count in result.get("dependencies", {}).get("events", {}).items():
+        print(f"{'':>11}{event:<30} {count:>6}", file=out)
+    lag = result.get("event_loop_lag")
+    if lag and lag["samples"]:
+        print(f"{'':>11}event loop lag: p50 {lag['p50_ms']}ms  p99 {lag['p99_ms']}ms  max {lag['max_ms']}ms", file=out)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str, out):
+    with open(baseline_path) as f:
+        baseline = {
+            (level["rps"], endpoint): summary
+            for level in json.load(f)["results"]
+            for endpoint, summary in level["endpoints"].items()
+        }
+
+    def delta(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"\nCompared with {baseline_path}:", file=out)
+    for level in results:
+        for endpoint, summary in level["endpoints"].items():
+            old = baseline.get((level["rps"], endpoint))
+            if old is None:
+                continue
+            print(
+                f"  {level['rps']:>6g} rps {endpoint:<14} p50 {delta(summary['p50_ms'], old['p50_ms'])}  "
+                f"p99 {delta(summary['p99_ms'], old['p99_ms'])}  "
+                f"ok/s {delta(summary['throughput_rps'], old['throughput_rps'])}",
+                file=out,
+            )
+
+
+def float_list(value: str):
+    return [float(v) for v in value.split(",") if v]
+
+
+def int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for entry in value.split(","):
+        endpoint, _, weight = entry.partition("=")
+        if endpoint not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {endpoint!r} (use {', '.join(ENDPOINTS)})")
+        mix[endpoint] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the wardrobe metadata API")
+    parser.add_argument("--url", help="metadata server to load (default: serve locally on fake backends)")
+    parser.add_argument("--rps", type=float_list, default=[2.0, 5.0, 10.0], help="offered request rates, one level each")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per rate level")
+    parser.add_argument("--mix", type=parse_mix, default={"categorize": 0.8, "upload_outfit": 0.2})
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--wardrobe-sizes", type=int_list, default=[10, 50, 150, 400])
+    parser.add_argument("--new-users", type=float, default=0.1, help="fraction of users without name counters yet")
+    parser.add_argument("--images", type=int, default=128, help="distinct images to cycle through")
+    parser.add_argument("--uniform", action="store_true", help="evenly spaced instead of Poisson arrivals")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="keep the service's own log output")
+    parser.add_argument("--output", help="result JSON path (default: benchmarks/metadata-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result JSON to compare against")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    if args.verbose:
+        return run(args, out)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return run(args, out)
+
+
+def run(args, out):
+    rng = random.Random(args.seed)
+    corpus = build_corpus(args.images, args.seed)
+
+    fakes = probe = stop = None
+    if args.url:
+        url = args.url.rstrip("/")
+        user_ids = [f"loadtest-{idx:05d}" for idx in range(args.users)]
+    else:
+        service = import_service()
+        url, loop, stop = serve_locally(service.app)
+        fakes = service.fakes
+        user_ids = seed_users(fakes, args.users, args.wardrobe_sizes, args.new_users, args.seed)
+        fakes.stats.reset()
+        probe = LoopLagProbe(loop)
+        print(f"Seeded {len(user_ids)} users, {fakes.firestore.document_count()} documents", file=out)
+
+    results = []
+    for rps in args.rps:
+        if probe is not None:
+            probe.take()
+        records, wall = asyncio.run(run_level(url, rps, args.duration, args.mix, user_ids, corpus, args.uniform, rng))
+        result = {
+            "rps": rps,
+            "wall_seconds": round(wall, 2),
+            "endpoints": {
+                endpoint: summarize([record for record in records if record["endpoint"] == endpoint], wall)
+                for endpoint in args.mix
+            },
+        }
+        if fakes is not None:
+            result["dependencies"] = fakes.stats.snapshot()
+            result["event_loop_lag"] = probe.take()
+            fakes.stats.reset()
+        results.append(result)
+        print_level(result, out)
+
+    if probe is not None:
+        probe.stop()
+        stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "git_commit": git_commit(),
+            "url": args.url,
+            "args": vars(args),
+            "env": {k: v for k, v in os.environ.items() if k.startswith(("METADATA_", "FAKE_", "GEMINI_"))},
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        "benchmarks", f"metadata-{datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Wrote {output}", file=out)
+
+    if args.compare:
+        compare(results, args.compare, out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,485 @@
+"""
+Benchmark harness for the segmentation pipeline.
+
+    python benchmark_segmentation.py --stub-models                  # pipeline overhead only
+    python benchmark_segmentation.py                                 # real models, in-process
+    python benchmark_segmentation.py --target http --url http://localhost:8080
+    python benchmark_segmentation.py --stub-models --target http     # serves the app locally
+    python benchmark_segmentation.py --stub-models --compare benchmarks/previous.json
+
+The corpus is a seeded set of synthetic JPEGs (every --resolutions x
+--garments combination) plus any --images files. Each corpus entry is sent
+--requests times at every --concurrency level, and the run reports p50/p95/
+p99 latency, images/sec, mean per-stage milliseconds and peak RSS. Results
+are written as JSON so runs can be compared with --compare.
+
+--target inprocess drives decode, the inference scheduler and rendering
+directly; --target http posts to /segment, against --url or, without one,
+a server started in this process. The result cache is disabled for local
+runs and bypassed with a per-request nonce for remote ones. --stub-models
+swaps GroundingDINO and SAM2 for cheap stand-ins that find the synthetic
+garments by colour and return elliptical masks, so the numbers isolate
+pipeline overhead from model time. Everything runs on CPU.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import types
+import uuid
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+# -----------------------------
+# Corpus
+# -----------------------------
+GARMENT_COLORS = [(200, 30, 30), (30, 60, 200), (240, 200, 20), (30, 160, 60), (150, 40, 170), (240, 120, 20)]
+
+
+def synthetic_image(side: int, garments: int, seed: int) -> bytes:
+    """A 4:3 JPEG with `garments` saturated shapes on a muted, noisy background."""
+    rng = np.random.default_rng(seed)
+    width, height = side, side * 3 // 4
+    background = rng.integers(90, 140, size=(height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    image = cv2.resize(background, (width, height), interpolation=cv2.INTER_CUBIC)
+    image = cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
+
+    # Lay garments out on a grid so they never touch
+    cols = int(np.ceil(np.sqrt(garments)))
+    rows = int(np.ceil(garments / cols))
+    cell_w, cell_h = width // cols, height // rows
+    for idx in range(garments):
+        x0, y0 = (idx % cols) * cell_w, (idx // cols) * cell_h
+        center = (x0 + cell_w // 2, y0 + cell_h // 2)
+        axes = (int(cell_w * rng.uniform(0.25, 0.4)), int(cell_h * rng.uniform(0.25, 0.4)))
+        cv2.ellipse(image, center, axes, 0, 0, 360, GARMENT_COLORS[idx % len(GARMENT_COLORS)], -1)
+
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, "JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def build_corpus(resolutions, garment_counts, image_paths, seed: int):
+    corpus = []
+    for side in resolutions:
+        for garments in garment_counts:
+            corpus.append((f"{side}px-{garments}g", synthetic_image(side, garments, seed + side + garments)))
+    for path in image_paths:
+        with open(path, "rb") as f:
+            corpus.append((os.path.basename(path), f.read()))
+    return corpus
+
+
+# -----------------------------
+# Stub models
+# -----------------------------
+def find_garments(image_np: np.ndarray) -> np.ndarray:
+    """xyxy boxes around saturated regions covering at least 1% of the image."""
+    saturation = cv2.cvtColor(image_np, cv2.COLOR_RGB2HSV)[:, :, 1]
+    count, _, stats, _ = cv2.connectedComponentsWithStats((saturation > 100).astype(np.uint8))
+    min_area = 0.01 * image_np.shape[0] * image_np.shape[1]
+    boxes = [
+        [x, y, x + w, y + h]
+        for x, y, w, h, area in stats[1:count]
+        if area >= min_area
+    ]
+    return np.array(boxes, dtype=np.float32).reshape(-1, 4)
+
+
+class StubTokenizer:
+    def __call__(self, text, return_tensors=None, **kwargs):
+        ids = [101] + [zlib.crc32(word.encode()) % 30000 for word in text.split()] + [102]
+        input_ids = torch.tensor([ids])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "token_type_ids": torch.zeros_like(input_ids),
+        }
+
+
+class StubImageProcessor:
+    """Finds the garments up front and passes the boxes through the model inputs."""
+
+    def __call__(self, images, return_tensors=None, **kwargs):
+        found = [find_garments(np.array(image)) for image in images]
+        boxes = torch.zeros(len(images), max([len(b) for b in found] + [1]), 4)
+        for idx, image_boxes in enumerate(found):
+            boxes[idx, :len(image_boxes)] = torch.from_numpy(image_boxes)
+        return {
+            "pixel_values": torch.zeros(len(images), 3, 1, 1),
+            "stub_boxes": boxes,
+            "stub_counts": torch.tensor([len(b) for b in found]),
+        }
+
+
+class StubProcessor:
+    tokenizer = StubTokenizer()
+    image_processor = StubImageProcessor()
+
+    def post_process_grounded_object_detection(self, outputs, input_ids=None, target_sizes=None, **kwargs):
+        return [
+            {
+                "boxes": boxes[:count],
+                "scores": torch.full((int(count),), 0.9),
+                "labels": ["clothes"] * int(count),
+            }
+            for boxes, count in zip(outputs["stub_boxes"], outputs["stub_counts"])
+        ]
+
+
+class StubTextBackbone(torch.nn.Module):
+    def forward(self, input_ids, *args, **kwargs):
+        from transformers.modeling_outputs import BaseModelOutput
+
+        return BaseModelOutput(last_hidden_state=torch.zeros(input_ids.shape[0], input_ids.shape[1], 8))
+
+
+class StubDetector(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.model = torch.nn.Module()
+        self.model.text_backbone = StubTextBackbone()
+        self.proj = torch.nn.Linear(8, 8)
+
+    def forward(self, input_ids=None, stub_boxes=None, stub_counts=None, **kwargs):
+        # Goes through the (cached) text backbone like the real model does
+        self.model.text_backbone(input_ids, None, None, None, return_dict=True)
+        return {"stub_boxes": stub_boxes, "stub_counts": stub_counts}
+
+
+class StubSam2(torch.nn.Module):
+    image_size = 1024
+
+    def __init__(self):
+        super().__init__()
+        self.sam_mask_decoder = torch.nn.Linear(8, 8)
+
+
+class StubPredictor:
+    """Returns the ellipse inscribed in each box (or around each object's clicks) as its mask."""
+
+    def set_image_batch(self, images):
+        self._shapes = [image.shape[:2] for image in images]
+
+    def predict_batch(self, point_coords_batch=None, point_labels_batch=None, box_batch=None,
+                      multimask_output=False, **kwargs):
+        masks_batch = []
+        for idx, (height, width) in enumerate(self._shapes):
+            boxes = box_batch[idx] if box_batch is not None else None
+            if boxes is None:
+                # Points only: a box around each object's clicks
+                boxes = [
+                    [xs.min() - 40, ys.min() - 40, xs.max() + 40, ys.max() + 40]
+                    for xs, ys in (points.T for points in point_coords_batch[idx])
+                ]
+            masks = np.zeros((len(boxes), 1, height, width), dtype=np.float32)
+            for mask, (x1, y1, x2, y2) in zip(masks, boxes):
+                center = (int((x1 + x2) / 2), int((y1 + y2) / 2))
+                axes = (max(1, int((x2 - x1) / 2)), max(1, int((y2 - y1) / 2)))
+                cv2.ellipse(mask[0], center, axes, 0, 0, 360, 1.0, -1)
+            masks_batch.append(masks)
+        logits_batch = [np.zeros((len(m), 256, 256), dtype=np.float32) for m in masks_batch]
+        return masks_batch, [np.ones((len(m), 1)) for m in masks_batch], logits_batch
+
+
+def install_stub_models(seg):
+    seg.AutoProcessor = types.SimpleNamespace(from_pretrained=lambda *a, **k: StubProcessor())
+    seg.AutoModelForZeroShotObjectDetection = types.SimpleNamespace(from_pretrained=lambda *a, **k: StubDetector())
+    seg.build_sam2 = lambda *a, **k: StubSam2()
+    seg.create_predictor_factory = lambda *a, **k: StubPredictor
+    seg.SAM2AutomaticMaskGenerator = lambda model: None
+
+
+def import_segmentation(stub_models: bool, local: bool):
+    """Import segmentation.py with load-on-demand settings (and no result cache for local runs)."""
+    os.environ["SEGMENT_BACKGROUND_LOAD"] = "0"
+    if local:
+        os.environ["SEGMENT_CACHE_MAX_BYTES"] = "0"
+        os.environ.pop("SEGMENT_CACHE_DIR", None)
+    import segmentation as seg
+
+    if stub_models:
+        install_stub_models(seg)
+    return seg
+
+
+# -----------------------------
+# Targets
+# -----------------------------
+def make_inprocess_target(seg, options):
+    """Mirror /segment without HTTP: decode, queue on the scheduler, render."""
+    from stage_timing import StageTimings
+
+    def send(contents: bytes):
+        timings = StageTimings()
+        with timings.stage("decode"):
+            image = seg.decode_image(contents)
+        waited = time.perf_counter()
+        result = seg.scheduler.submit((image, options.vocabulary)).result()
+        model_ms = sum(result["timings"].values())
+        timings.add("queue", max(0.0, (time.perf_counter() - waited) * 1000.0 - model_ms))
+        timings.update(result["timings"])
+        body = seg.render_result(result, options, contents, timings)
+        ok = not (isinstance(body, dict) and "error" in body)
+        return ok, timings.durations
+
+    return send
+
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for entry in header.split(","):
+        name, _, params = entry.strip().partition(";")
+        if params.startswith("dur=") and name != "total":
+            stages[name] = float(params[4:])
+    return stages
+
+
+def make_http_target(url: str, output: str, bust_cache: bool):
+    import httpx
+
+    local = threading.local()
+
+    def send(contents: bytes):
+        if not hasattr(local, "client"):
+            local.client = httpx.Client(base_url=url, timeout=600.0)
+        if bust_cache:
+            # Trailing bytes after the image are ignored by the decoder but change the cache key
+            contents = contents + b"\0" + uuid.uuid4().bytes
+        response = local.client.post(
+            "/segment", params={"format": output}, files={"file": ("image.jpg", contents, "image/jpeg")}
+        )
+        ok = response.status_code == 200
+        if ok and output in ("json", "rle"):
+            ok = "error" not in response.json()
+        return ok, parse_server_timing(response.headers.get("server-timing", ""))
+
+    return send
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def serve_locally(seg) -> str:
+    """Run the segmentation app on a local port and wait until /readyz passes."""
+    import httpx
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(seg.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="benchmark-server", daemon=True).start()
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 1800
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/readyz").status_code == 200:
+                return url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("Local segmentation server did not become ready")
+
+
+def server_rss(url: str):
+    """Current RSS of a server exposing Prometheus process metrics, if available."""
+    import httpx
+
+    try:
+        text = httpx.get(f"{url}/metrics").text
+    except httpx.TransportError:
+        return None
+    for line in text.splitlines():
+        if line.startswith("process_resident_memory_bytes"):
+            return int(float(line.split()[-1]))
+    return None
+
+
+# -----------------------------
+# Measurement
+# -----------------------------
+def percentile(values, pct: float) -> float:
+    return round(float(np.percentile(values, pct)), 2) if values else None
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in KiB on Linux; children covers forked model workers
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+def run_level(send, contents: bytes, concurrency: int, requests: int) -> dict:
+    latencies = []
+    stages = defaultdict(list)
+    failures = 0
+    lock = threading.Lock()
+
+    def one():
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            ok, durations = send(contents)
+        except Exception as e:
+            print(f"❌ Request failed: {e}")
+            ok, durations = False, {}
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        with lock:
+            latencies.append(elapsed_ms)
+            failures += 0 if ok else 1
+            for stage, duration in durations.items():
+                stages[stage].append(duration)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(one) for _ in range(requests)]:
+            future.result()
+    wall = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "failures": failures,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": round(float(np.mean(latencies)), 2),
+        "images_per_sec": round(requests / wall, 3),
+        "stages_mean_ms": {stage: round(float(np.mean(values)), 2) for stage, values in stages.items()},
+        "peak_rss_bytes": peak_rss_bytes(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(r["corpus"], r["concurrency"]): r for r in json.load(f)["results"]}
+
+    def delta(new, old):
+        return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get((result["corpus"], result["concurrency"]))
+        if old is None:
+            continue
+        print(
+            f"  {result['corpus']:<16} c={result['concurrency']:<3} "
+            f"p50 {delta(result['p50_ms'], old['p50_ms'])}  p95 {delta(result['p95_ms'], old['p95_ms'])}  "
+            f"img/s {delta(result['images_per_sec'], old['images_per_sec'])}"
+        )
+
+
+def int_list(value: str):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the segmentation pipeline")
+    parser.add_argument("--target", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--url", help="segmentation server to benchmark (default: serve locally)")
+    parser.add_argument("--stub-models", action="store_true", help="replace GroundingDINO/SAM2 with cheap stubs")
+    parser.add_argument("--resolutions", type=int_list, default=[512, 1024, 2048])
+    parser.add_argument("--garments", type=int_list, default=[1, 3])
+    parser.add_argument("--images", nargs="*", default=[], help="extra sample images to include")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 8])
+    parser.add_argument("--requests", type=int, default=20, help="requests per corpus entry and concurrency level")
+    parser.add_argument("--warmup", type=int, default=2, help="unmeasured requests per corpus entry")
+    parser.add_argument("--format", choices=("json", "rle", "png", "webp"), default="json")
+    parser.add_argument("--mode", choices=("merged", "items"), default="merged")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result JSON path (default: benchmarks/segmentation-<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier result JSON to compare against")
+    args = parser.parse_args(argv)
+
+    if args.url and args.stub_models:
+        parser.error("--stub-models only applies to in-process runs or a locally served app")
+
+    torch.set_grad_enabled(False)
+    corpus = build_corpus(args.resolutions, args.garments, args.images, args.seed)
+
+    if args.url:
+        send = make_http_target(args.url.rstrip("/"), args.format, bust_cache=True)
+        url = args.url.rstrip("/")
+    else:
+        seg = import_segmentation(args.stub_models, local=True)
+        if args.target == "http":
+            url = serve_locally(seg)
+            send = make_http_target(url, args.format, bust_cache=False)
+        else:
+            url = None
+            seg.load_models()
+            if seg.model_status["state"] != "ready":
+                print(f"❌ Models failed to load: {seg.model_status['error']}")
+                return 1
+            options = seg.build_options(args.mode, seg.DEFAULT_VOCABULARY, args.format, None)
+            send = make_inprocess_target(seg, options)
+
+    results = []
+    for name, contents in corpus:
+        for _ in range(args.warmup):
+            send(contents)
+        for concurrency in args.concurrency:
+            result = {"corpus": name, "bytes": len(contents), **run_level(send, contents, concurrency, args.requests)}
+            if url is not None:
+                result["server_rss_bytes"] = server_rss(url)
+            results.append(result)
+            print(
+                f"{name:<16} c={concurrency:<3} p50 {result['p50_ms']:>9.1f}ms  p95 {result['p95_ms']:>9.1f}ms  "
+                f"p99 {result['p99_ms']:>9.1f}ms  {result['images_per_sec']:>7.2f} img/s  "
+                f"failures {result['failures']}"
+            )
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "git_commit": git_commit(),
+            "target": args.target if not args.url else "http",
+            "url": args.url,
+            "stub_models": args.stub_models,
+            "args": vars(args),
+            "env": {k: v for k, v in os.environ.items() if k.startswith("SEGMENT_")},
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        "benchmarks", f"segmentation-{datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Wrote {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,543 @@
+"""
+In-process stand-ins for Gemini, Firestore and Cloud Storage, used by
+image_to_text.py when METADATA_BACKEND=fake (and by
+benchmark_metadata.py) so the service can be load-tested without
+credentials, quota or cost.
+
+Each fake implements only the calls the service makes, with the same
+threading model as the real client: the Gemini fake is async (client.aio),
+while Firestore and Storage block the calling thread. Every call waits for
+a latency drawn from a log-normal distribution around its median and fails
+with FakeBackendError at the configured error rate. Both are set per
+dependency through environment variables:
+
+    FAKE_GEMINI_LATENCY_MS      median latency (default 1200)
+    FAKE_GEMINI_SPREAD          log-normal sigma (default 0.35)
+    FAKE_GEMINI_ERROR_RATE      0.0 - 1.0 (default 0)
+
+and the same for FAKE_FIRESTORE_* (default 25ms) and FAKE_STORAGE_*
+(default 60ms). FAKE_FIRESTORE_SCAN_MS_PER_DOC adds time per document
+returned by a query. FAKE_STORAGE_MB_PER_SEC adds upload time for the
+payload size. FAKE_SEED makes runs repeatable.
+
+Every call is recorded in DependencyStats, which keeps its pure service
+time. The service's own stage timings also include time spent waiting
+for the I/O pool, so comparing the two shows where requests queue.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+MAX_TRANSACTION_ATTEMPTS = 5  # as google.cloud.firestore's transactional
+LOCK_TIMEOUT_SECONDS = 10.0
+
+CATEGORIES = ("top", "bottom", "full_body")
+COLORS = ("black", "white", "navy", "beige", "red", "olive", "grey", "pink")
+PATTERNS = ("solid", "striped", "checked", "floral", "graphic")
+STYLES = ("casual", "formal", "streetwear", "business", "sporty", "minimalist")
+OCCASIONS = (
+    "Casual", "Formal", "Business / Office", "Party / Celebration", "Wedding", "Sports / Active",
+    "Travel / Vacation", "Loungewear / Home", "Traditional / Cultural", "Seasonal / Weather-based",
+)
+
+
+class FakeBackendError(RuntimeError):
+    """An injected failure from a fake dependency."""
+
+
+@dataclass
+class FaultProfile:
+    """Latency and error injection for one fake dependency."""
+
+    latency_ms: float
+    spread: float = 0.35
+    error_rate: float = 0.0
+
+    @classmethod
+    def from_env(cls, name: str, latency_ms: float) -> "FaultProfile":
+        prefix = f"FAKE_{name.upper()}_"
+        return cls(
+            latency_ms=float(os.getenv(prefix + "LATENCY_MS", str(latency_ms))),
+            spread=float(os.getenv(prefix + "SPREAD", "0.35")),
+            error_rate=float(os.getenv(prefix + "ERROR_RATE", "0")),
+        )
+
+    def draw(self, rng: random.Random, extra_ms: float = 0.0) -> float:
+        """Seconds this call takes."""
+        latency_ms = self.latency_ms * math.exp(rng.gauss(0.0, self.spread)) if self.latency_ms > 0 else 0.0
+        return (latency_ms + extra_ms) / 1000.0
+
+    def fails(self, rng: random.Random) -> bool:
+        return self.error_rate > 0 and rng.random() < self.error_rate
+
+
+class DependencyStats:
+    """Service time and outcome of every fake call, by operation (e.g. "firestore.set")."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = defaultdict(list)  # operation -> service time in ms per call
+        self._errors = defaultdict(int)
+        self._events = defaultdict(int)  # non-call counters, e.g. transaction retries
+
+    def record(self, operation: str, seconds: float, ok: bool = True):
+        with self._lock:
+            self._calls[operation].append(seconds * 1000.0)
+            if not ok:
+                self._errors[operation] += 1
+
+    def count(self, event: str):
+        with self._lock:
+            self._events[event] += 1
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._errors.clear()
+            self._events.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            operations = {
+                operation: {
+                    "calls": len(times),
+                    "errors": self._errors.get(operation, 0),
+                    "mean_ms": round(float(np.mean(times)), 2),
+                    "p95_ms": round(float(np.percentile(times, 95)), 2),
+                    "total_ms": round(float(np.sum(times)), 1),
+                }
+                for operation, times in sorted(self._calls.items())
+                if times
+            }
+            return {"operations": operations, "events": dict(self._events)}
+
+
+class _Dependency:
+    """Shared latency/error behaviour of one fake client."""
+
+    def __init__(self, name: str, profile: FaultProfile, stats: DependencyStats, rng: random.Random):
+        self.name = name
+        self.profile = profile
+        self.stats = stats
+        self.rng = rng
+
+    def _outcome(self, operation: str, extra_ms: float):
+        seconds = self.profile.draw(self.rng, extra_ms)
+        failed = self.profile.fails(self.rng)
+        return f"{self.name}.{operation}", seconds, failed
+
+    def call(self, operation: str, extra_ms: float = 0.0):
+        """Block for one call's latency, then raise if it was chosen to fail."""
+        name, seconds, failed = self._outcome(operation, extra_ms)
+        time.sleep(seconds)
+        self.stats.record(name, seconds, ok=not failed)
+        if failed:
+            raise FakeBackendError(f"Injected {name} failure")
+
+    async def acall(self, operation: str, extra_ms: float = 0.0):
+        name, seconds, failed = self._outcome(operation, extra_ms)
+        await asyncio.sleep(seconds)
+        self.stats.record(name, seconds, ok=not failed)
+        if failed:
+            raise FakeBackendError(f"Injected {name} failure")
+
+
+# -----------------------------
+# Gemini
+# -----------------------------
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _FakeModels:
+    def __init__(self, dependency: _Dependency):
+        self._dependency = dependency
+
+    async def generate_content(self, model: str, contents: list, config=None) -> FakeGeminiResponse:
+        """ClothingItem-shaped JSON picked deterministically from the image bytes."""
+        await self._dependency.acall("generate_content")
+        data = next(
+            (part.inline_data.data for part in contents if getattr(part, "inline_data", None) is not None), b""
+        )
+        digest = hashlib.sha256(data).digest()
+        pick = lambda options, idx: options[digest[idx] % len(options)]
+        return FakeGeminiResponse(json.dumps({
+            "description": f"A {pick(COLORS, 1)} {pick(PATTERNS, 2)} {pick(STYLES, 3)} garment",
+            "category": pick(CATEGORIES, 0),
+            "color": pick(COLORS, 1),
+            "pattern": pick(PATTERNS, 2),
+            "style": pick(STYLES, 3),
+            "occasion": pick(OCCASIONS, 4),
+        }))
+
+
+class _FakeAsyncClient:
+    def __init__(self, dependency: _Dependency):
+        self.models = _FakeModels(dependency)
+
+
+class FakeGeminiClient:
+    """Stands in for genai.Client(); only client.aio.models.generate_content is used."""
+
+    def __init__(self, dependency: _Dependency):
+        self.aio = _FakeAsyncClient(dependency)
+
+
+# -----------------------------
+# Firestore
+# -----------------------------
+class FakeSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[dict]:
+        return json.loads(json.dumps(self._data)) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, transaction: Optional["FakeTransaction"] = None) -> FakeSnapshot:
+        if transaction is not None:
+            transaction.lock(self.path)
+        self._db.dependency.call("get")
+        return FakeSnapshot(self, self._db.read(self.path))
+
+    def set(self, data: dict):
+        self._db.dependency.call("set")
+        self._db.write(self.path, data)
+
+    def create(self, data: dict):
+        self._db.dependency.call("create")
+        with self._db.lock:
+            if self._db.read(self.path) is not None:
+                raise AlreadyExists(f"Document already exists: {self.path}")
+            self._db.write(self.path, data)
+
+    def update(self, fields: dict):
+        self._db.dependency.call("update")
+        with self._db.lock:
+            data = self._db.read(self.path)
+            if data is None:
+                raise NotFound(f"No document to update: {self.path}")
+            data.update(fields)
+            self._db.write(self.path, data)
+
+    def delete(self):
+        self._db.dependency.call("delete")
+        self._db.write(self.path, None)
+
+
+class FakeQuery:
+    def __init__(self, collection: "FakeCollectionReference", fields: Optional[List[str]] = None):
+        self._collection = collection
+        self._fields = fields
+
+    def stream(self):
+        db = self._collection._db
+        documents = db.documents_in(self._collection.path)
+        db.dependency.call("stream", extra_ms=len(documents) * db.scan_ms_per_doc)
+        for path, data in documents:
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            yield FakeSnapshot(FakeDocumentReference(db, path), data)
+
+
+class FakeCollectionReference:
+    def __init__(self, db: "FakeFirestore", path: str):
+        self._db = db
+        self.path = path
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        return FakeDocumentReference(self._db, f"{self.path}/{document_id or uuid.uuid4().hex}")
+
+    def select(self, fields: List[str]) -> FakeQuery:
+        return FakeQuery(self, list(fields))
+
+    def stream(self):
+        return FakeQuery(self).stream()
+
+    def list_documents(self):
+        return [FakeDocumentReference(self._db, path) for path, _ in self._db.documents_in(self.path)]
+
+
+class FakeWriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference: FakeDocumentReference, data: dict):
+        self._writes.append((reference.path, data))
+
+    def commit(self):
+        self._db.dependency.call("batch_commit", extra_ms=len(self._writes) * 0.1)
+        with self._db.lock:
+            for path, data in self._writes:
+                self._db.write(path, data)
+
+
+class TransactionAborted(Exception):
+    """A transaction gave up waiting for a document lock; transactional() retries it."""
+
+
+class FakeTransaction:
+    """
+    Like Firestore's server-side transactions, reading a document locks it
+    until the transaction commits, so concurrent transactions on one
+    document queue up behind each other. One that waits longer than
+    LOCK_TIMEOUT_SECONDS is aborted and retried.
+    """
+
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self.writes = []
+        self._held = {}  # path -> lock
+
+    def lock(self, path: str):
+        if path in self._held:
+            return
+        lock = self._db.document_lock(path)
+        if not lock.acquire(timeout=LOCK_TIMEOUT_SECONDS):
+            raise TransactionAborted(path)
+        self._held[path] = lock
+
+    def set(self, reference: FakeDocumentReference, data: dict):
+        self.writes.append((reference.path, data))
+
+    def begin(self):
+        self.release()
+        self.writes = []
+
+    def commit(self):
+        try:
+            self._db.dependency.call("transaction_commit")
+            with self._db.lock:
+                for path, data in self.writes:
+                    self._db.write(path, data)
+        finally:
+            self.release()
+
+    def release(self):
+        for lock in self._held.values():
+            lock.release()
+        self._held = {}
+
+
+def transactional(fn):
+    """
+    Counterpart of firestore.transactional for FakeFirestore: run fn in a
+    transaction, retrying it (up to MAX_TRANSACTION_ATTEMPTS times) when it
+    is aborted by lock contention.
+    """
+
+    def run(transaction: FakeTransaction, *args, **kwargs):
+        stats = transaction._db.dependency.stats
+        for _ in range(MAX_TRANSACTION_ATTEMPTS):
+            transaction.begin()
+            try:
+                result = fn(transaction, *args, **kwargs)
+                transaction.commit()
+                return result
+            except TransactionAborted:
+                stats.count("firestore.transaction_aborted")
+            finally:
+                transaction.release()
+        raise FakeBackendError(f"Transaction aborted {MAX_TRANSACTION_ATTEMPTS} times")
+
+    return run
+
+
+class FakeFirestore:
+    """
+    Stands in for firestore.Client: documents are JSON-copied dicts in
+    memory, indexed by collection path.
+    """
+
+    def __init__(self, dependency: _Dependency, scan_ms_per_doc: float = 0.0):
+        self.dependency = dependency
+        self.scan_ms_per_doc = scan_ms_per_doc
+        self.lock = threading.RLock()
+        self._collections = defaultdict(dict)  # collection path -> {document id: data}
+        self._document_locks = defaultdict(threading.Lock)  # path -> transaction lock
+
+    def collection(self, name: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, name)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self) -> FakeTransaction:
+        return FakeTransaction(self)
+
+    def document_lock(self, path: str) -> threading.Lock:
+        with self.lock:
+            return self._document_locks[path]
+
+    def read(self, path: str) -> Optional[dict]:
+        """A copy of the document at path, or None."""
+        collection, _, document_id = path.rpartition("/")
+        with self.lock:
+            data = self._collections[collection].get(document_id)
+            return json.loads(json.dumps(data)) if data is not None else None
+
+    def write(self, path: str, data: Optional[dict]):
+        """Store (or with None, delete) the document at path."""
+        collection, _, document_id = path.rpartition("/")
+        with self.lock:
+            if data is None:
+                self._collections[collection].pop(document_id, None)
+            else:
+                self._collections[collection][document_id] = json.loads(json.dumps(data))
+
+    def documents_in(self, collection: str) -> list:
+        with self.lock:
+            return [
+                (f"{collection}/{document_id}", json.loads(json.dumps(data)))
+                for document_id, data in self._collections.get(collection, {}).items()
+            ]
+
+    def document_count(self) -> int:
+        with self.lock:
+            return sum(len(documents) for documents in self._collections.values())
+
+
+# -----------------------------
+# Cloud Storage
+# -----------------------------
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+
+    def upload_from_string(self, data: bytes, content_type: str = "application/octet-stream"):
+        bucket = self.bucket
+        transfer_ms = len(data) / (bucket.mb_per_sec * 1000.0) if bucket.mb_per_sec > 0 else 0.0
+        bucket.dependency.call("upload", extra_ms=transfer_ms)
+        with bucket.lock:
+            bucket.objects[self.name] = (len(data), content_type)
+
+    def make_public(self):
+        self.bucket.dependency.call("make_public")
+
+    def delete(self):
+        self.bucket.dependency.call("delete")
+        with self.bucket.lock:
+            if self.bucket.objects.pop(self.name, None) is None:
+                raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+
+
+class FakeBucket:
+    """Keeps each object's size and content type, not its bytes."""
+
+    def __init__(self, name: str, dependency: _Dependency, mb_per_sec: float):
+        self.name = name
+        self.dependency = dependency
+        self.mb_per_sec = mb_per_sec
+        self.lock = threading.Lock()
+        self.objects = {}  # object name -> (size, content type)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def stored_bytes(self) -> int:
+        with self.lock:
+            return sum(size for size, _ in self.objects.values())
+
+
+class FakeStorageClient:
+    def __init__(self, dependency: _Dependency, mb_per_sec: float = 0.0):
+        self.dependency = dependency
+        self.mb_per_sec = mb_per_sec
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name: str) -> FakeBucket:
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(name, self.dependency, self.mb_per_sec)
+            return self._buckets[name]
+
+
+# -----------------------------
+# Wiring
+# -----------------------------
+class FakeBackends:
+    """The three fake clients plus the stats they share."""
+
+    def __init__(
+        self,
+        gemini: FaultProfile,
+        firestore: FaultProfile,
+        storage: FaultProfile,
+        scan_ms_per_doc: float = 0.05,
+        storage_mb_per_sec: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.stats = DependencyStats()
+        rng = random.Random(seed)
+        self.gemini = FakeGeminiClient(_Dependency("gemini", gemini, self.stats, random.Random(rng.random())))
+        self.firestore = FakeFirestore(
+            _Dependency("firestore", firestore, self.stats, random.Random(rng.random())), scan_ms_per_doc
+        )
+        self.storage = FakeStorageClient(
+            _Dependency("storage", storage, self.stats, random.Random(rng.random())), storage_mb_per_sec
+        )
+        self.transactional = transactional
+
+    @classmethod
+    def from_env(cls) -> "FakeBackends":
+        seed = os.getenv("FAKE_SEED")
+        return cls(
+            gemini=FaultProfile.from_env("gemini", 1200),
+            firestore=FaultProfile.from_env("firestore", 25),
+            storage=FaultProfile.from_env("storage", 60),
+            scan_ms_per_doc=float(os.getenv("FAKE_FIRESTORE_SCAN_MS_PER_DOC", "0.05")),
+            storage_mb_per_sec=float(os.getenv("FAKE_STORAGE_MB_PER_SEC", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def seed_wardrobe(self, user_id: str, items: int, with_counters: bool = True):
+        """
+        Give user_id `items` wardrobe documents with display names like the
+        service hands out. Without counters the user has no counter document yet,
+        so their first upload pays for the backfill scan.
+        """
+        rng = random.Random(user_id)
+        counts = {}
+        with self.firestore.lock:
+            for _ in range(items):
+                base = rng.choice(("Casual", "Formal", "Business", "Party", "Sports", "Travel"))
+                counts[base] = counts.get(base, 0) + 1
+                self.firestore.write(
+                    f"users/{user_id}/wardrobeItems/{uuid.uuid4().hex}",
+                    {
+                        "image_name": "seed.png",
+                        "image_url": f"https://example.invalid/{user_id}/{counts[base]}.png",
+                        "metadata": {"occasion": base, "category": rng.choice(CATEGORIES)},
+                        "display_name": f"{base} {counts[base]}",
+                    },
+                )
+            if with_counters:
+                self.firestore.write(f"users/{user_id}/counters/displayNames", {"counts": counts})
@@ -0,0 +1,103 @@
+import json
+import os
+from typing import Dict, List, Union
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+# -----------------------------
+# Label vocabularies
+# -----------------------------
+# Each vocabulary becomes one GroundingDINO prompt ("a . b . c ."). Extra or
+# replacement vocabularies can be supplied as a JSON object of
+# {"name": ["label", ...]} in the file named by SEGMENT_VOCABULARIES_FILE.
+DEFAULT_VOCABULARIES = {
+    "clothing": [
+        "clothes", "shirt", "t-shirt", "pants", "dress", "jacket", "coat", "skirt", "blouse",
+        "sweater", "hoodie", "jeans", "trousers", "shorts", "gown", "jumpsuit",
+    ],
+    "accessories": [
+        "bag", "handbag", "backpack", "hat", "cap", "scarf", "belt", "sunglasses", "watch",
+        "necklace", "bracelet", "earrings", "tie",
+    ],
+    "shoes": [
+        "shoes", "sneakers", "boots", "heels", "sandals", "slippers", "loafers",
+    ],
+}
+DEFAULT_VOCABULARY = "clothing"
+
+
+def build_prompt(labels: Union[str, List[str]]) -> str:
+    """Join labels into GroundingDINO's lower-case, period-separated prompt format."""
+    if isinstance(labels, str):
+        return labels
+    return " . ".join(label.strip().lower() for label in labels) + " ."
+
+
+def load_vocabularies() -> Dict[str, str]:
+    """Return {vocabulary name: prompt string}, including any configured overrides."""
+    vocabularies = dict(DEFAULT_VOCABULARIES)
+    path = os.getenv("SEGMENT_VOCABULARIES_FILE")
+    if path:
+        with open(path) as f:
+            vocabularies.update(json.load(f))
+    return {name: build_prompt(labels) for name, labels in vocabularies.items()}
+
+
+# -----------------------------
+# Text-side caching
+# -----------------------------
+class CachedTextBackbone(torch.nn.Module):
+    """
+    Drop-in wrapper for GroundingDINO's BERT text backbone that memoizes its
+    output per prompt. GroundingDINO derives the attention masks and position
+    ids passed to the backbone from input_ids alone, so the token ids are a
+    complete cache key. Batches whose rows all carry the same prompt reuse a
+    single cached row; mixed batches fall through to the wrapped backbone.
+    """
+
+    def __init__(self, text_backbone: torch.nn.Module):
+        super().__init__()
+        self.text_backbone = text_backbone
+        self._features = {}
+
+    def forward(self, input_ids, *args, **kwargs):
+        first_row = input_ids[0]
+        uniform = bool((input_ids == first_row).all())
+        if not uniform:
+            return self.text_backbone(input_ids, *args, **kwargs)
+
+        key = tuple(first_row.tolist())
+        hidden = self._features.get(key)
+        if hidden is None:
+            first_args = [arg[:1] if torch.is_tensor(arg) else arg for arg in args]
+            outputs = self.text_backbone(input_ids[:1], *first_args, **kwargs)
+            hidden = outputs[0].detach()
+            self._features[key] = hidden
+        return BaseModelOutput(last_hidden_state=hidden.expand(input_ids.shape[0], -1, -1))
+
+
+class PromptEncoder:
+    """
+    Tokenizes every vocabulary once and installs CachedTextBackbone on the
+    model, so per-request detection only runs the image side of GroundingDINO.
+    """
+
+    def __init__(self, processor, model, vocabularies: Dict[str, str], device):
+        self.processor = processor
+        self.vocabularies = vocabularies
+        self.device = device
+        self.tokens = {
+            name: {k: v.to(device) for k, v in processor.tokenizer(prompt, return_tensors="pt").items()}
+            for name, prompt in vocabularies.items()
+        }
+        if not isinstance(model.model.text_backbone, CachedTextBackbone):
+            model.model.text_backbone = CachedTextBackbone(model.model.text_backbone)
+
+    def inputs_for(self, images, vocabulary: str) -> dict:
+        """Model inputs for a batch of images that all use the same vocabulary."""
+        inputs = self.processor.image_processor(images, return_tensors="pt")
+        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        for k, v in self.tokens[vocabulary].items():
+            inputs[k] = v.repeat(len(images), 1)
+        return inputs
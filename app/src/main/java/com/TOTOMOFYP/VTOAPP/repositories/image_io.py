@@ -0,0 +1,115 @@
+import base64
+import io
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from uploads import read_upload  # re-exported for the segmentation endpoints
+
+
+def load_working_image(contents: bytes, max_side: int) -> Image.Image:
+    """
+    Decode an upload at the models' working resolution: the longest side is
+    capped at max_side (0 keeps the original size). JPEGs are decoded with
+    PIL's draft mode, which lets libjpeg skip straight to a 1/2, 1/4 or 1/8
+    scale instead of materialising every pixel of a 12MP photo.
+    """
+    image = Image.open(io.BytesIO(contents))
+    width, height = image.size
+    scale = max_side / max(width, height) if max_side else 1.0
+    if scale < 1.0:
+        target = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image.draft("RGB", target)
+        image = image.convert("RGB")
+        image.thumbnail(target, Image.BICUBIC)
+        return image
+    return image.convert("RGB")
+
+
+def load_full_image(contents: bytes, working_np: np.ndarray) -> np.ndarray:
+    """Full-resolution pixels for the final crop, reusing the working copy when nothing was downscaled."""
+    image = Image.open(io.BytesIO(contents))
+    if image.size == (working_np.shape[1], working_np.shape[0]):
+        return working_np
+    return np.array(image.convert("RGB"))
+
+
+def scale_box(box, from_shape: Tuple[int, int], to_shape: Tuple[int, int]) -> list:
+    """Map an xyxy box between two image sizes given as (height, width)."""
+    sy, sx = to_shape[0] / from_shape[0], to_shape[1] / from_shape[1]
+    x1, y1, x2, y2 = (float(v) for v in box)
+    return [int(round(x1 * sx)), int(round(y1 * sy)), int(round(x2 * sx)), int(round(y2 * sy))]
+
+
+def crop_cutout(image_np: np.ndarray, mask: np.ndarray):
+    """
+    Crop the image to the mask's bounding box. The mask may be at a lower
+    (working) resolution than image_np; only the cropped region of it is
+    upsampled to match the full-resolution pixels. Returns the cropped pixels,
+    the cropped boolean mask and the crop box [x1, y1, x2, y2] in image_np
+    coordinates.
+    """
+    # find bounding box around mask
+    ys, xs = np.where(mask)
+    y1, y2 = ys.min(), ys.max()
+    x1, x2 = xs.min(), xs.max()
+    cropped_mask = mask[y1:y2, x1:x2]
+
+    if image_np.shape[:2] == mask.shape:
+        crop_box = [int(x1), int(y1), int(x2), int(y2)]
+        cropped_img = image_np[y1:y2, x1:x2]
+    else:
+        crop_box = scale_box((x1, y1, x2, y2), mask.shape, image_np.shape[:2])
+        fx1, fy1, fx2, fy2 = crop_box
+        cropped_img = image_np[fy1:fy2, fx1:fx2]
+        upsampled = cv2.resize(
+            cropped_mask.astype(np.uint8) * 255,
+            (cropped_img.shape[1], cropped_img.shape[0]),
+            interpolation=cv2.INTER_LINEAR,
+        )
+        cropped_mask = upsampled > 127
+
+    return cropped_img, cropped_mask, crop_box
+
+
+def to_bgra(cropped_img: np.ndarray, cropped_mask: np.ndarray) -> np.ndarray:
+    """Combine RGB pixels and a boolean mask into the BGRA layout OpenCV encodes."""
+    alpha = (cropped_mask.astype(np.uint8) * 255)
+    return cv2.cvtColor(np.dstack((cropped_img, alpha)), cv2.COLOR_RGBA2BGRA)
+
+
+def encode_png(bgra: np.ndarray, level: Optional[int] = None) -> bytes:
+    """PNG-encode; level 0-9 trades size for speed, None keeps OpenCV's default."""
+    params = [cv2.IMWRITE_PNG_COMPRESSION, level] if level is not None else []
+    ok, buffer = cv2.imencode(".png", bgra, params)
+    if not ok:
+        raise ValueError("Failed to encode PNG")
+    return buffer.tobytes()
+
+
+def encode_webp(bgra: np.ndarray, quality: int = 90) -> bytes:
+    """WebP-encode with alpha; quality above 100 selects lossless mode."""
+    ok, buffer = cv2.imencode(".webp", bgra, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    if not ok:
+        raise ValueError("Failed to encode WebP")
+    return buffer.tobytes()
+
+
+def encode_base64_png(bgra: np.ndarray, level: Optional[int] = None) -> str:
+    return base64.b64encode(encode_png(bgra, level)).decode("utf-8")
+
+
+def encode_rle(mask: np.ndarray) -> dict:
+    """
+    COCO-style uncompressed RLE: run lengths over the column-major flattened
+    mask, always starting with a (possibly empty) run of background pixels.
+    """
+    height, width = mask.shape
+    pixels = mask.ravel(order="F").astype(np.uint8)
+    changes = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [pixels.size])))
+    if pixels.size and pixels[0]:
+        runs = np.concatenate(([0], runs))
+    return {"size": [height, width], "counts": runs.tolist()}
@@ -0,0 +1,162 @@
+import io
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+    "image/heic": "heic",
+    "image/heif": "heif",
+}
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    """One upload, normalized for its two consumers."""
+    gemini_bytes: bytes   # downscaled, alpha flattened: what the model sees
+    gemini_mime: str
+    master_bytes: bytes   # what Storage keeps and the app downloads
+    master_mime: str
+    source_mime: str      # the real format of the upload
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.master_mime, "bin")
+
+
+def sniff_mime(image_bytes: bytes, fallback: str = "application/octet-stream") -> str:
+    """Identify the image format from its magic bytes rather than trusting the client."""
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    if image_bytes[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if image_bytes[4:8] == b"ftyp":
+        brand = image_bytes[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"hevx"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1"):
+            return "image/heif"
+    return fallback
+
+
+def _fit(image: Image.Image, max_side: int) -> Image.Image:
+    if not max_side or max(image.size) <= max_side:
+        return image
+    resized = image.copy()
+    resized.thumbnail((max_side, max_side), Image.LANCZOS)
+    return resized
+
+
+def _encode(image: Image.Image, fmt: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, **params)
+    return buffer.getvalue()
+
+
+def _encode_master(image: Image.Image, has_alpha: bool, master_format: str) -> Tuple[bytes, str]:
+    """
+    Cutouts keep their transparency losslessly, opaque photos are stored
+    lossy. "png" (the default) stays within PNG/JPEG, which every consumer
+    of image_url accepts, including the virtual try-on API; "webp" is
+    smaller still. PNG uses zlib's default level: level 9 is ~10x slower
+    for ~15% fewer bytes, and this runs on the request path.
+    """
+    if master_format == "webp":
+        if has_alpha:
+            return _encode(image, "WEBP", lossless=True, quality=80, method=4), "image/webp"
+        return _encode(image, "WEBP", quality=90, method=4), "image/webp"
+    if has_alpha:
+        return _encode(image, "PNG", compress_level=6), "image/png"
+    return _encode(image, "JPEG", quality=90, optimize=True), "image/jpeg"
+
+
+def prepare_image(
+    image_bytes: bytes,
+    declared_mime: Optional[str] = None,
+    gemini_max_side: int = 768,
+    master_max_side: int = 2048,
+    master_format: str = "png",
+) -> PreparedImage:
+    """
+    Detect the upload's real format, apply its EXIF orientation and produce
+    a Gemini copy capped at gemini_max_side (JPEG on white) plus a storage
+    master capped at master_max_side. Formats PIL can't decode (e.g. HEIC)
+    are passed through untouched under their detected MIME type, and so is
+    a transparent PNG that already fits and is upright when the master
+    would be PNG anyway, instead of being re-encoded.
+    """
+    source_mime = sniff_mime(image_bytes, declared_mime or "application/octet-stream")
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.draft("RGB", (master_max_side, master_max_side))
+        image.load()
+    except Exception:
+        return PreparedImage(image_bytes, source_mime, image_bytes, source_mime, source_mime)
+
+    upright = image.getexif().get(0x0112, 1) == 1
+    image = ImageOps.exif_transpose(image)
+    original = image_bytes if source_mime == "image/png" and upright else None
+    return prepare_pil_image(image, source_mime, gemini_max_side, master_max_side, master_format, original)
+
+
+def prepare_pil_image(
+    image: Image.Image,
+    source_mime: str = "image/png",
+    gemini_max_side: int = 768,
+    master_max_side: int = 2048,
+    master_format: str = "png",
+    original_png: Optional[bytes] = None,
+) -> PreparedImage:
+    """
+    prepare_image() for an image that is already decoded and upright, such
+    as a segmentation cutout handed over in memory, so each output is
+    encoded exactly once. original_png, the upload the image was decoded
+    from, is stored as the master as-is when it would only be re-encoded
+    to PNG at the same size.
+    """
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    master = _fit(image, master_max_side)
+    if original_png is not None and has_alpha and master_format != "webp" and master is image:
+        master_bytes, master_mime = original_png, "image/png"
+    else:
+        master_bytes, master_mime = _encode_master(master, has_alpha, master_format)
+
+    gemini = _fit(image, gemini_max_side)
+    if has_alpha:
+        background = Image.new("RGB", gemini.size, (255, 255, 255))
+        background.paste(gemini, mask=gemini.getchannel("A"))
+        gemini = background
+    gemini_bytes = _encode(gemini, "JPEG", quality=85)
+
+    return PreparedImage(gemini_bytes, "image/jpeg", master_bytes, master_mime, source_mime)
+
+
+def make_thumbnails(image_bytes: bytes, sizes: Iterable[int], quality: int = 80) -> Dict[int, bytes]:
+    """
+    WebP thumbnails of a stored master, keyed by their longest side. Each
+    size is downscaled from the previous larger one, so the master is only
+    decoded once; transparency is kept. Sizes at or above the image's own
+    are encoded at its original size.
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft("RGB", (sizes[0], sizes[0]))
+    image = ImageOps.exif_transpose(image)
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    thumbnails = {}
+    for size in sizes:
+        image = _fit(image, size)
+        thumbnails[size] = _encode(image, "WEBP", quality=quality, method=4)
+    return thumbnails
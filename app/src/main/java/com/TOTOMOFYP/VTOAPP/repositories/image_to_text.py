@@ -1,4 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Depends, Request, Response, BackgroundTasks, Query
+from fastapi.responses import JSONResponse
 from google import genai
 from google.genai import types
 from google.cloud import firestore, storage
@@ -9,8 +10,24 @@ import datetime
 from fastapi.encoders import jsonable_encoder
 import json
 import os
+import asyncio
+import functools
+import hashlib
+from typing import Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from google.oauth2 import service_account
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from stage_timing import StageTimings
+from service_metrics import instrument_app, observe_stages
+from smart_names import SmartNameCounters, base_name_for
+from analysis_cache import AnalysisCache, image_signature
+from image_prep import PreparedImage, make_thumbnails, prepare_image
+from jobs import InMemoryJobStore, JobRunner, add_job_routes, submit_job, wants_async
+from fake_backends import FakeBackends
+from uploads import UploadLimitMiddleware, read_upload
 
 load_dotenv() # Load environment variables from .env file
 
@@ -49,106 +66,12 @@ class ClothingItem(BaseModel):
 def generate_smart_item_name(user_id: str, item_occasion: str, item_category: str, item_style: str) -> str:
     """
     Generate smart names based on occasion like 'Casual 1', 'Formal 2', 'Business 3', etc.
-    based on existing items in the user's wardrobe
+    The number comes from the user's transactional name counter (see smart_names.py).
     """
     try:
-        # Map occasion text to proper display name
-        occasion_mapping = {
-            "casual": "Casual",
-            "formal": "Formal", 
-            "business": "Business",
-            "office": "Business",
-            "business / office": "Business",
-            "party": "Party",
-            "celebration": "Party",
-            "party / celebration": "Party",
-            "wedding": "Wedding",
-            "sports": "Sports",
-            "active": "Sports", 
-            "sports / active": "Sports",
-            "travel": "Travel",
-            "vacation": "Travel",
-            "travel / vacation": "Travel",
-            "loungewear": "Loungewear",
-            "home": "Loungewear",
-            "loungewear / home": "Loungewear",
-            "traditional": "Traditional",
-            "cultural": "Traditional",
-            "traditional / cultural": "Traditional",
-            "seasonal": "Seasonal",
-            "weather": "Seasonal",
-            "seasonal / weather-based": "Seasonal"
-        }
-        
-        # Determine base name from occasion first, then style, then category
-        occasion_lower = item_occasion.lower().strip()
-        style_lower = item_style.lower().strip()
-        
-        base_name = None
-        
-        # Try to match occasion first
-        for key, value in occasion_mapping.items():
-            if key in occasion_lower:
-                base_name = value
-                break
-        
-        # If no occasion match, try style
-        if not base_name and (style_lower and 
-            style_lower != "unknown" and 
-            style_lower != "test clothing item" and 
-            style_lower != "not specified" and
-            style_lower != ""):
-            
-            # Map common styles to occasions
-            if "casual" in style_lower:
-                base_name = "Casual"
-            elif "formal" in style_lower:
-                base_name = "Formal"
-            elif "business" in style_lower or "office" in style_lower:
-                base_name = "Business"
-            elif "party" in style_lower or "evening" in style_lower:
-                base_name = "Party"
-            elif "sport" in style_lower or "active" in style_lower:
-                base_name = "Sports"
-            else:
-                base_name = item_style.capitalize()
-        
-        # If no occasion or style match, use category as fallback
-        if not base_name:
-            if item_category.lower() == "top":
-                base_name = "Top"
-            elif item_category.lower() == "bottom":
-                base_name = "Bottom"
-            elif item_category.lower() == "full_body":
-                base_name = "Outfit"
-            else:
-                base_name = "Item"
-        
-        # Query existing items with the same base name pattern
-        user_items_ref = db.collection("users").document(user_id).collection("wardrobeItems")
-        existing_items = user_items_ref.get()
-        
-        # Count items with similar style/base name
-        count = 0
-        for item_doc in existing_items:
-            item_data = item_doc.to_dict()
-            existing_display_name = item_data.get("display_name", "")
-            
-            # Check if this item has the same base name
-            if existing_display_name.startswith(base_name + " "):
-                try:
-                    # Extract number from existing name like "Casual 3"
-                    number_part = existing_display_name.split(" ")[-1]
-                    if number_part.isdigit():
-                        item_number = int(number_part)
-                        count = max(count, item_number)
-                except:
-                    continue
-        
-        # Generate new name with next number
-        new_number = count + 1
-        smart_name = f"{base_name} {new_number}"
-        
+        base_name = base_name_for(item_occasion, item_category, item_style)
+        smart_name = name_counters.next_name(user_id, base_name)
+
         print(f"Generated smart name: '{smart_name}' for occasion='{item_occasion}', style='{item_style}', category='{item_category}'")
         return smart_name
         
@@ -157,212 +80,709 @@ def generate_smart_item_name(user_id: str, item_occasion: str, item_category: st
         # Fallback to simple naming
         return f"Item {datetime.datetime.now().strftime('%m%d%H%M')}"
 
+def generate_smart_item_names(user_id: str, analyses: List[dict]) -> List[str]:
+    """Smart names for a whole batch of analysed items, reserved in one counter transaction."""
+    try:
+        base_names = [
+            base_name_for(
+                analysis.get("occasion", ""), analysis.get("category", "other"), analysis.get("style", "")
+            )
+            for analysis in analyses
+        ]
+        smart_names = name_counters.next_names(user_id, base_names)
+        print(f"Generated {len(smart_names)} smart names: {smart_names}")
+        return smart_names
+
+    except Exception as e:
+        print(f"Error generating smart names: {e}")
+        # Fallback to simple naming
+        stamp = datetime.datetime.now().strftime('%m%d%H%M')
+        return [f"Item {stamp}-{idx + 1}" for idx in range(len(analyses))]
+
 # -----------------------------
 # Initialize FastAPI & Gemini
 # -----------------------------
-app = FastAPI(title="Clothing Metadata API")
-client = genai.Client()  # Gemini API client
-
-# Initialize Firebase with credentials
-try:
+# Clients are created by init_clients() during startup rather than at import,
+# so /healthz answers even when credentials are missing and /readyz reports why
+client = None  # Gemini API client
+db = None
+storage_client = None
+bucket = None
+name_counters = None
+client_status = {"state": "starting", "error": None}
+
+# Storage and Firestore clients are synchronous, so their calls run on this
+# bounded pool instead of the event loop; the Storage HTTP session keeps the
+# same number of pooled connections so every worker can reuse one
+IO_WORKERS = int(os.getenv("METADATA_IO_WORKERS", "16"))
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="metadata-io")
+
+
+async def run_io(fn, *args, **kwargs):
+    """Run a blocking Storage/Firestore call on the I/O pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(fn, *args, **kwargs))
+
+
+# METADATA_BACKEND=fake swaps Gemini, Firestore and Storage for the in-process
+# fakes in fake_backends.py (latency and error rates set by its FAKE_*
+# variables), for load tests without credentials
+METADATA_BACKEND = os.getenv("METADATA_BACKEND", "google")
+STORAGE_BUCKET = "vto-app-f7833.firebasestorage.app"
+fakes = None  # the FakeBackends in use, when METADATA_BACKEND=fake
+
+
+def google_clients():
+    """The real Gemini, Firestore and Storage clients, from the configured credentials."""
     # Path to your service account key file
     credentials_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-    
+
     if not credentials_path:
         print("❌ Error: GOOGLE_APPLICATION_CREDENTIALS not found in environment variables.")
         print("Please create a .env file and add GOOGLE_APPLICATION_CREDENTIALS='./path/to/your/firebase-adminsdk.json'")
-        exit(1)
-        
-    if os.path.exists(credentials_path):
-    
-    if os.path.exists(credentials_path):
-        # Load credentials from file
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        db = firestore.Client(credentials=credentials)
-        storage_client = storage.Client(credentials=credentials)
-        bucket = storage_client.bucket("vto-app-f7833.firebasestorage.app")
-        print("✅ Firebase credentials loaded successfully")
-    else:
+        raise RuntimeError("GOOGLE_APPLICATION_CREDENTIALS is not set")
+
+    if not os.path.exists(credentials_path):
         print(f"❌ Credentials file not found: {credentials_path}")
         print("Please download firebase-credentials.json from Firebase Console")
-        exit(1)
-except Exception as e:
-    print(f"❌ Firebase initialization failed: {e}")
-    exit(1)
+        raise RuntimeError(f"Credentials file not found: {credentials_path}")
+
+    gemini_client = genai.Client()  # its .aio interface is used so Gemini calls never block the event loop
+
+    # Load credentials from file
+    credentials = service_account.Credentials.from_service_account_file(credentials_path)
+    firestore_client = firestore.Client(credentials=credentials)
+    storage_session = AuthorizedSession(credentials.with_scopes(storage.Client.SCOPE))
+    storage_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=IO_WORKERS))
+    storage_client = storage.Client(credentials=credentials, _http=storage_session)
+    print("✅ Firebase credentials loaded successfully")
+    return gemini_client, firestore_client, storage_client, firestore.transactional
+
+
+def init_clients():
+    """Create the Gemini, Firestore and Storage clients for METADATA_BACKEND."""
+    global client, db, storage_client, bucket, name_counters, fakes
+
+    if METADATA_BACKEND == "fake":
+        fakes = FakeBackends.from_env()
+        client, db, storage_client, transactional = fakes.gemini, fakes.firestore, fakes.storage, fakes.transactional
+        print("⚠️  Using in-process fake Gemini, Firestore and Storage backends")
+    elif METADATA_BACKEND == "google":
+        client, db, storage_client, transactional = google_clients()
+    else:
+        raise RuntimeError(f"Unknown METADATA_BACKEND {METADATA_BACKEND!r} (use google or fake)")
+    bucket = storage_client.bucket(STORAGE_BUCKET)
+    name_counters = SmartNameCounters(db, transactional=transactional)
 
 
-@app.post("/categorize/{user_id}")
-async def categorize_clothing(user_id: str, file: UploadFile = File(...)):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     try:
-        # Read uploaded image
-        image_bytes = await file.read()
-
-        # Prompt Gemini to generate description + structured JSON
-        prompt = (
-            "Interpret this clothing item and provide:\n"
-            "1. A simple description.\n"
-            "2. Structured JSON with fields:\n"
-            "   - description (text)\n"
-            "   - category (enum: all, top, bottom, full_body)\n"
-            "   - color (text)\n"
-            "   - pattern (text)\n"
-            "   - style (text)\n"
-            "   - occasion (choose from: Casual, Formal, Business / Office, Party / Celebration, Wedding, Sports / Active, Travel / Vacation, Loungewear / Home, Traditional / Cultural, Seasonal / Weather-based)\n"
-            "\nFor occasion field, pick the most appropriate from the list above. If multiple apply, choose the primary one."
-        )
+        init_clients()
+        client_status["state"] = "ready"
+    except Exception as e:
+        print(f"❌ Firebase initialization failed: {e}")
+        client_status["state"] = "failed"
+        client_status["error"] = str(e)
+    yield
+    await job_runner.shutdown()
+    await asyncio.gather(*job_followups, return_exceptions=True)
+    io_executor.shutdown(wait=False)
+
+
+app = FastAPI(title="Clothing Metadata API", lifespan=lifespan)
+
+# Prometheus metrics on /metrics. Stage timings (Gemini, naming, Storage,
+# Firestore) are always recorded there; clients can also ask for them on a
+# single response by sending "X-Trace-Timing: 1", which adds a Server-Timing header.
+instrument_app(app, "metadata")
+TRACE_HEADER = "x-trace-timing"
+
+
+def finish_trace(request: Request, response: Response, timings: StageTimings, **descriptions):
+    """Record stage metrics and, if the client asked for it, add the Server-Timing header."""
+    observe_stages("metadata", timings)
+    if request.headers.get(TRACE_HEADER) == "1":
+        response.headers["Server-Timing"] = timings.server_timing(**descriptions)
+
+
+# Async mode (?async=true or "Prefer: respond-async"): /categorize answers
+# 202 with a job to poll on /jobs/{id}. At most METADATA_JOB_WORKERS jobs run
+# at once and METADATA_JOB_MAX_PENDING may be unfinished; finished jobs are
+# kept for METADATA_JOB_TTL_SECONDS
+job_runner = JobRunner(
+    InMemoryJobStore(
+        ttl_seconds=float(os.getenv("METADATA_JOB_TTL_SECONDS", "3600")),
+        max_jobs=int(os.getenv("METADATA_JOB_MAX_STORED", "1000")),
+    ),
+    max_workers=int(os.getenv("METADATA_JOB_WORKERS", "8")),
+    max_pending=int(os.getenv("METADATA_JOB_MAX_PENDING", "256")),
+)
+add_job_routes(app, job_runner)
+job_followups = set()  # jobs' background tasks (thumbnails), which finish after the job does
+
+
+def require_ready():
+    """Dependency that rejects requests with 503 until the clients are initialized."""
+    if client_status["state"] != "ready":
+        raise HTTPException(status_code=503, detail=f"Service is not ready ({client_status['state']})")
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving HTTP."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 only once Gemini, Firestore and Storage clients are initialized."""
+    status_code = 200 if client_status["state"] == "ready" else 503
+    return JSONResponse(content=client_status, status_code=status_code)
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return analysis_cache.stats()
+
+
+CATEGORIZE_PROMPT = (
+    "Interpret this clothing item and provide:\n"
+    "1. A simple description.\n"
+    "2. Structured JSON with fields:\n"
+    "   - description (text)\n"
+    "   - category (enum: all, top, bottom, full_body)\n"
+    "   - color (text)\n"
+    "   - pattern (text)\n"
+    "   - style (text)\n"
+    "   - occasion (choose from: Casual, Formal, Business / Office, Party / Celebration, Wedding, Sports / Active, Travel / Vacation, Loungewear / Home, Traditional / Cultural, Seasonal / Weather-based)\n"
+    "\nFor occasion field, pick the most appropriate from the list above. If multiple apply, choose the primary one."
+)
+
+OUTFIT_PROMPT = (
+    "Analyze this outfit image and provide structured JSON with:\n"
+    "1. description (short text)\n"
+    "2. occasion (choose one: Casual, Formal, Business / Office, Party / Celebration, "
+    "Wedding, Sports / Active, Travel / Vacation, Loungewear / Home, Traditional / Cultural, Seasonal)\n"
+    "3. color (main colors)\n"
+    "4. style (short style description)\n"
+)
+
+
+GEMINI_MODEL = "gemini-2.5-flash"
+
+# Gemini analyses are cached by perceptual hash plus a coarse colour
+# signature: an image of the same colour whose hash is within
+# GEMINI_CACHE_MAX_DISTANCE bits of one analysed in the last
+# GEMINI_CACHE_TTL_SECONDS reuses its result. GEMINI_CACHE_DB adds a sqlite
+# tier that survives restarts, holding at most GEMINI_CACHE_DB_MAX_ROWS
+# analyses; GEMINI_CACHE_MAX_ENTRIES=0 with no DB disables it.
+analysis_cache = AnalysisCache(
+    namespace=hashlib.sha256(f"{GEMINI_MODEL}\0{CATEGORIZE_PROMPT}".encode("utf-8")).hexdigest()[:16],
+    max_entries=int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "2048")),
+    ttl_seconds=float(os.getenv("GEMINI_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_distance=int(os.getenv("GEMINI_CACHE_MAX_DISTANCE", "4")),
+    db_path=os.getenv("GEMINI_CACHE_DB") or None,
+    db_max_rows=int(os.getenv("GEMINI_CACHE_DB_MAX_ROWS", "100000")),
+)
+
+
+def parse_gemini_json(gemini_response) -> dict:
+    # Parse Gemini output safely
+    try:
+        return json.loads(gemini_response.text)
+    except Exception:
+        return {"error": "Failed to parse Gemini output", "raw_text": gemini_response.text}
 
-        # Call Gemini with structured output
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type="image/png"
-                ),
-                prompt
-            ],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": ClothingItem,
-                "thinking_config": types.ThinkingConfig(thinking_budget=0)  # disables extra thinking
-            }
+
+# Uploads are normalized before use: Gemini gets a copy capped at
+# GEMINI_IMAGE_MAX_SIDE (its vision input is tiled at 768px), Storage keeps a
+# master capped at METADATA_MASTER_MAX_SIDE in METADATA_MASTER_FORMAT
+# ("png": lossless PNG for cutouts / JPEG for photos, or "webp")
+GEMINI_IMAGE_MAX_SIDE = int(os.getenv("GEMINI_IMAGE_MAX_SIDE", "768"))
+MASTER_MAX_SIDE = int(os.getenv("METADATA_MASTER_MAX_SIDE", "2048"))
+MASTER_FORMAT = os.getenv("METADATA_MASTER_FORMAT", "png")
+
+# Uploads over METADATA_MAX_UPLOAD_BYTES are refused with 413 before their
+# body is received (UploadLimitMiddleware below, batches allow that per image),
+# so neither a request nor a queued async job holds an arbitrarily large body
+MAX_UPLOAD_BYTES = int(os.getenv("METADATA_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+
+async def normalize_upload(image_bytes: bytes, declared_mime: str, timings: StageTimings) -> PreparedImage:
+    with timings.stage("normalize"):
+        return await run_io(
+            prepare_image, image_bytes, declared_mime, GEMINI_IMAGE_MAX_SIDE, MASTER_MAX_SIDE, MASTER_FORMAT
         )
 
-        # Parse Gemini output safely
+
+async def analyze_clothing(image_bytes: bytes, mime_type: str = "image/png") -> dict:
+    """Ask Gemini for the structured ClothingItem metadata of one garment image."""
+    gemini_response = await client.aio.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=[
+            types.Part.from_bytes(
+                data=image_bytes,
+                mime_type=mime_type
+            ),
+            CATEGORIZE_PROMPT
+        ],
+        config={
+            "response_mime_type": "application/json",
+            "response_schema": ClothingItem,
+            "thinking_config": types.ThinkingConfig(thinking_budget=0)  # disables extra thinking
+        }
+    )
+    return parse_gemini_json(gemini_response)
+
+
+async def analyze_clothing_cached(prepared: PreparedImage, timings: StageTimings):
+    """
+    analyze_clothing() behind the perceptual-hash cache. Returns the
+    metadata and whether it came from the cache; only parseable analyses
+    are cached.
+    """
+    with timings.stage("analysis_cache"):
         try:
-            structured_json = json.loads(response.text)
+            signature = await run_io(image_signature, prepared.gemini_bytes)
         except Exception:
-            structured_json = {"error": "Failed to parse Gemini output", "raw_text": response.text}
+            signature = None  # not decodable by PIL; let Gemini have a go
+        cached = await run_io(analysis_cache.get, *signature) if signature is not None else None
+    if cached is not None:
+        return cached, True
 
-        # Generate smart name based on AI analysis results
-        item_occasion = structured_json.get("occasion", "")
-        item_style = structured_json.get("style", "")
-        item_category = structured_json.get("category", "other")
-        smart_name = generate_smart_item_name(user_id, item_occasion, item_category, item_style)
+    with timings.stage("gemini"):
+        structured_json = await analyze_clothing(prepared.gemini_bytes, prepared.gemini_mime)
+    if signature is not None and "error" not in structured_json:
+        await run_io(analysis_cache.put, *signature, structured_json)
+    return structured_json, False
 
-        # Upload image to Firebase Storage - FIXED PATH
-        item_id = str(uuid.uuid4())
 
-        # Use PNG format to preserve transparency from segmentation
-        storage_path = f"users/{user_id}/wardrobe/{item_id}.png"
-        blob = bucket.blob(storage_path)
+async def upload_image(blob, prepared: PreparedImage, timings: StageTimings, require_public: bool = True):
+    """Upload the normalized master to Storage and make it public, off the event loop."""
+    try:
+        with timings.stage("upload"):
+            await run_io(blob.upload_from_string, prepared.master_bytes, content_type=prepared.master_mime)
+        print(f"✅ Successfully uploaded to Firebase Storage")
+    except Exception as upload_error:
+        print(f"❌ Upload failed: {upload_error}")
+        raise upload_error
 
-        # Upload with error handling
-        try:
-            blob.upload_from_string(image_bytes, content_type="image/png")
-            print(f"✅ Successfully uploaded to Firebase Storage")
-        except Exception as upload_error:
-            print(f"❌ Upload failed: {upload_error}")
-            raise upload_error
+    try:
+        with timings.stage("make_public"):
+            await run_io(blob.make_public)
+        print(f"✅ Successfully made blob public")
+    except Exception as public_error:
+        print(f"❌ Make public failed: {public_error}")
+        if require_public:
+            raise public_error
+        print(f"⚠️  Continuing with URL generation...")
+
+
+async def delete_blob(blob):
+    """Delete an uploaded image nothing will reference; failures only leave it orphaned."""
+    try:
+        await run_io(blob.delete)
+    except Exception as e:
+        print(f"⚠️  Could not delete orphaned {blob.name}: {e}")
 
-        # Make blob public and generate proper URL
+
+async def discard_upload(upload_task: asyncio.Task, blob):
+    """The request failed after its upload started: wait for it and delete the orphaned blob."""
+    try:
+        await upload_task
+    except Exception:
+        return
+    await delete_blob(blob)
+
+
+def public_url(blob) -> str:
+    blob_name = blob.name.replace("/", "%2F")  # URL encode the path
+    return f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/{blob_name}?alt=media"
+
+
+# WebP thumbnails for list views (longest side in px), made after the
+# response is sent; an empty METADATA_THUMBNAIL_SIZES turns them off
+THUMBNAIL_SIZES = [int(size) for size in os.getenv("METADATA_THUMBNAIL_SIZES", "128,256,512").split(",") if size.strip()]
+
+
+def thumbnail_path(storage_path: str, size: int) -> str:
+    """users/u/wardrobe/abc.png -> users/u/wardrobe/thumbnails/abc_256.webp"""
+    folder, _, filename = storage_path.rpartition("/")
+    return f"{folder}/thumbnails/{filename.rsplit('.', 1)[0]}_{size}.webp"
+
+
+async def store_thumbnails(doc_ref, storage_path: str, master_bytes: bytes):
+    """
+    Background task: upload a thumbnail per THUMBNAIL_SIZES next to the
+    stored master and record their URLs on its Firestore document as
+    thumbnail_urls ({"128": url, ...}). A failure only costs the
+    thumbnails, clients fall back to image_url.
+    """
+    if not THUMBNAIL_SIZES:
+        return
+    timings = StageTimings()
+    blobs = []
+
+    async def upload(size: int, data: bytes):
+        blob = bucket.blob(thumbnail_path(storage_path, size))
+        blobs.append(blob)
+        await run_io(blob.upload_from_string, data, content_type="image/webp")
         try:
-            blob.make_public()
-            print(f"✅ Successfully made blob public")
+            await run_io(blob.make_public)
         except Exception as public_error:
-            print(f"❌ Make public failed: {public_error}")
-            print(f"⚠️  Continuing with URL generation...")
-            
-        bucket_name = bucket.name
-        blob_name = blob.name.replace("/", "%2F")  # URL encode the path
-        image_url = f"https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/{blob_name}?alt=media"
-
-        print(f"=== IMAGE UPLOAD DEBUG ===")
-        print(f"User ID: {user_id}")
-        print(f"Item ID: {item_id}")
-        print(f"Storage path: {storage_path}")
-        print(f"Bucket name: {bucket_name}")
-        print(f"Blob name (encoded): {blob_name}")
-        print(f"Generated URL: {image_url}")
-        print(f"File name: {file.filename}")
-        print(f"Image bytes size: {len(image_bytes)}")
-        print("=========================")
-
-        # Save metadata + image URL to Firestore with error handling
-        try:
+            print(f"⚠️  Make public failed for {blob.name}: {public_error}")
+        return str(size), public_url(blob)
+
+    try:
+        with timings.stage("thumbnail_resize"):
+            thumbnails = await run_io(make_thumbnails, master_bytes, THUMBNAIL_SIZES)
+        with timings.stage("thumbnail_upload"):
+            uploaded = await asyncio.gather(
+                *(upload(size, data) for size, data in thumbnails.items()), return_exceptions=True
+            )
+        for outcome in uploaded:
+            if isinstance(outcome, Exception):
+                raise outcome
+        with timings.stage("thumbnail_firestore"):
+            await run_io(doc_ref.update, {"thumbnail_urls": dict(uploaded)})
+        print(f"✅ Stored {len(uploaded)} thumbnails for {storage_path}")
+    except Exception as e:
+        # Also covers the item being deleted before its thumbnails were ready
+        print(f"❌ Thumbnail generation failed for {storage_path}: {e}")
+        for blob in blobs:
+            try:
+                await run_io(blob.delete)
+            except Exception:
+                pass
+    finally:
+        observe_stages("metadata", timings)
+
+
+async def save_wardrobe_item(
+    user_id: str,
+    prepared: PreparedImage,
+    filename: str,
+    timings: StageTimings,
+    background_tasks: BackgroundTasks,
+    progress: Optional[Callable[..., None]] = None,
+):
+    """
+    Store one normalized garment image as a wardrobe item: upload it while
+    Gemini analyses it, reserve its smart name, write the wardrobeItems
+    document and queue its thumbnails. Returns the /categorize response body
+    and whether the analysis came from the cache. progress, if given, is
+    called as progress("analyzed", ...) and progress("stored", ...) as
+    those steps finish.
+    """
+    progress = progress or (lambda event, **fields: None)
+
+    # Upload image to Firebase Storage - FIXED PATH
+    item_id = str(uuid.uuid4())
+
+    # The extension follows the stored format (PNG keeps cutout transparency)
+    storage_path = f"users/{user_id}/wardrobe/{item_id}.{prepared.extension}"
+    blob = bucket.blob(storage_path)
+
+    # The upload doesn't depend on the analysis, so it runs while Gemini works
+    upload_task = asyncio.create_task(upload_image(blob, prepared, timings, require_public=False))
+
+    # Call Gemini with structured output (skipped for images analysed before)
+    try:
+        structured_json, cache_hit = await analyze_clothing_cached(prepared, timings)
+    except Exception:
+        await discard_upload(upload_task, blob)
+        raise
+
+    # Generate smart name based on AI analysis results
+    item_occasion = structured_json.get("occasion", "")
+    item_style = structured_json.get("style", "")
+    item_category = structured_json.get("category", "other")
+    with timings.stage("smart_name"):
+        smart_name = await run_io(generate_smart_item_name, user_id, item_occasion, item_category, item_style)
+    progress("analyzed", metadata=structured_json, display_name=smart_name, cache="hit" if cache_hit else "miss")
+
+    await upload_task
+    image_url = public_url(blob)
+
+    print(f"=== IMAGE UPLOAD DEBUG ===")
+    print(f"User ID: {user_id}")
+    print(f"Item ID: {item_id}")
+    print(f"Storage path: {storage_path}")
+    print(f"Bucket name: {bucket.name}")
+    print(f"Generated URL: {image_url}")
+    print(f"File name: {filename}")
+    print(f"Image: {prepared.source_mime} -> stored {len(prepared.master_bytes)} {prepared.master_mime}, Gemini {len(prepared.gemini_bytes)}")
+    print("=========================")
+
+    # Save metadata + image URL to Firestore with error handling
+    try:
+        doc_ref = db.collection("users").document(user_id).collection("wardrobeItems").document(item_id)
+        firestore_data = {
+            "image_name": filename,
+            "image_url": image_url,
+            "metadata": structured_json,
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "display_name": smart_name  # Generated smart name
+        }
+        with timings.stage("firestore"):
+            await run_io(doc_ref.set, jsonable_encoder(firestore_data))
+        print(f"✅ Successfully saved to Firestore")
+        print(f"Document path: users/{user_id}/wardrobeItems/{item_id}")
+    except Exception as firestore_error:
+        print(f"❌ Firestore save failed: {firestore_error}")
+        raise firestore_error
+    progress("stored", item_id=item_id, image_url=image_url)
+
+    background_tasks.add_task(store_thumbnails, doc_ref, storage_path, prepared.master_bytes)
+
+    return {
+        "message": "Clothing categorized and saved to Firebase",
+        "item_id": item_id,
+        "image_url": image_url,
+        "display_name": smart_name,
+        "metadata": structured_json,
+        "timestamp": datetime.datetime.utcnow().isoformat()
+    }, cache_hit
+
+
+async def categorize_job(user_id: str, image_bytes: bytes, declared_mime: str, filename: str) -> dict:
+    timings = StageTimings()
+    background_tasks = BackgroundTasks()
+    try:
+        prepared = await normalize_upload(image_bytes, declared_mime, timings)
+        item, _ = await save_wardrobe_item(user_id, prepared, filename, timings, background_tasks)
+    finally:
+        observe_stages("metadata", timings)
+    # Thumbnails follow the job like they follow a response, rather than holding up its result
+    followup = asyncio.create_task(background_tasks())
+    job_followups.add(followup)
+    followup.add_done_callback(job_followups.discard)
+    return item
+
+
+@app.post("/categorize/{user_id}", dependencies=[Depends(require_ready)])
+async def categorize_clothing(
+    user_id: str,
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    async_mode: bool = Query(False, alias="async")
+):
+    """
+    Categorize one garment image and save it as a wardrobe item. With
+    async=true (or "Prefer: respond-async") the response is 202 with a job
+    to poll on /jobs/{id}; resending the same Idempotency-Key header returns
+    the original job instead of analysing the image again.
+    """
+    if wants_async(request, async_mode):
+        image_bytes = await read_upload(file, MAX_UPLOAD_BYTES)
+        return submit_job(
+            job_runner, request, "categorize",
+            lambda: categorize_job(user_id, image_bytes, file.content_type, file.filename),
+            scope=user_id,
+        )
+
+    timings = StageTimings()
+    cache_status = "miss"
+    try:
+        # Read uploaded image
+        with timings.stage("read"):
+            image_bytes = await read_upload(file, MAX_UPLOAD_BYTES)
+        prepared = await normalize_upload(image_bytes, file.content_type, timings)
+
+        item, cache_hit = await save_wardrobe_item(user_id, prepared, file.filename, timings, background_tasks)
+        cache_status = "hit" if cache_hit else "miss"
+        return item
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        return {"error": str(e)}
+    finally:
+        finish_trace(request, response, timings, cache=cache_status)
+
+# Batch import limits: how many images one request may carry, how many
+# Gemini analyses run at once, and Firestore's cap on writes per batch
+MAX_BATCH_ITEMS = int(os.getenv("METADATA_MAX_BATCH_ITEMS", "100"))
+GEMINI_CONCURRENCY = int(os.getenv("METADATA_GEMINI_CONCURRENCY", "8"))
+FIRESTORE_BATCH_LIMIT = 500
+app.add_middleware(
+    UploadLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES,
+    path_limits={"/categorize_batch/": MAX_BATCH_ITEMS * MAX_UPLOAD_BYTES},
+)
+
+
+def commit_batch(writes: list):
+    batch = db.batch()
+    for _, doc_ref, data in writes:
+        batch.set(doc_ref, data)
+    batch.commit()
+
+
+@app.post("/categorize_batch/{user_id}", dependencies=[Depends(require_ready)])
+async def categorize_batch(
+    user_id: str,
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...)
+):
+    """
+    Import many garments at once. Gemini analyses run with at most
+    GEMINI_CONCURRENCY in flight while every image uploads in parallel on the
+    I/O pool; smart names for the whole batch are reserved in one counter
+    transaction and the metadata is committed with Firestore batched writes.
+    Each image gets its own entry in "results", with an "error" if it failed.
+    """
+    if len(files) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_ITEMS} images per batch")
+
+    timings = StageTimings()
+    try:
+        results = [{"filename": file.filename} for file in files]
+        semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+
+        async def process(file: UploadFile):
+            # Read per item, so an oversized or broken file only fails its own entry
+            item_timings = StageTimings()
+            with item_timings.stage("read"):
+                image_bytes = await read_upload(file, MAX_UPLOAD_BYTES)
+            prepared = await normalize_upload(image_bytes, file.content_type, item_timings)
+            del image_bytes  # only the normalized copies are kept until the batch commits
+            item_id = str(uuid.uuid4())
+            blob = bucket.blob(f"users/{user_id}/wardrobe/{item_id}.{prepared.extension}")
+            upload_task = asyncio.create_task(upload_image(blob, prepared, item_timings, require_public=False))
+            try:
+                async with semaphore:
+                    structured_json, _ = await analyze_clothing_cached(prepared, item_timings)
+            except Exception:
+                await discard_upload(upload_task, blob)
+                raise
+            await upload_task
+            observe_stages("metadata", item_timings)
+            return item_id, blob, prepared, structured_json
+
+        with timings.stage("analyze_upload"):
+            outcomes = await asyncio.gather(
+                *(process(file) for file in files),
+                return_exceptions=True,
+            )
+
+        succeeded = []
+        for idx, outcome in enumerate(outcomes):
+            if isinstance(outcome, HTTPException):
+                results[idx]["error"] = outcome.detail
+            elif isinstance(outcome, Exception):
+                results[idx]["error"] = str(outcome)
+            else:
+                succeeded.append((idx, *outcome))
+
+        # Generate smart names for the whole batch in one pass
+        with timings.stage("smart_name"):
+            smart_names = await run_io(generate_smart_item_names, user_id, [analysis for *_, analysis in succeeded])
+
+        timestamp = datetime.datetime.utcnow().isoformat()
+        writes = []
+        thumbnail_sources = {}
+        for (idx, item_id, blob, prepared, structured_json), smart_name in zip(succeeded, smart_names):
+            image_url = public_url(blob)
             doc_ref = db.collection("users").document(user_id).collection("wardrobeItems").document(item_id)
             firestore_data = {
-                "image_name": file.filename,
+                "image_name": files[idx].filename,
                 "image_url": image_url,
                 "metadata": structured_json,
-                "timestamp": datetime.datetime.utcnow().isoformat(),
+                "timestamp": timestamp,
                 "display_name": smart_name  # Generated smart name
             }
-            doc_ref.set(jsonable_encoder(firestore_data))
-            print(f"✅ Successfully saved to Firestore")
-            print(f"Document path: users/{user_id}/wardrobeItems/{item_id}")
-        except Exception as firestore_error:
-            print(f"❌ Firestore save failed: {firestore_error}")
-            raise firestore_error
+            writes.append((idx, doc_ref, jsonable_encoder(firestore_data)))
+            thumbnail_sources[idx] = (blob, prepared.master_bytes)
+            results[idx].update({
+                "item_id": item_id,
+                "image_url": image_url,
+                "display_name": smart_name,
+                "metadata": structured_json,
+            })
 
+        with timings.stage("firestore"):
+            for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+                chunk = writes[start:start + FIRESTORE_BATCH_LIMIT]
+                try:
+                    await run_io(commit_batch, chunk)
+                    print(f"✅ Saved {len(chunk)} wardrobe items to Firestore")
+                    for idx, doc_ref, _ in chunk:
+                        blob, master_bytes = thumbnail_sources[idx]
+                        background_tasks.add_task(store_thumbnails, doc_ref, blob.name, master_bytes)
+                except Exception as firestore_error:
+                    print(f"❌ Firestore batch save failed: {firestore_error}")
+                    # No document points at these images now
+                    await asyncio.gather(*(delete_blob(thumbnail_sources[idx][0]) for idx, _, _ in chunk))
+                    for idx, _, _ in chunk:
+                        results[idx] = {"filename": files[idx].filename, "error": f"Firestore save failed: {firestore_error}"}
+
+        saved = sum(1 for result in results if "error" not in result)
         return {
-            "message": "Clothing categorized and saved to Firebase",
-            "item_id": item_id,
-            "image_url": image_url,
-            "metadata": structured_json,
-            "timestamp": datetime.datetime.utcnow().isoformat()
+            "message": f"Categorized and saved {saved} of {len(files)} clothing items",
+            "results": results,
+            "timestamp": timestamp
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        finish_trace(request, response, timings)
 
-@app.post("/upload_outfit/{user_id}")
+
+@app.post("/upload_outfit/{user_id}", dependencies=[Depends(require_ready)])
 async def upload_outfit(
     user_id: str,
+    request: Request,
+    response: Response,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     outfit_name: str = Form(...)  # User provides outfit name
 ):
+    timings = StageTimings()
     try:
         # Read uploaded image
-        image_bytes = await file.read()
-
-        # Prompt Gemini to generate outfit occasion + metadata
-        prompt = (
-            "Analyze this outfit image and provide structured JSON with:\n"
-            "1. description (short text)\n"
-            "2. occasion (choose one: Casual, Formal, Business / Office, Party / Celebration, "
-            "Wedding, Sports / Active, Travel / Vacation, Loungewear / Home, Traditional / Cultural, Seasonal)\n"
-            "3. color (main colors)\n"
-            "4. style (short style description)\n"
-        )
-
-        # Call Gemini for structured metadata
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                types.Part.from_bytes(data=image_bytes, mime_type="image/png"),
-                prompt
-            ],
-            config={
-                "response_mime_type": "application/json"
-            }
-        )
-
-        # Parse Gemini response safely
-        try:
-            structured_json = json.loads(response.text)
-        except Exception:
-            structured_json = {"error": "Failed to parse Gemini output", "raw_text": response.text}
+        with timings.stage("read"):
+            image_bytes = await read_upload(file, MAX_UPLOAD_BYTES)
+        prepared = await normalize_upload(image_bytes, file.content_type, timings)
 
         # Generate unique ID for outfit
         item_id = str(uuid.uuid4())
 
         # Firebase Storage path (outfits)
-        storage_path = f"users/{user_id}/outfits/{item_id}.png"
+        storage_path = f"users/{user_id}/outfits/{item_id}.{prepared.extension}"
         blob = bucket.blob(storage_path)
 
+        # Upload while Gemini analyses the outfit
+        upload_task = asyncio.create_task(upload_image(blob, prepared, timings))
+
+        # Call Gemini for structured metadata
         try:
-            blob.upload_from_string(image_bytes, content_type="image/png")
-            blob.make_public()
-            print(f"✅ Uploaded outfit image to Storage")
-        except Exception as e:
-            print(f"❌ Upload failed: {e}")
-            raise e
-
-        # Generate public URL
-        bucket_name = bucket.name
-        blob_name = blob.name.replace("/", "%2F")
-        image_url = f"https://firebasestorage.googleapis.com/v0/b/{bucket_name}/o/{blob_name}?alt=media"
+            with timings.stage("gemini"):
+                gemini_response = await client.aio.models.generate_content(
+                    model=GEMINI_MODEL,
+                    contents=[
+                        types.Part.from_bytes(data=prepared.gemini_bytes, mime_type=prepared.gemini_mime),
+                        OUTFIT_PROMPT
+                    ],
+                    config={
+                        "response_mime_type": "application/json"
+                    }
+                )
+        except Exception:
+            await discard_upload(upload_task, blob)
+            raise
+        structured_json = parse_gemini_json(gemini_response)
+
+        await upload_task
+        image_url = public_url(blob)
 
         # Firestore path (outfits)
         try:
@@ -373,12 +793,15 @@ async def upload_outfit(
                 "metadata": structured_json,
                 "timestamp": datetime.datetime.utcnow().isoformat()
             }
-            doc_ref.set(jsonable_encoder(firestore_data))
+            with timings.stage("firestore"):
+                await run_io(doc_ref.set, jsonable_encoder(firestore_data))
             print(f"✅ Saved outfit metadata to Firestore")
         except Exception as firestore_error:
             print(f"❌ Firestore save failed: {firestore_error}")
             raise firestore_error
 
+        background_tasks.add_task(store_thumbnails, doc_ref, storage_path, prepared.master_bytes)
+
         return {
             "message": "Outfit uploaded and saved successfully",
             "item_id": item_id,
@@ -387,8 +810,13 @@ async def upload_outfit(
             "metadata": structured_json
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         return {"error": str(e)}
+    finally:
+        finish_trace(request, response, timings)
+
 # -----------------------------
 # Run locally
 # -----------------------------
@@ -0,0 +1,296 @@
+"""
+Inference backend selection for the segmentation server.
+
+SEGMENT_BACKEND chooses how the SAM2 image encoder (the dominant per-image
+cost) is executed:
+
+* torch        - the original PyTorch modules (default)
+* torchscript  - a traced encoder exported with `python inference_backend.py export`
+* onnx         - the same encoder exported to ONNX and run with ONNX Runtime
+
+GroundingDINO and the SAM2 prompt decoder always run in PyTorch. On CPU,
+SEGMENT_QUANTIZE=int8 applies dynamic int8 quantization to their Linear
+layers (and, for the torch backend, to the SAM2 encoder too); ONNX exports
+are quantized at export time with --quantize int8. SEGMENT_NUM_THREADS caps
+the intra-op threads used by both PyTorch and ONNX Runtime.
+"""
+import argparse
+import contextlib
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from sam2.build_sam import build_sam2
+from sam2.sam2_image_predictor import SAM2ImagePredictor
+
+BACKENDS = ("torch", "torchscript", "onnx")
+BACKEND = os.getenv("SEGMENT_BACKEND", "torch")
+QUANTIZE = os.getenv("SEGMENT_QUANTIZE", "")
+NUM_THREADS = int(os.getenv("SEGMENT_NUM_THREADS", "0"))
+EXPORT_DIR = os.getenv("SEGMENT_EXPORT_DIR", "exported")
+
+SAM2_CHECKPOINT = os.getenv("SAM2_CHECKPOINT", "checkpoints/sam2.1_hiera_tiny.pt")
+SAM2_CONFIG = os.getenv("SAM2_CONFIG", "configs/sam2.1/sam2.1_hiera_t.yaml")
+
+ENCODER_FILES = {"torchscript": "sam2_image_encoder.pt", "onnx": "sam2_image_encoder.onnx"}
+
+
+def configure_device() -> torch.device:
+    """Pick CUDA when present, otherwise CPU, and apply the matching global torch settings."""
+    if NUM_THREADS > 0:
+        torch.set_num_threads(NUM_THREADS)
+
+    if torch.cuda.is_available():
+        if torch.cuda.get_device_properties(0).major >= 8:
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+        return torch.device("cuda")
+    return torch.device("cpu")
+
+
+def inference_context(device: torch.device):
+    """
+    Context for running the models on the current thread: bfloat16 autocast
+    on CUDA, plain fp32 on CPU. autocast and no_grad are thread-local, so
+    enter this on whichever thread runs the models.
+    """
+    stack = contextlib.ExitStack()
+    if device.type == "cuda":
+        stack.enter_context(torch.autocast(device_type="cuda", dtype=torch.bfloat16))
+    stack.enter_context(torch.no_grad())
+    return stack
+
+
+def maybe_quantize(model: torch.nn.Module, device: torch.device) -> torch.nn.Module:
+    """Apply dynamic int8 quantization to Linear layers when requested and running on CPU."""
+    if QUANTIZE != "int8":
+        return model
+    if device.type != "cpu":
+        print("⚠️  SEGMENT_QUANTIZE=int8 only applies on CPU, ignoring it")
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+# -----------------------------
+# SAM2 image encoder export
+# -----------------------------
+class SAM2ImageEncoder(torch.nn.Module):
+    """
+    SAM2's image encoder plus the feature preparation done in
+    SAM2ImagePredictor.set_image_batch, as a single module with tensor outputs
+    (image_embed, high_res_feat_0, high_res_feat_1) suitable for export.
+    """
+
+    def __init__(self, sam2_model):
+        super().__init__()
+        self.model = sam2_model
+        self.bb_feat_sizes = SAM2ImagePredictor(sam2_model)._bb_feat_sizes
+
+    def forward(self, img_batch: torch.Tensor):
+        batch_size = img_batch.shape[0]
+        backbone_out = self.model.forward_image(img_batch)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+        feats = [
+            feat.permute(1, 2, 0).reshape(batch_size, -1, *feat_size)
+            for feat, feat_size in zip(vision_feats[::-1], self.bb_feat_sizes[::-1])
+        ][::-1]
+        return feats[-1], feats[0], feats[1]
+
+
+class TorchScriptImageEncoder:
+    def __init__(self, path: str, device: torch.device):
+        self.module = torch.jit.load(path, map_location=device).eval()
+
+    def __call__(self, img_batch: torch.Tensor):
+        # The trace is specialised to batch size 1, so run images one by one
+        outputs = [self.module(img_batch[i:i + 1]) for i in range(img_batch.shape[0])]
+        return [torch.cat(level) for level in zip(*outputs)]
+
+
+class OnnxImageEncoder:
+    def __init__(self, path: str, device: torch.device):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if NUM_THREADS > 0:
+            options.intra_op_num_threads = NUM_THREADS
+        providers = ["CPUExecutionProvider"]
+        if device.type == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = device
+
+    def __call__(self, img_batch: torch.Tensor):
+        outputs = self.session.run(None, {self.input_name: img_batch.cpu().numpy().astype(np.float32)})
+        return [torch.from_numpy(output).to(self.device) for output in outputs]
+
+
+class ExportedEncoderPredictor(SAM2ImagePredictor):
+    """SAM2ImagePredictor whose image embeddings come from an exported encoder."""
+
+    def __init__(self, sam_model, encoder, **kwargs):
+        super().__init__(sam_model, **kwargs)
+        self.encoder = encoder
+
+    @torch.no_grad()
+    def set_image_batch(self, image_list):
+        self.reset_predictor()
+        self._orig_hw = [image.shape[:2] for image in image_list]
+        img_batch = self._transforms.forward_batch(image_list).to(self.device)
+        image_embed, *high_res_feats = self.encoder(img_batch)
+        self._features = {"image_embed": image_embed, "high_res_feats": high_res_feats}
+        self._is_image_set = True
+        self._is_batch = True
+
+
+def load_image_encoder(backend: str, device: torch.device, export_dir: str = EXPORT_DIR):
+    path = os.path.join(export_dir, ENCODER_FILES[backend])
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f"{path} not found; run `python inference_backend.py export --format {backend}` first"
+        )
+    if backend == "onnx":
+        return OnnxImageEncoder(path, device)
+    return TorchScriptImageEncoder(path, device)
+
+
+def create_predictor_factory(
+    sam2_model, device: torch.device, backend: str = BACKEND, export_dir: str = EXPORT_DIR
+):
+    """Return a zero-argument callable producing a fresh SAM2 predictor for the chosen backend."""
+    if backend not in BACKENDS:
+        raise ValueError(f"SEGMENT_BACKEND must be one of {', '.join(BACKENDS)}, got {backend!r}")
+    if backend == "torch":
+        return lambda: SAM2ImagePredictor(sam2_model)
+    encoder = load_image_encoder(backend, device, export_dir)
+    print(f"✅ Loaded {backend} SAM2 image encoder")
+    return lambda: ExportedEncoderPredictor(sam2_model, encoder)
+
+
+def export_image_encoder(sam2_model, fmt: str, export_dir: str, quantize: str = ""):
+    encoder = SAM2ImageEncoder(sam2_model).eval()
+    image_size = sam2_model.image_size
+    example = torch.randn(1, 3, image_size, image_size)
+    os.makedirs(export_dir, exist_ok=True)
+    path = os.path.join(export_dir, ENCODER_FILES[fmt])
+
+    with torch.no_grad():
+        if fmt == "torchscript":
+            if quantize == "int8":
+                encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+            torch.jit.trace(encoder, example, check_trace=False).save(path)
+        else:
+            torch.onnx.export(
+                encoder,
+                (example,),
+                path,
+                input_names=["image"],
+                output_names=["image_embed", "high_res_feat_0", "high_res_feat_1"],
+                dynamic_axes={name: {0: "batch"} for name in ("image", "image_embed", "high_res_feat_0", "high_res_feat_1")},
+                opset_version=17,
+                dynamo=False,
+            )
+            if quantize == "int8":
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+
+                float_path = path.replace(".onnx", ".fp32.onnx")
+                os.replace(path, float_path)
+                quantize_dynamic(float_path, path, weight_type=QuantType.QInt8)
+    print(f"✅ Exported SAM2 image encoder to {path}")
+    return path
+
+
+# -----------------------------
+# Parity check
+# -----------------------------
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def check_parity(sam2_model, backend: str, device: torch.device, export_dir: str, images, min_iou: float) -> bool:
+    """
+    Segment each image with the PyTorch predictor and with the exported
+    encoder, prompting both with the same boxes, and compare the masks.
+    """
+    reference = SAM2ImagePredictor(sam2_model)
+    candidate = create_predictor_factory(sam2_model, device, backend, export_dir)()
+
+    ious = []
+    for name, image in images:
+        height, width = image.shape[:2]
+        # A centred box plus the left and right halves stand in for garment detections
+        boxes = np.array([
+            [width * 0.2, height * 0.2, width * 0.8, height * 0.8],
+            [0, 0, width * 0.5, height],
+            [width * 0.5, 0, width, height],
+        ])
+        timings = []
+        masks = []
+        for predictor in (reference, candidate):
+            start = time.perf_counter()
+            with inference_context(device):
+                predictor.set_image_batch([image])
+                batch_masks, _, _ = predictor.predict_batch(box_batch=[boxes], multimask_output=False)
+            timings.append((time.perf_counter() - start) * 1000.0)
+            masks.append(batch_masks[0].reshape(-1, height, width).astype(bool))
+        image_ious = [mask_iou(a, b) for a, b in zip(*masks)]
+        ious.extend(image_ious)
+        print(f"{name}: IoU min={min(image_ious):.4f} torch={timings[0]:.0f}ms {backend}={timings[1]:.0f}ms")
+
+    worst = min(ious) if ious else 1.0
+    print(f"Mean IoU {np.mean(ious):.4f}, worst {worst:.4f} (threshold {min_iou})")
+    return worst >= min_iou
+
+
+def load_parity_images(paths):
+    from PIL import Image
+
+    if not paths:
+        rng = np.random.default_rng(0)
+        # Smooth synthetic images give the encoder some structure to work with
+        base = rng.integers(0, 255, size=(12, 16, 3), dtype=np.uint8)
+        image = np.array(Image.fromarray(base).resize((640, 480), Image.BICUBIC))
+        return [("synthetic", image)]
+    return [(path, np.array(Image.open(path).convert("RGB"))) for path in paths]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export and verify SAM2 inference backends")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export", help="export the SAM2 image encoder")
+    export_parser.add_argument("--format", choices=("onnx", "torchscript"), default="onnx")
+    export_parser.add_argument("--quantize", choices=("", "int8"), default="")
+
+    parity_parser = subparsers.add_parser("parity", help="compare exported masks against PyTorch")
+    parity_parser.add_argument("--backend", choices=("onnx", "torchscript"), default="onnx")
+    parity_parser.add_argument("--min-iou", type=float, default=0.9)
+    parity_parser.add_argument("images", nargs="*", help="sample images (defaults to a synthetic one)")
+
+    for sub in (export_parser, parity_parser):
+        sub.add_argument("--export-dir", default=EXPORT_DIR)
+        sub.add_argument("--checkpoint", default=SAM2_CHECKPOINT)
+        sub.add_argument("--config", default=SAM2_CONFIG)
+
+    args = parser.parse_args(argv)
+    device = torch.device("cpu")
+    sam2_model = build_sam2(args.config, args.checkpoint, device=device, apply_postprocessing=False).eval()
+
+    if args.command == "export":
+        export_image_encoder(sam2_model, args.format, args.export_dir, args.quantize)
+        return 0
+
+    images = load_parity_images(args.images)
+    ok = check_parity(sam2_model, args.backend, device, args.export_dir, images, args.min_iou)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
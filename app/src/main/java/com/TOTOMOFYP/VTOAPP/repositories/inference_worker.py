@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+
+class QueueFullError(Exception):
+    """Raised by InferenceScheduler.submit when the pending queue has no room."""
+
+
+class InferenceScheduler:
+    """
+    Runs model inference on a dedicated worker thread so request handlers never
+    block the event loop.
+
+    Handlers call submit()/submit_many() and await the returned futures. The
+    worker collects pending items into micro-batches: it takes the first waiting
+    item, then keeps collecting for up to max_wait_ms or until max_batch_size
+    items are gathered, and hands the whole batch to process_batch. The queue
+    is bounded; once max_queue_size items are waiting, new work is rejected
+    with QueueFullError so the caller can answer 429.
+
+    With num_workers > 1, that many threads pull batches from the same queue,
+    which is how requests are spread over a pool of model processes: each
+    thread blocks on one process at a time, so batches go to whichever
+    process is free next.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        max_queue_size: int = 64,
+        name: str = "inference-worker",
+        num_workers: int = 1,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_queue_size = max(1, max_queue_size)
+        self.name = name
+        self.num_workers = max(1, num_workers)
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopped = False
+        for idx in range(self.num_workers):
+            name = self.name if self.num_workers == 1 else f"{self.name}-{idx}"
+            thread = threading.Thread(target=self._run, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = None):
+        """Stop accepting work, let the workers drain what is queued, then join them."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def submit(self, item: Any) -> Future:
+        return self.submit_many([item])[0]
+
+    def submit_many(self, items: List[Any]) -> List[Future]:
+        """Enqueue all items or none of them; raises QueueFullError if they don't fit."""
+        futures = [Future() for _ in items]
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f"{self.name} is not running")
+            if len(self._pending) + len(items) > self.max_queue_size:
+                raise QueueFullError(
+                    f"{self.name} queue is full ({len(self._pending)}/{self.max_queue_size} pending)"
+                )
+            self._pending.extend(zip(items, futures))
+            self._cond.notify()
+        return futures
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending and not self._stopped:
+                self._cond.wait()
+            if not self._pending:
+                return None
+
+            # Give concurrent requests a short window to join this batch
+            deadline = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size and not self._stopped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            size = min(len(self._pending), self.max_batch_size)
+            return [self._pending.popleft() for _ in range(size)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            # Skip work whose caller has already gone away
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                results = self.process_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
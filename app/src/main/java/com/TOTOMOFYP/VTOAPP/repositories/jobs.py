@@ -0,0 +1,240 @@
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED_STATES = (SUCCEEDED, FAILED)
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+MAX_WAIT_SECONDS = 60.0
+
+
+class JobQueueFullError(Exception):
+    """Raised by JobRunner.submit when max_pending jobs are already waiting or running."""
+
+
+class JobStore(ABC):
+    """
+    Where job records live. A record is a JSON-serializable dict with id,
+    kind, state, created_at, updated_at and, once finished, result or error.
+    The default InMemoryJobStore only serves one process; a shared store
+    (Redis, Firestore, ...) implements these three methods, with create()
+    atomic per idempotency key.
+    """
+
+    @abstractmethod
+    def create(self, job: dict, idempotency_key: Optional[str] = None) -> Tuple[dict, bool]:
+        """
+        Store job unless idempotency_key already belongs to a job that has
+        not failed. Returns the job that owns the key and whether it is the
+        new one.
+        """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]:
+        """The job record, or None if it is unknown or has expired."""
+
+    @abstractmethod
+    def update(self, job_id: str, **fields) -> Optional[dict]:
+        """Merge fields into the job record and return it, or None if it is gone."""
+
+
+class InMemoryJobStore(JobStore):
+    """
+    Jobs in a dict. Finished jobs are dropped ttl_seconds after they finish,
+    and the oldest finished ones are dropped early once more than max_jobs
+    are held; queued and running jobs are never evicted.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, max_jobs: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max(1, max_jobs)
+        self._jobs = OrderedDict()  # job id -> record, oldest first
+        self._keys = {}  # idempotency key -> job id
+        self._lock = threading.Lock()
+
+    def create(self, job: dict, idempotency_key: Optional[str] = None) -> Tuple[dict, bool]:
+        with self._lock:
+            self._purge(time.time())
+            if idempotency_key is not None:
+                existing = self._jobs.get(self._keys.get(idempotency_key))
+                if existing is not None and existing["state"] != FAILED:
+                    return dict(existing), False
+                self._keys[idempotency_key] = job["id"]
+            self._jobs[job["id"]] = dict(job, idempotency_key=idempotency_key)
+            return dict(job), True
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id: str, **fields) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job.update(fields, updated_at=time.time())
+            return dict(job)
+
+    def _purge(self, now: float):
+        # Caller holds _lock
+        finished = [job for job in self._jobs.values() if job["state"] in FINISHED_STATES]
+        excess = len(self._jobs) - self.max_jobs + 1
+        for idx, job in enumerate(finished):
+            if idx >= excess and now - job["updated_at"] < self.ttl_seconds:
+                continue
+            del self._jobs[job["id"]]
+            if self._keys.get(job["idempotency_key"]) == job["id"]:
+                del self._keys[job["idempotency_key"]]
+
+
+def public_view(job: dict) -> dict:
+    return {k: v for k, v in job.items() if k != "idempotency_key"}
+
+
+class JobRunner:
+    """
+    Runs submitted coroutines as background jobs on the event loop, at most
+    max_workers at a time, recording their state and result in store.
+    A submission carrying an idempotency key that is already in use returns
+    the existing job instead of starting new work; only failed jobs can be
+    resubmitted under the same key. New jobs beyond max_pending unfinished
+    ones are rejected with JobQueueFullError.
+    """
+
+    def __init__(self, store: JobStore, max_workers: int = 4, max_pending: int = 256):
+        self.store = store
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max(1, max_pending)
+        self._semaphore = None
+        self._tasks = set()
+        self._finished = {}  # job id -> asyncio.Event, for long polls
+
+    def submit(
+        self, kind: str, work: Callable[[], Awaitable[dict]], idempotency_key: Optional[str] = None
+    ) -> Tuple[dict, bool]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        # Resolve the idempotency key first so a retry of an accepted job gets
+        # it back even when the queue is full; a new job turned away is marked
+        # failed, which frees its key for the next attempt
+        now = time.time()
+        job = {"id": uuid.uuid4().hex, "kind": kind, "state": QUEUED, "created_at": now, "updated_at": now}
+        job, created = self.store.create(job, idempotency_key)
+        if not created:
+            return public_view(job), False
+        if len(self._tasks) >= self.max_pending:
+            error = f"{len(self._tasks)} jobs are already pending"
+            self.store.update(job["id"], state=FAILED, error=error, status_code=429)
+            raise JobQueueFullError(error)
+
+        self._finished[job["id"]] = asyncio.Event()
+        task = asyncio.create_task(self._run(job["id"], work))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return public_view(job), True
+
+    async def _run(self, job_id: str, work: Callable[[], Awaitable[dict]]):
+        try:
+            async with self._semaphore:
+                self.store.update(job_id, state=RUNNING)
+                try:
+                    result = await work()
+                    self.store.update(job_id, state=SUCCEEDED, result=result)
+                except HTTPException as e:
+                    self.store.update(job_id, state=FAILED, error=e.detail, status_code=e.status_code)
+                except Exception as e:
+                    self.store.update(job_id, state=FAILED, error=str(e))
+        finally:
+            event = self._finished.pop(job_id, None)
+            if event is not None:
+                event.set()
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        """The job once it has finished, or as it stands after timeout seconds."""
+        event = self._finished.get(job_id)
+        if event is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        job = self.store.get(job_id)
+        return public_view(job) if job is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        return {"pending": len(self._tasks), "max_pending": self.max_pending, "max_workers": self.max_workers}
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def wants_async(request: Request, async_mode: bool) -> bool:
+    """Async mode is opted into with ?async=true or "Prefer: respond-async"."""
+    return async_mode or "respond-async" in request.headers.get("prefer", "").lower()
+
+
+def submit_job(
+    runner: JobRunner,
+    request: Request,
+    kind: str,
+    work: Callable[[], Awaitable[dict]],
+    scope: str = "",
+    retry_after: int = 2,
+) -> JSONResponse:
+    """
+    Queue work for request and answer 202 with the job and where to poll it.
+    The client's Idempotency-Key header (namespaced by kind and scope, e.g.
+    a user id) makes retried submissions return the original job.
+    """
+    client_key = request.headers.get(IDEMPOTENCY_HEADER)
+    idempotency_key = f"{kind}:{scope}:{client_key}" if client_key else None
+    try:
+        job, created = runner.submit(kind, work, idempotency_key)
+    except JobQueueFullError:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many pending jobs, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        )
+    status_url = str(request.app.url_path_for("get_job", job_id=job["id"]))
+    if created:
+        print(f"✅ Queued {kind} job {job['id']}")
+    return JSONResponse(
+        content=dict(job, status_url=status_url),
+        status_code=202,
+        headers={"Location": status_url, "Retry-After": str(retry_after)},
+    )
+
+
+def add_job_routes(app: FastAPI, runner: JobRunner, retry_after: int = 2):
+    """
+    Serve GET /jobs/{job_id} on app. ?wait=N long-polls: the response is
+    held for up to N seconds (capped at MAX_WAIT_SECONDS) until the job
+    finishes.
+    """
+
+    @app.get("/jobs/{job_id}", name="get_job")
+    async def get_job(job_id: str, wait: float = 0):
+        job = await runner.wait(job_id, min(max(wait, 0.0), MAX_WAIT_SECONDS))
+        if job is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired job")
+        headers = {} if job["state"] in FINISHED_STATES else {"Retry-After": str(retry_after)}
+        return JSONResponse(content=job, headers=headers)
+
+    @app.get("/jobs", include_in_schema=False)
+    async def job_stats():
+        return runner.stats()
@@ -0,0 +1,199 @@
+"""
+Multi-process model serving for the segmentation server.
+
+The parent process loads the model weights once and then forks
+SEGMENT_MODEL_WORKERS children. Forked children share the parent's weight
+pages copy-on-write, and inference never writes to them, so each extra
+worker costs its activations and caches rather than another copy of
+GroundingDINO and SAM2. gc.freeze() before forking keeps the garbage
+collector from touching (and so copying) the parent's object pages.
+
+Each child runs a simple request/reply loop over a pipe. ModelProcessPool's
+process_batch() hands a batch to whichever child is idle, so an
+InferenceScheduler with one thread per child balances load across the pool.
+Fork is only safe for CPU inference; CUDA contexts cannot be shared with
+forked children.
+"""
+import gc
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from typing import Any, Callable, List, Optional
+
+import torch
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised when a model worker process exits in the middle of a batch."""
+
+
+def _worker_main(conn, process_batch, initializer, num_threads: int):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    try:
+        if initializer is not None:
+            initializer()
+    except Exception as e:
+        traceback.print_exc()
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", os.getpid()))
+
+    while True:
+        try:
+            jobs = conn.recv()
+        except EOFError:
+            return
+        if jobs is None:
+            return
+        try:
+            conn.send(("ok", process_batch(jobs)))
+        except Exception as e:
+            traceback.print_exc()
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.batches = 0
+        self.dead = False  # could not be restarted; its slot is gone
+
+
+class ModelProcessPool:
+    """
+    A fixed pool of forked model worker processes. process_batch() blocks
+    the calling thread until an idle worker has processed the batch; a worker
+    that dies is replaced with a fresh fork and the batch fails with
+    WorkerCrashedError. If respawn_attempts forks in a row fail too, the
+    slot is marked dead (see stats()), and once every slot is dead
+    process_batch() fails immediately instead of waiting for a worker.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        num_workers: int,
+        initializer: Optional[Callable[[], None]] = None,
+        threads_per_worker: int = 0,
+        name: str = "model-worker",
+        start_timeout: float = 600.0,
+        respawn_attempts: int = 2,
+    ):
+        self.process_batch_fn = process_batch
+        self.num_workers = max(1, num_workers)
+        self.initializer = initializer
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.name = name
+        self.start_timeout = start_timeout
+        self.respawn_attempts = max(1, respawn_attempts)
+
+        self._ctx = multiprocessing.get_context("fork")
+        self._workers = []
+        self._idle = queue.Queue()
+        self._fork_lock = threading.Lock()
+        self._slots_lock = threading.Lock()
+
+    def start(self):
+        """Fork every worker and wait until each one has run its initializer."""
+        gc.collect()
+        gc.freeze()
+        for index in range(self.num_workers):
+            worker = self._spawn(index)
+            self._workers.append(worker)
+            self._idle.put(worker)
+        print(
+            f"✅ Started {self.num_workers} {self.name} processes "
+            f"({self.threads_per_worker} threads each): {[w.process.pid for w in self._workers]}"
+        )
+
+    def _spawn(self, index: int) -> _Worker:
+        with self._fork_lock:
+            parent_conn, child_conn = self._ctx.Pipe()
+            process = self._ctx.Process(
+                target=_worker_main,
+                args=(child_conn, self.process_batch_fn, self.initializer, self.threads_per_worker),
+                name=f"{self.name}-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+
+        if not parent_conn.poll(self.start_timeout):
+            process.kill()
+            raise RuntimeError(f"{self.name}-{index} did not start within {self.start_timeout}s")
+        status, detail = parent_conn.recv()
+        if status != "ready":
+            process.join()
+            raise RuntimeError(f"{self.name}-{index} failed to start: {detail}")
+        return _Worker(index, process, parent_conn)
+
+    def _replace(self, worker: _Worker):
+        """Fork a replacement for a crashed worker, or mark its slot dead if that keeps failing."""
+        for attempt in range(1, self.respawn_attempts + 1):
+            try:
+                replacement = self._spawn(worker.index)
+            except Exception as e:
+                print(f"❌ Restarting {self.name}-{worker.index} failed ({attempt}/{self.respawn_attempts}): {e}")
+                continue
+            self._workers[worker.index] = replacement
+            self._idle.put(replacement)
+            return
+
+        with self._slots_lock:
+            worker.dead = True
+            if all(w.dead for w in self._workers):
+                print(f"❌ Every {self.name} process is dead")
+                self._idle.put(None)  # wakes waiting callers so they fail instead of blocking
+            else:
+                print(f"⚠️  {self.name}-{worker.index} is dead, continuing with fewer workers")
+
+    def process_batch(self, jobs: List[Any]) -> List[Any]:
+        worker = self._idle.get()
+        if worker is None:
+            self._idle.put(None)  # for the next waiting caller
+            raise WorkerCrashedError(f"No {self.name} processes are left")
+        try:
+            worker.conn.send(jobs)
+            status, payload = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            print(f"❌ {worker.process.name} (pid {worker.process.pid}) died, restarting it")
+            worker.process.join(timeout=1)
+            self._replace(worker)
+            raise WorkerCrashedError(f"{worker.process.name} exited while processing a batch") from e
+
+        worker.batches += 1
+        self._idle.put(worker)
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def stop(self, timeout: float = 5.0):
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.kill()
+        self._workers = []
+        gc.unfreeze()
+
+    def live_workers(self) -> int:
+        return sum(1 for w in self._workers if not w.dead)
+
+    def stats(self) -> dict:
+        return {
+            "workers": [
+                {"pid": w.process.pid, "alive": w.process.is_alive(), "dead": w.dead, "batches": w.batches}
+                for w in self._workers
+            ],
+            "live_workers": self.live_workers(),
+            "threads_per_worker": self.threads_per_worker,
+        }
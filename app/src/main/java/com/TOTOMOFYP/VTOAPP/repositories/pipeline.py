@@ -0,0 +1,210 @@
+"""
+Segment-and-categorize pipeline: the phone uploads the original photo once
+and gets back the stored wardrobe item, instead of downloading the cutout
+from /segment and uploading it again to /categorize.
+
+Both services run in this one process, so the cutout is handed from
+segmentation to Gemini and Storage in memory: the garment is cropped
+straight from the decoded photo and each copy (Storage master, Gemini
+JPEG) is encoded exactly once. Run it with
+
+    python pipeline.py
+
+(port 8090). It loads the segmentation models and the Gemini/Firebase
+clients, configured by the same environment variables as the two servers.
+"""
+import asyncio
+import json
+import time
+
+import numpy as np
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, Depends, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from PIL import Image
+from starlette.concurrency import run_in_threadpool
+
+import image_to_text
+import segmentation
+from grounding_prompts import DEFAULT_VOCABULARY
+from image_io import crop_cutout, load_full_image, read_upload
+from image_prep import prepare_pil_image, sniff_mime
+from service_metrics import instrument_app, observe_stages
+from stage_timing import StageTimings
+from uploads import UploadLimitMiddleware
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    async with segmentation.lifespan(segmentation.app), image_to_text.lifespan(image_to_text.app):
+        yield
+
+
+app = FastAPI(title="Segment and Categorize Pipeline", lifespan=lifespan)
+instrument_app(app, "pipeline")
+app.add_middleware(UploadLimitMiddleware, max_bytes=segmentation.MAX_UPLOAD_BYTES)
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def readiness() -> dict:
+    return {"segmentation": segmentation.model_status, "metadata": image_to_text.client_status}
+
+
+def is_ready() -> bool:
+    return segmentation.model_status["state"] == "ready" and image_to_text.client_status["state"] == "ready"
+
+
+def require_ready():
+    """Reject requests with 503 until both the models and the clients are up."""
+    if not is_ready():
+        raise HTTPException(
+            status_code=503,
+            detail="Pipeline is not ready yet",
+            headers={"Retry-After": str(segmentation.RETRY_AFTER_SECONDS)},
+        )
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    return JSONResponse(content=readiness(), status_code=200 if is_ready() else 503)
+
+
+def cutout_image(result: dict, contents: bytes, timings: StageTimings) -> Image.Image:
+    """The merged garment cutout of a segmentation result as an RGBA image, at full resolution."""
+    if "error" in result:
+        raise ValueError(result["error"])
+    with timings.stage("merge"):
+        combined_mask = np.any(result["masks"], axis=0)
+    if not combined_mask.any():
+        raise ValueError("No masks generated")
+    with timings.stage("crop"):
+        image_np = load_full_image(contents, result["image"]) if segmentation.FULL_RES_OUTPUT else result["image"]
+        cropped_img, cropped_mask, _ = crop_cutout(image_np, combined_mask)
+        alpha = cropped_mask.astype(np.uint8) * 255
+        return Image.fromarray(np.dstack((cropped_img, alpha)), "RGBA")
+
+
+async def run_pipeline(
+    user_id: str,
+    contents: bytes,
+    filename: str,
+    vocabulary: str,
+    timings: StageTimings,
+    background_tasks: BackgroundTasks,
+    progress,
+):
+    with timings.stage("decode"):
+        image_pil = await run_in_threadpool(segmentation.decode_image, contents)
+
+    waited = time.perf_counter()
+    result = (await segmentation.run_segmentation([image_pil], vocabulary))[0]
+    if isinstance(result, Exception):
+        raise result
+    model_ms = sum(result["timings"].values())
+    timings.add("queue", max(0.0, (time.perf_counter() - waited) * 1000.0 - model_ms))
+    timings.update(result["timings"])
+
+    cutout = await run_in_threadpool(cutout_image, result, contents, timings)
+    progress("segmented", width=cutout.width, height=cutout.height)
+
+    with timings.stage("normalize"):
+        prepared = await image_to_text.run_io(
+            prepare_pil_image, cutout, sniff_mime(contents),
+            image_to_text.GEMINI_IMAGE_MAX_SIDE, image_to_text.MASTER_MAX_SIDE, image_to_text.MASTER_FORMAT,
+        )
+
+    item, _ = await image_to_text.save_wardrobe_item(
+        user_id, prepared, filename, timings, background_tasks, progress
+    )
+    return item
+
+
+def wants_stream(request: Request, stream: bool) -> bool:
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+@app.post("/pipeline/{user_id}", dependencies=[Depends(require_ready)])
+async def segment_and_categorize(
+    user_id: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    vocabulary: str = DEFAULT_VOCABULARY,
+    stream: bool = False,
+):
+    """
+    Segment the uploaded photo, then categorize and store the garment
+    cutout as a wardrobe item. Returns the same body as /categorize, with
+    per-stage timings in the Server-Timing header.
+
+    With stream=true (or "Accept: application/x-ndjson") the response is
+    one JSON object per line instead: "received", "segmented", "analyzed"
+    and "stored" progress events, then "done" with the item or "error".
+    Every event carries elapsed_ms since the upload was read.
+    """
+    if vocabulary not in segmentation.VOCABULARIES:
+        raise HTTPException(
+            status_code=400, detail=f"vocabulary must be one of {', '.join(segmentation.VOCABULARIES)}"
+        )
+
+    timings = StageTimings()
+    with timings.stage("read"):
+        contents = await read_upload(file, segmentation.MAX_UPLOAD_BYTES)
+    started = time.perf_counter()
+
+    if not wants_stream(request, stream):
+        try:
+            item = await run_pipeline(
+                user_id, contents, file.filename, vocabulary, timings, background_tasks, lambda event, **fields: None
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            item = {"error": str(e)}
+        finally:
+            observe_stages("pipeline", timings)
+        return JSONResponse(content=item, headers={"Server-Timing": timings.server_timing()})
+
+    events = asyncio.Queue()
+
+    def progress(event: str, **fields):
+        elapsed_ms = round((time.perf_counter() - started) * 1000.0, 1)
+        events.put_nowait({"event": event, "elapsed_ms": elapsed_ms, **fields})
+
+    async def run():
+        try:
+            item = await run_pipeline(
+                user_id, contents, file.filename, vocabulary, timings, background_tasks, progress
+            )
+            progress("done", item=item)
+        except HTTPException as e:
+            progress("error", error=e.detail, status_code=e.status_code)
+        except Exception as e:
+            progress("error", error=str(e))
+        finally:
+            observe_stages("pipeline", timings)
+
+    async def ndjson():
+        # The pipeline keeps running if the client goes away mid-stream, so
+        # an item that was already analysed still gets saved
+        task = asyncio.create_task(run())
+        progress("received", bytes=len(contents))
+        while True:
+            event = await events.get()
+            yield json.dumps(event, default=str) + "\n"
+            if event["event"] in ("done", "error"):
+                break
+        await task
+
+    return StreamingResponse(ndjson(), media_type=NDJSON_MEDIA_TYPE)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8090)
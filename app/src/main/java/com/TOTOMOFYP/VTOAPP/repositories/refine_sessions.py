@@ -0,0 +1,216 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import List
+
+import numpy as np
+
+
+class SessionNotFoundError(KeyError):
+    """Raised when a refinement session id is unknown or has expired."""
+
+
+class RefinementSession:
+    """
+    One image whose SAM2 embedding has been computed once, plus the garment
+    objects being segmented on it. Each object has an optional box and any
+    number of foreground (label 1) / background (label 0) points, all in
+    display_image pixel coordinates; only the prompt decoder runs when they
+    change. Prompts are mapped to the working resolution the embedding was
+    computed at by scale = (sx, sy).
+
+    Callers hold lock while using a session: the predictor keeps per-image
+    state and isn't safe to share between threads.
+    """
+
+    def __init__(self, predictor, display_image: np.ndarray, working_shape, vocabulary: str):
+        self.id = uuid.uuid4().hex
+        self.predictor = predictor
+        self.display_image = display_image
+        self.working_shape = tuple(working_shape)
+        self.scale = (
+            working_shape[1] / display_image.shape[1],
+            working_shape[0] / display_image.shape[0],
+        )
+        self.vocabulary = vocabulary
+        self.objects = OrderedDict()  # object id -> prompts, mask and decoder logits
+        self.lock = threading.Lock()
+        self._next_object_id = 1
+
+    def add_object(self, box=None, label: str = "manual", score: float = 1.0) -> int:
+        object_id = self._next_object_id
+        self._next_object_id += 1
+        self.objects[object_id] = {
+            "box": list(box) if box is not None else None,
+            "points": [],
+            "point_labels": [],
+            "label": label,
+            "score": float(score),
+            "mask": None,
+            "logits": None,
+        }
+        return object_id
+
+    def update_object(self, object_id: int, box=None, points=None, point_labels=None, replace_points: bool = False):
+        obj = self.objects.get(object_id)
+        if obj is None:
+            raise KeyError(f"Unknown object {object_id}")
+        if box is not None:
+            obj["box"] = list(box)
+            obj["logits"] = None  # a new box starts over rather than refining the old mask
+        if replace_points:
+            obj["points"], obj["point_labels"] = [], []
+            obj["logits"] = None
+        if points:
+            obj["points"].extend([list(point) for point in points])
+            obj["point_labels"].extend(point_labels)
+
+    def remove_object(self, object_id: int):
+        if self.objects.pop(object_id, None) is None:
+            raise KeyError(f"Unknown object {object_id}")
+
+    def decode(self, object_ids: List[int]):
+        """Run the SAM2 prompt decoder for object_ids against the cached embedding."""
+        sx, sy = self.scale
+        height, width = self.working_shape
+        for object_id in object_ids:
+            obj = self.objects[object_id]
+            if obj["box"] is None and not obj["points"]:
+                obj["mask"] = np.zeros((height, width), dtype=bool)
+                continue
+            box = points = point_labels = mask_input = None
+            if obj["box"] is not None:
+                x1, y1, x2, y2 = obj["box"]
+                box = np.array([[x1 * sx, y1 * sy, x2 * sx, y2 * sy]], dtype=np.float32)
+            if obj["points"]:
+                points = np.array([[[x * sx, y * sy] for x, y in obj["points"]]], dtype=np.float32)
+                point_labels = np.array([obj["point_labels"]], dtype=np.int32)
+                # Clicks refine the previous mask, as in SAM's interactive loop
+                if obj["logits"] is not None:
+                    mask_input = obj["logits"]
+            masks, _, logits = self.predictor.predict_batch(
+                point_coords_batch=[points],
+                point_labels_batch=[point_labels],
+                box_batch=[box],
+                mask_input_batch=[mask_input],
+                multimask_output=False,
+            )
+            obj["mask"] = np.asarray(masks[0]).reshape(-1, height, width)[0].astype(bool)
+            obj["logits"] = logits[0] if logits is not None else None
+
+    def result(self) -> dict:
+        """The session's objects in segment_images() result form, with boxes in display coordinates."""
+        ids = list(self.objects)
+        boxes = []
+        for object_id in ids:
+            obj = self.objects[object_id]
+            if obj["box"] is not None:
+                boxes.append(obj["box"])
+            else:
+                mask = obj["mask"] if obj["mask"] is not None else np.zeros(self.working_shape, dtype=bool)
+                ys, xs = np.where(mask) if mask.any() else (np.zeros(1), np.zeros(1))
+                sx, sy = self.scale
+                boxes.append([xs.min() / sx, ys.min() / sy, xs.max() / sx, ys.max() / sy])
+        height, width = self.working_shape
+        return {
+            "image": self.display_image,
+            "object_ids": ids,
+            "boxes": boxes,
+            "scores": [self.objects[object_id]["score"] for object_id in ids],
+            "labels": [self.objects[object_id]["label"] for object_id in ids],
+            "masks": np.array(
+                [self.objects[object_id]["mask"] for object_id in ids] or np.zeros((0, height, width), dtype=bool)
+            ),
+        }
+
+    def nbytes(self) -> int:
+        """Approximate memory held: the embedding, the display image and every mask and logit map."""
+        total = self.display_image.nbytes
+        features = getattr(self.predictor, "_features", None) or {}
+        for value in features.values():
+            for tensor in value if isinstance(value, (list, tuple)) else [value]:
+                total += tensor.numel() * tensor.element_size()
+        for obj in self.objects.values():
+            for key in ("mask", "logits"):
+                if obj[key] is not None:
+                    total += obj[key].nbytes
+        return total
+
+
+class SessionCache:
+    """
+    Refinement sessions by id: an LRU bounded by the total nbytes() of the
+    sessions held, which also drops sessions untouched for ttl_seconds. The
+    most recently stored session is always kept, even if it alone is over
+    max_bytes.
+    """
+
+    def __init__(self, max_bytes: int, ttl_seconds: float = 600):
+        self.max_bytes = max(0, max_bytes)
+        self.ttl_seconds = ttl_seconds
+        self._sessions = OrderedDict()  # id -> (session, nbytes, last_used)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def put(self, session: RefinementSession, is_new: bool = False):
+        """Store (or re-measure after an update) session and evict what no longer fits."""
+        size = session.nbytes()
+        with self._lock:
+            previous = self._sessions.pop(session.id, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._sessions[session.id] = (session, size, time.monotonic())
+            self._bytes += size
+            if is_new:
+                self.created += 1
+            self._evict()
+
+    def get(self, session_id: str) -> RefinementSession:
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                raise SessionNotFoundError(session_id)
+            self._sessions[session_id] = (entry[0], entry[1], time.monotonic())
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                raise SessionNotFoundError(session_id)
+            self._bytes -= entry[1]
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                "sessions": len(self._sessions),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "created": self.created,
+                "evicted": self.evicted,
+                "expired": self.expired,
+            }
+
+    def _expire(self, now: float):
+        # Caller holds _lock
+        for session_id, (_, size, last_used) in list(self._sessions.items()):
+            if now - last_used > self.ttl_seconds:
+                del self._sessions[session_id]
+                self._bytes -= size
+                self.expired += 1
+
+    def _evict(self):
+        # Caller holds _lock
+        self._expire(time.monotonic())
+        while self._bytes > self.max_bytes and len(self._sessions) > 1:
+            _, (_, size, _) = self._sessions.popitem(last=False)
+            self._bytes -= size
+            self.evicted += 1
@@ -1,19 +1,63 @@
-import cv2
 import torch
-import base64
 import numpy as np
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, File, UploadFile, Response, Request, Depends, Query
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-import io
-from sam2.build_sam import build_sam2
-from sam2.sam2_image_predictor import SAM2ImagePredictor
+import os
+import json
+import queue
+import asyncio
+import concurrent.futures
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import List, Optional, Union
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from sam2.build_sam import build_sam2, build_sam2_video_predictor
 from sam2.automatic_mask_generator import SAM2AutomaticMaskGenerator
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection 
 from PIL import Image
+from inference_worker import InferenceScheduler, QueueFullError
+from jobs import InMemoryJobStore, JobRunner, add_job_routes, submit_job, wants_async
+from model_pool import ModelProcessPool
+from uploads import UploadLimitMiddleware
+from segment_cache import SegmentCache
+from refine_sessions import RefinementSession, SessionCache, SessionNotFoundError
+from video_segmentation import FrameStreamError, FrameStreamParser, VideoSegmenter, decode_frame, spool_path, video_file_frames
+from grounding_prompts import DEFAULT_VOCABULARY, PromptEncoder, load_vocabularies
+from image_io import (
+    crop_cutout, encode_base64_png, encode_png, encode_rle, encode_webp,
+    load_full_image, load_working_image, read_upload, scale_box, to_bgra,
+)
+from stage_timing import StageTimings
+from service_metrics import (
+    DEVICE_MEMORY, MODEL_BYTES, QUEUE_DEPTH, instrument_app, model_bytes, observe_stages,
+)
+from inference_backend import (
+    BACKEND, NUM_THREADS, QUANTIZE, SAM2_CHECKPOINT, SAM2_CONFIG, configure_device, create_predictor_factory,
+    inference_context, maybe_quantize,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Models load after the server is up, so /healthz answers immediately and
+    # /readyz flips to 200 once everything is loaded and warmed
+    if BACKGROUND_LOAD:
+        threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+    else:
+        await run_in_threadpool(load_models)
+    yield
+    await job_runner.shutdown()
+    scheduler.stop()
+    if model_pool is not None:
+        model_pool.stop()
+
 
 # Create FastAPI app
-app = FastAPI(title="SAM2 Segmentation API")
+app = FastAPI(title="SAM2 Segmentation API", lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,28 +68,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Setup CUDA and model configurations
-torch.autocast(device_type="cuda", dtype=torch.bfloat16).__enter__()
-
-if torch.cuda.get_device_properties(0).major >= 8:
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.allow_tf32 = True
-
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-# Load GroundingDINO
-grounding_processor = AutoProcessor.from_pretrained("IDEA-Research/grounding-dino-tiny")
-grounding_model = AutoModelForZeroShotObjectDetection.from_pretrained(
-    "IDEA-Research/grounding-dino-tiny"
-).to(DEVICE)
+# Prometheus metrics on /metrics: per-stage and per-endpoint latency
+# histograms, in-flight requests, queue depth and model memory
+instrument_app(app, "segmentation")
 
-CHECKPOINT = "checkpoints/sam2.1_hiera_tiny.pt"
-CONFIG = "configs/sam2.1/sam2.1_hiera_t.yaml"
+# Setup device (CUDA when available, otherwise CPU) and model configurations
+DEVICE = configure_device()
 
+# Startup: load models on a background thread (SEGMENT_BACKGROUND_LOAD=0 blocks
+# startup instead), then run SEGMENT_WARMUP_RUNS passes over a synthetic image
+# so the first real request doesn't pay for cold kernels and allocator growth
+BACKGROUND_LOAD = os.getenv("SEGMENT_BACKGROUND_LOAD", "1") == "1"
+WARMUP_RUNS = int(os.getenv("SEGMENT_WARMUP_RUNS", "1"))
 
+# Multi-process serving: SEGMENT_MODEL_WORKERS > 0 forks that many model
+# worker processes after the weights are loaded (sharing them copy-on-write)
+# and load-balances batches across them. CPU only; SEGMENT_NUM_THREADS then
+# sets the threads per worker (default: cores / workers).
+MODEL_WORKERS = int(os.getenv("SEGMENT_MODEL_WORKERS", "0"))
+if MODEL_WORKERS and DEVICE.type != "cpu":
+    print("⚠️  SEGMENT_MODEL_WORKERS only applies on CPU, serving from this process")
+    MODEL_WORKERS = 0
 
-# Load the model
-sam2_model = build_sam2(CONFIG, CHECKPOINT, device=DEVICE, apply_postprocessing=False)
-mask_generator = SAM2AutomaticMaskGenerator(sam2_model)
+# Populated by load_models()
+grounding_processor = None
+grounding_model = None
+sam2_model = None
+new_predictor = None
+mask_generator = None
+prompt_encoder = None
+model_pool = None
+model_status = {"state": "starting", "error": None, "load_seconds": None, "warmup_seconds": None}
 
 
 @app.get("/")
@@ -53,136 +106,1129 @@ async def root():
     return {"message": "SAM2 Segmentation API is running. Use POST /segment endpoint."}
 
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving HTTP, whether or not models are loaded."""
+    return {"status": "ok"}
 
-@app.post("/segment")
-async def segment_image(file: UploadFile = File(...)):
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 only once models are loaded and warmed up, and while a model worker is left."""
+    status_code = 200 if model_status["state"] == "ready" else 503
+    content = dict(model_status)
+    if model_pool is not None:
+        content["pool"] = model_pool.stats()
+        if content["pool"]["live_workers"] == 0:
+            status_code = 503
+            content["error"] = "Every model worker process has died"
+    return JSONResponse(content=content, status_code=status_code)
+
+
+
+# GroundingDINO label vocabularies and thresholds shared by /segment and /segment_batch.
+# Prompts are tokenized once at startup and their text features cached.
+VOCABULARIES = load_vocabularies()
+GROUNDING_MODEL_ID = "IDEA-Research/grounding-dino-tiny"
+BOX_THRESHOLD = 0.35
+TEXT_THRESHOLD = 0.25
+
+# Response modes: "merged" returns one cutout, "items" adds one per garment
+SEGMENT_MODES = ("merged", "items")
+
+# Output formats. "json" is the original base64 PNG in JSON, "rle" returns a
+# COCO-style RLE mask plus crop box for the client to composite, and "png" /
+# "webp" return the merged cutout as raw image bytes. Without ?format= the
+# Accept header picks between json, png and webp.
+OUTPUT_MEDIA_TYPES = {
+    "json": "application/json",
+    "rle": "application/json",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+BINARY_OUTPUTS = ("png", "webp")
+# PNG zlib level 0-9 (unset keeps OpenCV's fast default); WebP quality > 100 is lossless
+PNG_COMPRESSION = int(os.environ["SEGMENT_PNG_COMPRESSION"]) if os.getenv("SEGMENT_PNG_COMPRESSION") else None
+WEBP_QUALITY = int(os.getenv("SEGMENT_WEBP_QUALITY", "90"))
+
+# Input pipeline: uploads above SEGMENT_MAX_UPLOAD_BYTES are refused with 413
+# before their body is received (UploadLimitMiddleware, batches allow that per
+# image), and both models run on a copy whose longest side is at most
+# SEGMENT_MAX_WORKING_SIDE (0 = original size). Masks are upsampled back onto
+# the full-resolution photo for the cutout unless SEGMENT_FULL_RES_OUTPUT=0.
+MAX_UPLOAD_BYTES = int(os.getenv("SEGMENT_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_WORKING_SIDE = int(os.getenv("SEGMENT_MAX_WORKING_SIDE", "1024"))
+FULL_RES_OUTPUT = os.getenv("SEGMENT_FULL_RES_OUTPUT", "1") == "1"
+
+# Micro-batching: upper bound on how many images go through the models in one
+# forward pass, and how long the worker waits for more requests to join a batch
+MAX_BATCH_SIZE = int(os.getenv("SEGMENT_MAX_BATCH_SIZE", "8"))
+BATCH_WAIT_MS = float(os.getenv("SEGMENT_BATCH_WAIT_MS", "10"))
+
+# Backpressure: images allowed to wait for the worker before we answer 429
+MAX_QUEUE_SIZE = int(os.getenv("SEGMENT_MAX_QUEUE_SIZE", "64"))
+RETRY_AFTER_SECONDS = int(os.getenv("SEGMENT_RETRY_AFTER_SECONDS", "2"))
+app.add_middleware(
+    UploadLimitMiddleware,
+    max_bytes=MAX_UPLOAD_BYTES,
+    path_limits={"/segment_batch": MAX_QUEUE_SIZE * MAX_UPLOAD_BYTES},
+)
+
+# Result cache: in-memory LRU capped in bytes, plus an optional on-disk tier
+# (enabled by setting SEGMENT_CACHE_DIR) that survives restarts
+result_cache = SegmentCache(
+    max_bytes=int(os.getenv("SEGMENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    disk_dir=os.getenv("SEGMENT_CACHE_DIR") or None,
+    disk_max_bytes=int(os.getenv("SEGMENT_CACHE_DISK_MAX_BYTES", str(2 * 1024 * 1024 * 1024))),
+)
+
+# Async mode (?async=true or "Prefer: respond-async"): /segment answers 202
+# with a job to poll on /jobs/{id}. At most SEGMENT_JOB_WORKERS jobs run at
+# once and SEGMENT_JOB_MAX_PENDING may be unfinished; finished jobs are kept
+# for SEGMENT_JOB_TTL_SECONDS
+job_runner = JobRunner(
+    InMemoryJobStore(
+        ttl_seconds=float(os.getenv("SEGMENT_JOB_TTL_SECONDS", "3600")),
+        max_jobs=int(os.getenv("SEGMENT_JOB_MAX_STORED", "1000")),
+    ),
+    max_workers=int(os.getenv("SEGMENT_JOB_WORKERS", "4")),
+    max_pending=int(os.getenv("SEGMENT_JOB_MAX_PENDING", "256")),
+)
+add_job_routes(app, job_runner, RETRY_AFTER_SECONDS)
+
+
+def detect_clothes(images_pil: List[Image.Image], vocabulary: str = DEFAULT_VOCABULARY):
+    """
+    Run GroundingDINO once over a padded batch of images and return one
+    post-processed detection dict (boxes, scores, labels) per image. The
+    vocabulary's tokens and text features come from prompt_encoder's cache.
+    """
+    inputs = prompt_encoder.inputs_for(images_pil, vocabulary)
+    with torch.no_grad():
+        outputs = grounding_model(**inputs)
+    return grounding_processor.post_process_grounded_object_detection(
+        outputs,
+        input_ids=inputs["input_ids"],
+        box_threshold=BOX_THRESHOLD, text_threshold=TEXT_THRESHOLD,
+        target_sizes=[image.size[::-1] for image in images_pil]
+    )
+
+
+def segment_images(images_pil: List[Image.Image], vocabulary: str = DEFAULT_VOCABULARY) -> List[dict]:
+    """
+    Detect and segment a batch of images with a single GroundingDINO pass, a
+    single SAM2 image-embedding pass and one prompt-decoder call per image
+    covering all of its boxes. Returns one dict per input image holding either
+    an "error" message or the raw per-garment detections and boolean masks.
+    """
+    timings = StageTimings()
+    images_np = [np.array(image) for image in images_pil]
+    with timings.stage("detect"):
+        detections = detect_clothes(images_pil, vocabulary)
+
+    results = [None] * len(images_np)
+    detected = []
+    for idx, detection in enumerate(detections):
+        boxes = detection["boxes"].cpu().numpy()
+        if len(boxes) == 0:
+            results[idx] = {"error": "No clothes detected"}
+        else:
+            detected.append((idx, boxes))
+
+    if detected:
+        # SAM2 embeds every image with detections in one batched encoder call
+        predictor = new_predictor()
+        with timings.stage("embed"):
+            predictor.set_image_batch([images_np[idx] for idx, _ in detected])
+        with timings.stage("predict"):
+            masks_batch, _, _ = predictor.predict_batch(
+                box_batch=[boxes for _, boxes in detected],
+                multimask_output=False
+            )
+        for (idx, boxes), masks in zip(detected, masks_batch):
+            height, width = images_np[idx].shape[:2]
+            detection = detections[idx]
+            results[idx] = {
+                "image": images_np[idx],
+                "boxes": boxes,
+                "scores": detection["scores"].cpu().numpy(),
+                "labels": list(detection.get("text_labels", detection["labels"])),
+                # (N, 1, H, W) for several boxes, (1, H, W) for one
+                "masks": masks.reshape(-1, height, width).astype(bool),
+            }
+
+    # Model stages run once for the whole batch, so every image reports the batch timings
+    for result in results:
+        result["timings"] = dict(timings.durations)
+    return results
+
+
+@dataclass(frozen=True)
+class SegmentOptions:
+    mode: str = "merged"
+    vocabulary: str = DEFAULT_VOCABULARY
+    output: str = "json"
+    png_level: Optional[int] = PNG_COMPRESSION
+
+
+def format_result(
+    result: dict,
+    options: SegmentOptions = SegmentOptions(),
+    contents: bytes = None,
+    timings: StageTimings = None,
+) -> Union[dict, bytes]:
+    """
+    Turn a segment_images() result into the response body. For JSON outputs
+    the merged cutout is always included and mode="items" also lists every
+    garment with its own cutout, GroundingDINO label, box and score; binary
+    outputs return just the encoded merged cutout. When the original upload
+    bytes are given, cutouts and boxes are produced at full resolution.
+    Errors are always returned as an {"error": ...} dict.
+    """
+    timings = timings if timings is not None else StageTimings()
+    if "error" in result:
+        return {"error": result["error"]}
+
+    masks = result["masks"]
+    with timings.stage("merge"):
+        combined_mask = np.any(masks, axis=0)  # shape: H x W, boolean mask
+    if not combined_mask.any():
+        return {"error": "No masks generated"}
+
+    with timings.stage("crop"):
+        working_shape = result["image"].shape[:2]
+        image_np = load_full_image(contents, result["image"]) if contents is not None else result["image"]
+        merged = crop_cutout(image_np, combined_mask)
+        items = []
+        if options.mode == "items":
+            items = [
+                (crop_cutout(image_np, mask), box, score, label)
+                for mask, box, score, label in zip(masks, result["boxes"], result["scores"], result["labels"])
+                if mask.any()
+            ]
+
+    with timings.stage("encode"):
+        if options.output == "png":
+            return encode_png(to_bgra(merged[0], merged[1]), options.png_level)
+        if options.output == "webp":
+            return encode_webp(to_bgra(merged[0], merged[1]), WEBP_QUALITY)
+
+        def encode(cutout):
+            cropped_img, cropped_mask, crop_box = cutout
+            if options.output == "rle":
+                return {"rle": encode_rle(cropped_mask), "crop_box": crop_box}
+            return {"mask": encode_base64_png(to_bgra(cropped_img, cropped_mask), options.png_level)}
+
+        response = encode(merged)
+        if options.output == "rle":
+            response["image_size"] = list(image_np.shape[:2])
+        if options.mode == "items":
+            response["items"] = [
+                {
+                    "label": label,
+                    "score": round(float(score), 4),
+                    "box": scale_box(box, working_shape, image_np.shape[:2]),
+                    **encode(cutout),
+                }
+                for cutout, box, score, label in items
+            ]
+    return response
+
+
+def run_inference_batch(jobs: List[tuple]) -> List[dict]:
+    """
+    Entry point for the inference worker thread. Each job is an
+    (image, vocabulary) pair; images sharing a vocabulary are segmented
+    together so their cached text features can be reused across the batch.
+    """
+    groups = {}
+    for idx, (_, vocabulary) in enumerate(jobs):
+        groups.setdefault(vocabulary, []).append(idx)
+
+    results = [None] * len(jobs)
+    with inference_context(DEVICE):
+        for vocabulary, indices in groups.items():
+            group_results = segment_images([jobs[idx][0] for idx in indices], vocabulary)
+            for idx, result in zip(indices, group_results):
+                results[idx] = result
+    return results
+
+
+def prime_prompt_cache():
+    """Compute every vocabulary's text features up front with a tiny dummy image."""
+    dummy = Image.new("RGB", (64, 64))
+    with inference_context(DEVICE):
+        for vocabulary in VOCABULARIES:
+            detect_clothes([dummy], vocabulary)
+
+
+def warmup():
+    """
+    Push a synthetic working-resolution image through the full pipeline. The
+    synthetic image rarely yields detections, so SAM2 is also run directly
+    with a centred box to warm its encoder and decoder.
+    """
+    side = MAX_WORKING_SIDE or 1024
+    gradient = np.linspace(0, 255, side, dtype=np.uint8)
+    image_np = np.ascontiguousarray(np.dstack([np.tile(gradient, (side * 3 // 4, 1))] * 3))
+    image = Image.fromarray(image_np)
+    height, width = image_np.shape[:2]
+    box = np.array([[width // 4, height // 4, width * 3 // 4, height * 3 // 4]], dtype=np.float32)
+    for _ in range(WARMUP_RUNS):
+        for result in run_inference_batch([(image, vocabulary) for vocabulary in VOCABULARIES]):
+            format_result(result)
+        with inference_context(DEVICE):
+            predictor = new_predictor()
+            predictor.set_image_batch([image_np])
+            predictor.predict_batch(box_batch=[box], multimask_output=False)
+
+
+def init_inference():
+    """
+    Per-process inference setup: build the SAM2 predictor factory (which may
+    open an ONNX Runtime session), prime the prompt cache and warm up. Runs in
+    each model worker process when SEGMENT_MODEL_WORKERS is set, otherwise in
+    this one.
+    """
+    global new_predictor
+    new_predictor = create_predictor_factory(sam2_model, DEVICE)
+    prime_prompt_cache()
+    warmup()
+
+
+def process_batch(jobs: List[tuple]) -> List[dict]:
+    """Scheduler entry point: run a batch in this process or on the next idle model worker."""
+    if model_pool is not None:
+        return model_pool.process_batch(jobs)
+    return run_inference_batch(jobs)
+
+
+def load_models():
+    """Load both models, warm up (in every model worker when pooled) and start the scheduler."""
+    global grounding_processor, grounding_model, sam2_model, mask_generator, prompt_encoder, model_pool
     try:
-        contents = await file.read()
-        image_pil = Image.open(io.BytesIO(contents)).convert("RGB")
-        image_np = np.array(image_pil)
-        
-        # Step 1: detect all clothing items
-        inputs = grounding_processor(
-            images=image_pil,
-            text="clothes . shirt . t-shirt . pants . dress . jacket . coat . skirt . blouse . sweater . hoodie . jeans . trousers . shorts . gown . jumpsuit .",
-            return_tensors="pt"
+        model_status["state"] = "loading"
+        print(f"Loading models on {DEVICE} with the {BACKEND} backend...")
+        started = time.perf_counter()
+
+        # Load GroundingDINO
+        grounding_processor = AutoProcessor.from_pretrained(GROUNDING_MODEL_ID)
+        grounding_model = AutoModelForZeroShotObjectDetection.from_pretrained(
+            GROUNDING_MODEL_ID
+        ).to(DEVICE).eval()
+        grounding_model = maybe_quantize(grounding_model, DEVICE)
+
+        # Load SAM2
+        sam2_model = build_sam2(SAM2_CONFIG, SAM2_CHECKPOINT, device=DEVICE, apply_postprocessing=False)
+        if BACKEND == "torch":
+            sam2_model = maybe_quantize(sam2_model, DEVICE)
+        else:
+            # Only the prompt encoder and mask decoder run in PyTorch with an exported image encoder
+            sam2_model.sam_mask_decoder = maybe_quantize(sam2_model.sam_mask_decoder, DEVICE)
+        mask_generator = SAM2AutomaticMaskGenerator(sam2_model)
+
+        prompt_encoder = PromptEncoder(grounding_processor, grounding_model, VOCABULARIES, DEVICE)
+        MODEL_BYTES.labels("grounding_dino").set(model_bytes(grounding_model))
+        MODEL_BYTES.labels("sam2").set(model_bytes(sam2_model))
+        model_status["load_seconds"] = round(time.perf_counter() - started, 2)
+
+        model_status["state"] = "warming"
+        started = time.perf_counter()
+        if MODEL_WORKERS:
+            # Workers are forked after the weights are loaded, so they share them
+            pool = ModelProcessPool(
+                run_inference_batch,
+                num_workers=MODEL_WORKERS,
+                initializer=init_inference,
+                threads_per_worker=NUM_THREADS,
+                name="segmentation-model",
+            )
+            pool.start()
+            model_pool = pool
+        else:
+            init_inference()
+        model_status["warmup_seconds"] = round(time.perf_counter() - started, 2)
+
+        scheduler.start()
+        model_status["state"] = "ready"
+        print(f"✅ Models ready (load {model_status['load_seconds']}s, warmup {model_status['warmup_seconds']}s)")
+    except Exception as e:
+        model_status["state"] = "failed"
+        model_status["error"] = str(e)
+        print(f"❌ Model loading failed: {e}")
+
+
+# All model calls go through worker threads that micro-batch concurrent
+# requests (one thread per model worker process when pooled); they are
+# started by load_models() once the models are warm
+scheduler = InferenceScheduler(
+    process_batch,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=BATCH_WAIT_MS,
+    max_queue_size=MAX_QUEUE_SIZE,
+    name="segmentation-worker",
+    num_workers=MODEL_WORKERS or 1,
+)
+QUEUE_DEPTH.labels("segmentation").set_function(scheduler.qsize)
+if DEVICE.type == "cuda":
+    DEVICE_MEMORY.labels("cuda").set_function(torch.cuda.memory_allocated)
+
+
+def require_models():
+    if model_status["state"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Models are not ready yet ({model_status['state']})",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
         )
-        inputs = {k: v.to(DEVICE) for k, v in inputs.items()}
-        with torch.no_grad():
-            outputs = grounding_model(**inputs)
-        results = grounding_processor.post_process_grounded_object_detection(
-            outputs,
-            input_ids=inputs["input_ids"],
-            box_threshold=0.35, text_threshold=0.25,
-            target_sizes=[image_np.shape[:2]]
+
+
+async def run_segmentation(images_pil: List[Image.Image], vocabulary: str) -> List[dict]:
+    """Queue images for the inference worker and wait for their results."""
+    require_models()
+    try:
+        futures = scheduler.submit_many([(image, vocabulary) for image in images_pil])
+    except QueueFullError:
+        raise HTTPException(
+            status_code=429,
+            detail="Segmentation queue is full, please retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
         )
-        boxes = results[0]["boxes"].cpu().numpy()
-        if len(boxes) == 0:
-            return {"error": "No clothes detected"}
-
-        # Step 2: segment each with SAM2
-        predictor = SAM2ImagePredictor(sam2_model)
-        predictor.set_image(image_np)
-        all_masks = []
-        for box in boxes:
-            masks, _, _ = predictor.predict(box=np.array([box]), multimask_output=False)
-            if len(masks) > 0:
-                mask_bool = masks[0].astype(bool)
-                all_masks.append(mask_bool)
-
-        if len(all_masks) == 0:
-            return {"error": "No masks generated"}
-
-        # Step 3: merge masks
-        combined_mask = np.any(all_masks, axis=0)  # shape: H x W, boolean mask
-
-        # Step 4: crop or prepare output
-        # optional: find bounding box around combined_mask
-        ys, xs = np.where(combined_mask)
-        y1, y2 = ys.min(), ys.max()
-        x1, x2 = xs.min(), xs.max()
-        # crop image_np
-        cropped_img = image_np[y1:y2, x1:x2]
-        # apply mask to crop
-        cropped_mask = combined_mask[y1:y2, x1:x2]
-        # build RGBA
-        alpha = (cropped_mask.astype(np.uint8) * 255)
-        cropped_rgba = np.dstack((cropped_img, alpha))
-        
-        # encode as base64 if you want
-        _, buffer = cv2.imencode(".png", cv2.cvtColor(cropped_rgba, cv2.COLOR_RGBA2BGRA))
-        b64_img = base64.b64encode(buffer).decode("utf-8")
-        return {"mask": b64_img}
+    return await asyncio.gather(*(asyncio.wrap_future(f) for f in futures), return_exceptions=True)
 
+
+def decode_image(contents: bytes) -> Image.Image:
+    return load_working_image(contents, MAX_WORKING_SIDE)
+
+
+def render_result(result: dict, options: SegmentOptions, contents: bytes, timings: StageTimings):
+    return format_result(result, options, contents if FULL_RES_OUTPUT else None, timings)
+
+
+def checkpoint_identity(path: str) -> str:
+    """Path plus size and mtime, so a checkpoint replaced in place changes the key too."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return f"{path}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+SAM2_IDENTITY = checkpoint_identity(SAM2_CHECKPOINT)
+
+
+def cache_key(contents: bytes, options: SegmentOptions) -> str:
+    # The disk tier outlives the process, so anything that changes the bytes
+    # served (models, thresholds, encoding settings) belongs in the key
+    return SegmentCache.make_key(
+        contents, VOCABULARIES[options.vocabulary], BOX_THRESHOLD, TEXT_THRESHOLD,
+        options.mode, options.output, options.png_level, WEBP_QUALITY, MAX_WORKING_SIDE, FULL_RES_OUTPUT,
+        BACKEND, QUANTIZE, GROUNDING_MODEL_ID, SAM2_CONFIG, SAM2_IDENTITY,
+    )
+
+
+def build_options(mode: str, vocabulary: str, output: str, png_level: Optional[int]) -> SegmentOptions:
+    if mode not in SEGMENT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(SEGMENT_MODES)}")
+    if vocabulary not in VOCABULARIES:
+        raise HTTPException(status_code=400, detail=f"vocabulary must be one of {', '.join(VOCABULARIES)}")
+    if output not in OUTPUT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(OUTPUT_MEDIA_TYPES)}")
+    if output in BINARY_OUTPUTS and mode == "items":
+        raise HTTPException(status_code=400, detail="mode=items needs a JSON format (json or rle)")
+    if png_level is not None and not 0 <= png_level <= 9:
+        raise HTTPException(status_code=400, detail="png_level must be between 0 and 9")
+    return SegmentOptions(mode, vocabulary, output, PNG_COMPRESSION if png_level is None else png_level)
+
+
+def negotiate_output(accept: str) -> str:
+    """Pick the output format from an Accept header, defaulting to JSON."""
+    for media_range in accept.split(","):
+        media_type = media_range.split(";")[0].strip().lower()
+        if media_type == "image/png":
+            return "png"
+        if media_type == "image/webp":
+            return "webp"
+        if media_type in ("application/json", "*/*"):
+            return "json"
+    return "json"
+
+
+def segment_options(
+    request: Request,
+    mode: str = "merged",
+    vocabulary: str = DEFAULT_VOCABULARY,
+    format: Optional[str] = None,
+    png_level: Optional[int] = None,
+) -> SegmentOptions:
+    output = format or negotiate_output(request.headers.get("accept", ""))
+    return build_options(mode, vocabulary, output, png_level)
+
+
+def batch_options(
+    mode: str = "merged",
+    vocabulary: str = DEFAULT_VOCABULARY,
+    format: str = "json",
+    png_level: Optional[int] = None,
+) -> SegmentOptions:
+    if format in BINARY_OUTPUTS:
+        raise HTTPException(status_code=400, detail="/segment_batch supports format=json or format=rle")
+    return build_options(mode, vocabulary, format, png_level)
+
+
+def make_response(body: Union[dict, bytes], options: SegmentOptions, timings: StageTimings, **descriptions) -> Response:
+    headers = {"Server-Timing": timings.server_timing(**descriptions)}
+    if isinstance(body, bytes):
+        return Response(content=body, media_type=OUTPUT_MEDIA_TYPES[options.output], headers=headers)
+    # Binary formats can't carry an error image, so flag failures with a status code
+    status_code = 422 if options.output in BINARY_OUTPUTS and "error" in body else 200
+    return JSONResponse(content=body, status_code=status_code, headers=headers)
+
+
+def serialize_for_cache(body: Union[dict, bytes]) -> bytes:
+    if isinstance(body, bytes):
+        return body
+    return json.dumps(body).encode("utf-8")
+
+
+async def segment_contents(contents: bytes, options: SegmentOptions, timings: StageTimings):
+    """
+    Segment one uploaded image, through the result cache. Returns the
+    response body (cached hits come back already serialized) and
+    "hit" or "miss".
+    """
+    with timings.stage("hash"):
+        key = await run_in_threadpool(cache_key, contents, options)
+        cached = await run_in_threadpool(result_cache.get, key)  # may read SEGMENT_CACHE_DIR
+    if cached is not None:
+        return cached, "hit"
+
+    with timings.stage("decode"):
+        image_pil = await run_in_threadpool(decode_image, contents)
+
+    # Detect all clothing items, then decode every box in one SAM2 call
+    waited = time.perf_counter()
+    result = (await run_segmentation([image_pil], options.vocabulary))[0]
+    if isinstance(result, Exception):
+        raise result
+    model_ms = sum(result["timings"].values())
+    timings.add("queue", max(0.0, (time.perf_counter() - waited) * 1000.0 - model_ms))
+    timings.update(result["timings"])
+
+    body = await run_in_threadpool(render_result, result, options, contents, timings)
+    if isinstance(body, bytes) or options.output not in BINARY_OUTPUTS:
+        await run_in_threadpool(result_cache.put, key, serialize_for_cache(body))
+    return body, "miss"
+
+
+async def segment_job(contents: bytes, options: SegmentOptions) -> dict:
+    timings = StageTimings()
+    try:
+        body, _ = await segment_contents(contents, options, timings)
+    finally:
+        observe_stages("segmentation", timings)
+    body = json.loads(body) if isinstance(body, bytes) else body
+    if "error" in body:
+        raise ValueError(body["error"])
+    return body
+
+
+@app.post("/segment")
+async def segment_image(
+    request: Request,
+    file: UploadFile = File(...),
+    options: SegmentOptions = Depends(segment_options),
+    async_mode: bool = Query(False, alias="async"),
+):
+    """
+    Segment one image. Query parameters: mode (merged | items), vocabulary,
+    format (json | rle | png | webp, otherwise negotiated from Accept) and
+    png_level. Per-stage timings are returned in the Server-Timing header.
+
+    With async=true (or "Prefer: respond-async") the response is 202 with a
+    job to poll on /jobs/{id}, whose result is the JSON body; resending the
+    same Idempotency-Key header returns the original job.
+    """
+    if wants_async(request, async_mode):
+        if options.output in BINARY_OUTPUTS:
+            raise HTTPException(status_code=400, detail="async mode needs format=json or format=rle")
+        contents = await read_upload(file, MAX_UPLOAD_BYTES)
+        return submit_job(
+            job_runner, request, "segment", lambda: segment_job(contents, options), retry_after=RETRY_AFTER_SECONDS
+        )
+
+    timings = StageTimings()
+    try:
+        with timings.stage("read"):
+            contents = await read_upload(file, MAX_UPLOAD_BYTES)
+
+        body, cache_status = await segment_contents(contents, options, timings)
+        if cache_status == "hit":
+            headers = {"Server-Timing": timings.server_timing(cache="hit")}
+            return Response(content=body, media_type=OUTPUT_MEDIA_TYPES[options.output], headers=headers)
+        return make_response(body, options, timings, cache="miss")
+
+    except HTTPException:
+        raise
     except Exception as e:
-        return {"error": str(e)}
+        return make_response({"error": str(e)}, options, timings)
+    finally:
+        observe_stages("segmentation", timings)
+
+
+@app.post("/segment_batch")
+async def segment_batch(files: List[UploadFile] = File(...), options: SegmentOptions = Depends(batch_options)):
+    """
+    Segment many images in one request. Cached images are answered straight
+    from the result cache; the rest are decoded individually and queued for
+    the inference worker, which runs them through the models in micro-batches
+    of up to MAX_BATCH_SIZE. Every input gets its own entry in "results",
+    formatted like a JSON /segment response.
+    """
+    if len(files) > MAX_QUEUE_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_QUEUE_SIZE} images per batch")
+
+    results = [{"filename": file.filename} for file in files]
+
+    pending = []
+    for idx, file in enumerate(files):
+        try:
+            contents = await read_upload(file, MAX_UPLOAD_BYTES)
+            key = await run_in_threadpool(cache_key, contents, options)
+            cached = await run_in_threadpool(result_cache.get, key)
+            if cached is not None:
+                results[idx].update(json.loads(cached))
+                continue
+            pending.append((idx, key, contents, await run_in_threadpool(decode_image, contents)))
+        except HTTPException as e:
+            results[idx]["error"] = e.detail
+        except Exception as e:
+            results[idx]["error"] = f"Invalid image: {e}"
+
+    if not pending:
+        return {"results": results}  # all cached or invalid: no need for the models
+    batch_results = await run_segmentation([image for _, _, _, image in pending], options.vocabulary)
+    for (idx, key, contents, _), result in zip(pending, batch_results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            timings = StageTimings(result["timings"])
+            payload = await run_in_threadpool(render_result, result, options, contents, timings)
+            observe_stages("segmentation", timings)
+            await run_in_threadpool(result_cache.put, key, serialize_for_cache(payload))
+            results[idx].update(payload)
+        except Exception as e:
+            results[idx]["error"] = str(e)
+
+    return {"results": results}
+
+
+# -----------------------------
+# Refinement sessions
+# -----------------------------
+# A session keeps one image's SAM2 embedding in memory so corrections (new or
+# moved boxes, foreground/background clicks) only re-run the prompt decoder.
+# Sessions are evicted least recently used first once they hold more than
+# SEGMENT_SESSION_MAX_BYTES, and after SEGMENT_SESSION_TTL_SECONDS unused
+session_cache = SessionCache(
+    max_bytes=int(os.getenv("SEGMENT_SESSION_MAX_BYTES", str(512 * 1024 * 1024))),
+    ttl_seconds=float(os.getenv("SEGMENT_SESSION_TTL_SECONDS", "600")),
+)
+session_predictor_lock = threading.Lock()
+
+# A session's embedding has to stay in this process, so creating one can't go
+# through the scheduler or the model workers. At most SEGMENT_SESSION_MAX_EMBEDS
+# embed (and detect) at once; more get 429 rather than starving /segment
+SESSION_MAX_EMBEDS = int(os.getenv("SEGMENT_SESSION_MAX_EMBEDS", "1"))
+session_embed_slots = threading.BoundedSemaphore(max(1, SESSION_MAX_EMBEDS))
+
+
+class ObjectPrompt(BaseModel):
+    object_id: Optional[int] = None  # refine this object; omitted adds a new one
+    box: Optional[List[float]] = None  # [x1, y1, x2, y2] in image pixels
+    points: List[List[float]] = []  # [x, y] clicks in image pixels
+    labels: List[int] = []  # one per point: 1 = garment, 0 = background
+    replace_points: bool = False  # drop the object's earlier clicks first
 
-    
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
 
+class RefineRequest(BaseModel):
+    prompts: List[ObjectPrompt] = []
+    remove: List[int] = []  # object ids to delete
 
 
+def session_predictor():
+    """
+    A fresh predictor for a session. When pooled, only the model workers
+    built the predictor factory, so this process builds its own on first use.
+    """
+    global new_predictor
+    with session_predictor_lock:
+        if new_predictor is None:
+            new_predictor = create_predictor_factory(sam2_model, DEVICE)
+    return new_predictor()
+
+
+def session_options(
+    mode: str = "items",
+    vocabulary: str = DEFAULT_VOCABULARY,
+    format: str = "json",
+    png_level: Optional[int] = None,
+) -> SegmentOptions:
+    if format in BINARY_OUTPUTS:
+        raise HTTPException(status_code=400, detail="Sessions support format=json or format=rle")
+    return build_options(mode, vocabulary, format, png_level)
+
+
+def validate_prompt(prompt: ObjectPrompt):
+    if prompt.box is not None and len(prompt.box) != 4:
+        raise HTTPException(status_code=400, detail="box must be [x1, y1, x2, y2]")
+    if any(len(point) != 2 for point in prompt.points):
+        raise HTTPException(status_code=400, detail="points must be [x, y] pairs")
+    if len(prompt.labels) != len(prompt.points) or any(label not in (0, 1) for label in prompt.labels):
+        raise HTTPException(status_code=400, detail="labels needs one 0 or 1 per point")
+    if prompt.object_id is None and prompt.box is None and not prompt.points:
+        raise HTTPException(status_code=400, detail="A new object needs a box or points")
+
+
+def start_session(contents: bytes, image_pil: Image.Image, vocabulary: str, detect: bool, timings: StageTimings):
+    """Embed the image once, optionally seed objects from GroundingDINO, and decode them."""
+    image_np = np.array(image_pil)
+    display_image = load_full_image(contents, image_np) if FULL_RES_OUTPUT else image_np
+    with inference_context(DEVICE):
+        predictor = session_predictor()
+        with timings.stage("embed"):
+            predictor.set_image_batch([image_np])
+        session = RefinementSession(predictor, display_image, image_np.shape[:2], vocabulary)
+        if detect:
+            with timings.stage("detect"):
+                detection = detect_clothes([image_pil], vocabulary)[0]
+            sx, sy = session.scale
+            labels = list(detection.get("text_labels", detection["labels"]))
+            for (x1, y1, x2, y2), score, label in zip(detection["boxes"].cpu().numpy(), detection["scores"].cpu().numpy(), labels):
+                session.add_object([x1 / sx, y1 / sy, x2 / sx, y2 / sy], label, score)
+        with timings.stage("predict"):
+            session.decode(list(session.objects))
+    return session
+
+
+def apply_refinement(session: RefinementSession, update: RefineRequest, timings: StageTimings):
+    touched = []
+    try:
+        for object_id in update.remove:
+            session.remove_object(object_id)
+        for prompt in update.prompts:
+            if prompt.object_id is None:
+                object_id = session.add_object(prompt.box)
+            else:
+                object_id = prompt.object_id
+                session.update_object(object_id, box=prompt.box, replace_points=prompt.replace_points)
+            session.update_object(object_id, points=prompt.points, point_labels=prompt.labels)
+            touched.append(object_id)
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=str(e.args[0]))
+    with inference_context(DEVICE), timings.stage("predict"):
+        session.decode(list(dict.fromkeys(touched)))
+
+
+def render_session(session: RefinementSession, options: SegmentOptions, timings: StageTimings) -> dict:
+    """Format a session like a /segment response, plus its id and every object's prompts."""
+    result = session.result()
+    body = format_result(result, options, None, timings)
+    if "items" in body:
+        visible = [object_id for object_id, mask in zip(result["object_ids"], result["masks"]) if mask.any()]
+        for item, object_id in zip(body["items"], visible):
+            item["id"] = object_id
+    body["session_id"] = session.id
+    body["objects"] = [
+        {
+            "id": object_id,
+            "label": obj["label"],
+            "box": [int(round(v)) for v in box],
+            "points": obj["points"],
+            "labels": obj["point_labels"],
+        }
+        for (object_id, obj), box in zip(session.objects.items(), result["boxes"])
+    ]
+    return body
+
+
+def get_session(session_id: str) -> RefinementSession:
+    try:
+        return session_cache.get(session_id)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+
+
+@app.post("/sessions")
+async def create_session(
+    file: UploadFile = File(...),
+    options: SegmentOptions = Depends(session_options),
+    detect: bool = True,
+):
+    """
+    Start a refinement session: the image is embedded once and, unless
+    detect=false, every garment GroundingDINO finds becomes an object.
+    Returns session_id and the objects with their masks, formatted like
+    /segment (mode defaults to items).
+    """
+    require_models()
+    timings = StageTimings()
+    try:
+        with timings.stage("read"):
+            contents = await read_upload(file, MAX_UPLOAD_BYTES)
+        with timings.stage("decode"):
+            image_pil = await run_in_threadpool(decode_image, contents)
+        if not session_embed_slots.acquire(blocking=False):
+            raise HTTPException(
+                status_code=429,
+                detail="Too many sessions starting, please retry later",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+            )
+        try:
+            session = await run_in_threadpool(start_session, contents, image_pil, options.vocabulary, detect, timings)
+        finally:
+            session_embed_slots.release()
+        session_cache.put(session, is_new=True)
+        body = await run_in_threadpool(render_session, session, options, timings)
+        return make_response(body, options, timings)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return make_response({"error": str(e)}, options, timings)
+    finally:
+        observe_stages("segmentation", timings)
+
+
+@app.post("/sessions/{session_id}/prompts")
+async def refine_session(
+    session_id: str,
+    update: RefineRequest,
+    options: SegmentOptions = Depends(session_options),
+):
+    """
+    Add, move or remove objects' boxes and clicks, then re-decode only the
+    objects that changed against the session's cached embedding.
+    """
+    require_models()
+    for prompt in update.prompts:
+        validate_prompt(prompt)
+    session = get_session(session_id)
+    timings = StageTimings()
+
+    def refine():
+        with session.lock:
+            apply_refinement(session, update, timings)
+            return render_session(session, options, timings)
+
+    try:
+        body = await run_in_threadpool(refine)
+        session_cache.put(session)  # masks and logits changed size
+        return make_response(body, options, timings)
+    except HTTPException:
+        raise
+    except Exception as e:
+        return make_response({"error": str(e)}, options, timings)
+    finally:
+        observe_stages("segmentation", timings)
 
 
+@app.get("/sessions/{session_id}")
+async def read_session(session_id: str, options: SegmentOptions = Depends(session_options)):
+    session = get_session(session_id)
+    timings = StageTimings()
 
-# @app.post("/segment")
-# async def segment_image(
-#     x: int = Form(...), 
-#     y: int = Form(...), 
-#     width: int = Form(...), 
-#     height: int = Form(...),
-#     image: UploadFile = File(...)
-# ):
-#     try:
-#         # Read the uploaded image
-#         image_bytes = await image.read()
-#         nparr = np.frombuffer(image_bytes, np.uint8)
-#         image_bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        
-#         if image_bgr is None:
-#             raise HTTPException(status_code=400, detail="Invalid image format")
-        
-#         image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
-        
-#         # Set up the predictor
-#         predictor = SAM2ImagePredictor(sam2_model)
-#         predictor.set_image(image_rgb)
-        
-#         # Process bounding box coordinates [x1, y1, x2, y2]
-#         box_array = np.array([[x, y, x + width, y + height]])
-        
-#         # Run prediction with bounding box
-#         masks, scores, logits = predictor.predict(
-#             box=box_array,  # Use bounding box instead of point coordinates
-#             multimask_output=False
-#         )
-        
-#         # Get the mask (should only have one since multimask_output=False)
-#         mask = masks[0].astype(np.uint8)
-        
-#         # Apply the mask to the image for visualization
-#         segmented_rgb = image_rgb * mask[:, :, np.newaxis]
-#         alpha = mask * 255
-#         segmented_rgba = np.dstack((segmented_rgb, alpha))
-        
-#         # Convert to BGRA for OpenCV
-#         bgra_image = cv2.cvtColor(segmented_rgba, cv2.COLOR_RGBA2BGRA)
-        
-#         # Encode the image as base64
-#         is_success, buffer = cv2.imencode(".png", bgra_image)
-#         if not is_success:
-#             raise HTTPException(status_code=500, detail="Failed to encode the image")
-        
-#         img_bytes = buffer.tobytes()
-#         img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        
-#         return {
-#             "success": True,
-#             "scores": scores.tolist() if isinstance(scores, np.ndarray) else [float(scores)],
-#             "image_base64": img_base64
-#         }
-        
-#     except Exception as e:
-#         raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+    def render():
+        with session.lock:
+            return render_session(session, options, timings)
+
+    return make_response(await run_in_threadpool(render), options, timings)
+
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    try:
+        session_cache.delete(session_id)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown or expired session")
+    return {"deleted": session_id}
+
+
+@app.get("/sessions")
+async def session_stats():
+    return session_cache.stats()
+
+
+# -----------------------------
+# Video segmentation
+# -----------------------------
+# /segment_video tracks garments through a clip or photo burst: GroundingDINO
+# runs on every SEGMENT_VIDEO_KEYFRAME_INTERVAL-th frame (0 = first frame
+# only) and SAM2's video predictor propagates the masks in between,
+# SEGMENT_VIDEO_CHUNK_FRAMES frames at a time. Frames past
+# SEGMENT_VIDEO_MAX_FRAMES are ignored. Garments no detection matches on
+# SEGMENT_VIDEO_RETIRE_KEYFRAMES keyframes in a row stop being tracked (0 =
+# never). Each stream ties up a model thread for its whole length, so at
+# most SEGMENT_VIDEO_MAX_STREAMS run at once
+VIDEO_KEYFRAME_INTERVAL = int(os.getenv("SEGMENT_VIDEO_KEYFRAME_INTERVAL", "30"))
+VIDEO_CHUNK_FRAMES = int(os.getenv("SEGMENT_VIDEO_CHUNK_FRAMES", "8"))
+VIDEO_MAX_FRAMES = int(os.getenv("SEGMENT_VIDEO_MAX_FRAMES", "1800"))
+VIDEO_RETIRE_KEYFRAMES = int(os.getenv("SEGMENT_VIDEO_RETIRE_KEYFRAMES", "2"))
+VIDEO_MAX_BYTES = int(os.getenv("SEGMENT_VIDEO_MAX_BYTES", str(200 * 1024 * 1024)))
+VIDEO_MAX_STREAMS = int(os.getenv("SEGMENT_VIDEO_MAX_STREAMS", "1"))
+FRAME_STREAM_MEDIA_TYPE = "application/x-frame-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+VIDEO_SUFFIXES = {"video/mp4": ".mp4", "video/quicktime": ".mov", "video/webm": ".webm", "video/3gpp": ".3gp"}
+
+video_slots = threading.BoundedSemaphore(max(1, VIDEO_MAX_STREAMS))
+video_predictor = None
+video_predictor_lock = threading.Lock()
+VIDEO_END = object()  # end-of-input / end-of-output marker on the stream queues
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse for handlers that keep reading the request body
+    while the response streams. Starlette otherwise listens on receive()
+    for the disconnect (under ASGI < 2.4, which uvicorn speaks) and would
+    swallow body chunks, so the handler's own reader watches for it instead.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+
+def get_video_predictor():
+    """
+    SAM2's video predictor, built on first use. It holds no per-video state
+    (that lives in each stream's inference state), so streams share it, and
+    it takes the already loaded image model's weights instead of a second
+    copy from the checkpoint where the modules match.
+    """
+    global video_predictor
+    with video_predictor_lock:
+        if video_predictor is None:
+            predictor = build_sam2_video_predictor(SAM2_CONFIG, None, device=DEVICE)
+            try:
+                predictor.load_state_dict(sam2_model.state_dict(), assign=True)
+            except Exception:
+                # A quantized sam2_model's weights don't fit the plain modules
+                predictor = build_sam2_video_predictor(SAM2_CONFIG, SAM2_CHECKPOINT, device=DEVICE)
+            video_predictor = predictor
+            print("✅ SAM2 video predictor ready")
+    return video_predictor
+
+
+def video_detector(vocabulary: str):
+    def detect(frame: np.ndarray):
+        detection = detect_clothes([Image.fromarray(frame)], vocabulary)[0]
+        labels = list(detection.get("text_labels", detection["labels"]))
+        return detection["boxes"].cpu().numpy(), detection["scores"].cpu().numpy(), labels
+    return detect
+
+
+def queued_frames(frames: queue.Queue, cancelled: threading.Event):
+    """Frames handed over by the request reader, until it signals the end of the input."""
+    while not cancelled.is_set():
+        try:
+            frame = frames.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if frame is VIDEO_END:
+            return
+        yield frame
+
+
+def track_video(source, vocabulary: str, keyframe_interval: int, timings: StageTimings, emit, cancelled: threading.Event):
+    """Run VideoSegmenter over source on this thread, emitting each frame's record and then VIDEO_END or the error."""
+    try:
+        with inference_context(DEVICE):
+            segmenter = VideoSegmenter(
+                get_video_predictor(), video_detector(vocabulary), keyframe_interval, VIDEO_CHUNK_FRAMES,
+                retire_after=VIDEO_RETIRE_KEYFRAMES,
+            )
+            for record in segmenter.run(source, timings):
+                if cancelled.is_set():
+                    break
+                emit(record)
+        emit(VIDEO_END)
+    except Exception as e:
+        emit(e)
+
+
+@app.post("/segment_video")
+async def segment_video(
+    request: Request,
+    vocabulary: str = DEFAULT_VOCABULARY,
+    keyframe_interval: int = VIDEO_KEYFRAME_INTERVAL,
+):
+    """
+    Segment garments through a clip or burst. The body is either a video
+    file (Content-Type video/*) or a frame stream (Content-Type
+    application/x-frame-stream): each frame a 4-byte big-endian length and
+    an encoded image, so a burst can be sent as it is captured. Streamed
+    frames are tracked while the upload is still arriving; a video file is
+    decoded frame by frame once it has been received.
+
+    The response is NDJSON: one line per frame with its index, whether it
+    was a keyframe and every tracked garment's id, label, box and RLE mask
+    (at the working resolution), then {"done": true, ...} with the frame
+    count and stage timings, or {"error": ...}, which is also how a frame
+    stream that turns out malformed or too large mid-upload is reported.
+    """
+    require_models()
+    if vocabulary not in VOCABULARIES:
+        raise HTTPException(status_code=400, detail=f"vocabulary must be one of {', '.join(VOCABULARIES)}")
+    if keyframe_interval < 0:
+        raise HTTPException(status_code=400, detail="keyframe_interval must be 0 (first frame only) or more")
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if not (content_type.startswith("video/") or content_type == FRAME_STREAM_MEDIA_TYPE):
+        raise HTTPException(
+            status_code=415, detail=f"Send a video/* file or an {FRAME_STREAM_MEDIA_TYPE} body"
+        )
+    if not video_slots.acquire(blocking=False):
+        raise HTTPException(
+            status_code=429,
+            detail="Too many video streams, please retry later",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+        )
+
+    timings = StageTimings()
+    loop = asyncio.get_running_loop()
+    records = asyncio.Queue(maxsize=2 * VIDEO_CHUNK_FRAMES)
+    cancelled = threading.Event()
+    spooled = None
+    tracker = None
+
+    def emit(record):
+        # Blocks while the client is behind, which in turn stalls the tracker
+        future = asyncio.run_coroutine_threadsafe(records.put(record), loop)
+        while not cancelled.is_set():
+            try:
+                future.result(timeout=0.1)
+                return
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+
+    def start(source):
+        nonlocal tracker
+        tracker = threading.Thread(
+            target=track_video,
+            args=(source, vocabulary, keyframe_interval, timings, emit, cancelled),
+            name="video-tracker",
+            daemon=True,
+        )
+        tracker.start()
+
+    def put_frame(frames: queue.Queue, frame) -> bool:
+        # Blocks while the tracker is behind, which in turn stops reading the body
+        while tracker.is_alive():
+            try:
+                frames.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def cleanup():
+        cancelled.set()
+        if tracker is not None:
+            tracker.join()
+        if spooled is not None and os.path.exists(spooled):
+            os.remove(spooled)
+        video_slots.release()
+
+    async def read_frames(frames: queue.Queue):
+        parser = FrameStreamParser(MAX_UPLOAD_BYTES)
+        received = 0
+        count = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > VIDEO_MAX_BYTES:
+                raise FrameStreamError("Frame stream is too large")
+            for data in parser.feed(chunk):
+                if count >= VIDEO_MAX_FRAMES:
+                    continue
+                with timings.stage("decode"):
+                    frame = await run_in_threadpool(decode_frame, data, MAX_WORKING_SIDE)
+                count += 1
+                if not await run_in_threadpool(put_frame, frames, frame):
+                    return  # the tracker has stopped; its end or error is already queued
+        parser.close()
+        await run_in_threadpool(put_frame, frames, VIDEO_END)
+
+    async def watch_request(frames: Optional[queue.Queue]):
+        # Owns receive() while the response streams: reads a frame stream's
+        # body, then waits for the client to go away and stops the tracker if it does
+        try:
+            if frames is not None:
+                await read_frames(frames)
+            while (await request.receive())["type"] != "http.disconnect":
+                pass
+            error = ClientDisconnect()
+        except Exception as e:
+            error = e
+        cancelled.set()
+        await records.put(error)
+
+    try:
+        if content_type == FRAME_STREAM_MEDIA_TYPE:
+            frames = queue.Queue(maxsize=2 * VIDEO_CHUNK_FRAMES)
+            start(queued_frames(frames, cancelled))
+        else:
+            spooled = spool_path(VIDEO_SUFFIXES.get(content_type, ".mp4"))
+            received = 0
+            with timings.stage("read"), open(spooled, "wb") as out:
+                async for chunk in request.stream():
+                    received += len(chunk)
+                    if received > VIDEO_MAX_BYTES:
+                        raise HTTPException(status_code=413, detail="Video is too large")
+                    out.write(chunk)
+            frames = None
+            start(video_file_frames(spooled, MAX_WORKING_SIDE, VIDEO_MAX_FRAMES))
+    except BaseException:
+        await run_in_threadpool(cleanup)
+        raise
+
+    async def ndjson():
+        frames_out = 0
+        watcher = asyncio.create_task(watch_request(frames))
+        try:
+            while True:
+                record = await records.get()
+                if record is VIDEO_END:
+                    durations = {name: round(ms, 1) for name, ms in timings.durations.items()}
+                    yield json.dumps({"done": True, "frames": frames_out, "timings": durations}) + "\n"
+                    break
+                if isinstance(record, Exception):
+                    yield json.dumps({"error": str(record) or "Client disconnected"}) + "\n"
+                    break
+                frames_out += 1
+                yield json.dumps(record) + "\n"
+        finally:
+            # Also runs when the client disconnects: the tracker stops after its current chunk
+            watcher.cancel()
+            await run_in_threadpool(cleanup)
+            observe_stages("segmentation", timings)
+
+    return DuplexStreamingResponse(ndjson(), media_type=NDJSON_MEDIA_TYPE)
+
+
+@app.get("/vocabularies")
+async def list_vocabularies():
+    return {"default": DEFAULT_VOCABULARY, "vocabularies": VOCABULARIES}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return result_cache.stats()
+
+    
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,70 @@
+"""
+Prometheus metrics shared by the segmentation and metadata servers.
+
+instrument_app() adds a /metrics endpoint plus request latency and
+in-flight tracking to a FastAPI app; handlers feed their StageTimings to
+observe_stages() so every stage gets its own latency histogram.
+"""
+import time
+
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+
+from stage_timing import StageTimings
+
+# Model stages on CPU can take tens of seconds, so the buckets go well past the defaults
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = Histogram(
+    "vto_stage_duration_seconds", "Time spent in each request stage",
+    ["service", "stage"], buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "vto_request_duration_seconds", "End-to-end request latency",
+    ["service", "endpoint", "status"], buckets=LATENCY_BUCKETS,
+)
+IN_FLIGHT = Gauge("vto_requests_in_flight", "Requests currently being handled", ["service"])
+QUEUE_DEPTH = Gauge("vto_inference_queue_depth", "Images waiting for the inference worker", ["service"])
+MODEL_BYTES = Gauge("vto_model_weight_bytes", "Size of each loaded model's weights", ["model"])
+DEVICE_MEMORY = Gauge("vto_device_memory_allocated_bytes", "Accelerator memory allocated by the models", ["device"])
+
+
+def observe_stages(service: str, timings: StageTimings):
+    for stage, duration_ms in timings.durations.items():
+        STAGE_SECONDS.labels(service, stage).observe(duration_ms / 1000.0)
+
+
+def model_bytes(model) -> int:
+    """Bytes held by a module's parameters and buffers (including quantized weights)."""
+    return sum(
+        value.numel() * value.element_size()
+        for value in model.state_dict().values()
+        if hasattr(value, "element_size")
+    )
+
+
+def instrument_app(app: FastAPI, service: str):
+    """Track request latency and in-flight requests for app and serve /metrics."""
+    in_flight = IN_FLIGHT.labels(service)
+
+    @app.middleware("http")
+    async def track_requests(request: Request, call_next):
+        if request.url.path == "/metrics":
+            return await call_next(request)
+        in_flight.inc()
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            in_flight.dec()
+            # Label by route template so per-user paths don't explode cardinality
+            route = request.scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUEST_SECONDS.labels(service, endpoint, str(status)).observe(time.perf_counter() - started)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,233 @@
+"""
+Smart display names ("Casual 3", "Formal 1", ...) for wardrobe items.
+
+Each user has one counter document, users/{uid}/counters/displayNames,
+holding {"counts": {base name: highest number handed out}}. Names are
+reserved by incrementing it inside a Firestore transaction, so concurrent
+uploads never get the same name and naming costs one document read and
+write instead of a scan of the whole wardrobe. A user without a counter
+document is backfilled once from their existing display_name values;
+
+    python smart_names.py backfill [--user UID]
+
+does that ahead of time for every user (or one).
+"""
+import argparse
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from google.api_core.exceptions import AlreadyExists
+from google.cloud import firestore
+
+COUNTERS_COLLECTION = "counters"
+COUNTERS_DOCUMENT = "displayNames"
+
+# Map occasion text to proper display name
+OCCASION_BASE_NAMES = {
+    "casual": "Casual",
+    "formal": "Formal",
+    "business": "Business",
+    "office": "Business",
+    "business / office": "Business",
+    "party": "Party",
+    "celebration": "Party",
+    "party / celebration": "Party",
+    "wedding": "Wedding",
+    "sports": "Sports",
+    "active": "Sports",
+    "sports / active": "Sports",
+    "travel": "Travel",
+    "vacation": "Travel",
+    "travel / vacation": "Travel",
+    "loungewear": "Loungewear",
+    "home": "Loungewear",
+    "loungewear / home": "Loungewear",
+    "traditional": "Traditional",
+    "cultural": "Traditional",
+    "traditional / cultural": "Traditional",
+    "seasonal": "Seasonal",
+    "weather": "Seasonal",
+    "seasonal / weather-based": "Seasonal"
+}
+
+IGNORED_STYLES = ("", "unknown", "test clothing item", "not specified")
+
+
+def base_name_for(item_occasion: str, item_category: str, item_style: str) -> str:
+    """Pick the name stem from the occasion first, then the style, then the category."""
+    occasion_lower = item_occasion.lower().strip()
+    style_lower = item_style.lower().strip()
+
+    # Try to match occasion first
+    for key, value in OCCASION_BASE_NAMES.items():
+        if key in occasion_lower:
+            return value
+
+    # If no occasion match, try style
+    if style_lower not in IGNORED_STYLES:
+        # Map common styles to occasions
+        if "casual" in style_lower:
+            return "Casual"
+        if "formal" in style_lower:
+            return "Formal"
+        if "business" in style_lower or "office" in style_lower:
+            return "Business"
+        if "party" in style_lower or "evening" in style_lower:
+            return "Party"
+        if "sport" in style_lower or "active" in style_lower:
+            return "Sports"
+        return item_style.capitalize()
+
+    # If no occasion or style match, use category as fallback
+    category_lower = item_category.lower()
+    if category_lower == "top":
+        return "Top"
+    if category_lower == "bottom":
+        return "Bottom"
+    if category_lower == "full_body":
+        return "Outfit"
+    return "Item"
+
+
+def highest_numbers(display_names: Iterable[str]) -> Dict[str, int]:
+    """Highest N per base name among names like "Casual 3"."""
+    counts = {}
+    for name in display_names:
+        base, _, number = (name or "").rpartition(" ")
+        if base and number.isdigit():
+            counts[base] = max(counts.get(base, 0), int(number))
+    return counts
+
+
+class SmartNameCounters:
+    """
+    Transactional per-user name counters with a read-through in-process
+    cache of each user's counts (bounded to max_cached_users, least recently
+    used first out). The cache only saves reads; every reservation still
+    goes through a transaction, so it stays correct with several servers.
+    transactional is the decorator that runs a function in a transaction
+    with retries; a non-Firestore db (see fake_backends.py) brings its own.
+    """
+
+    def __init__(self, db: firestore.Client, max_cached_users: int = 10000, transactional=firestore.transactional):
+        self.db = db
+        self.max_cached_users = max_cached_users
+        self.transactional = transactional
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _ref(self, user_id: str):
+        return (
+            self.db.collection("users").document(user_id)
+            .collection(COUNTERS_COLLECTION).document(COUNTERS_DOCUMENT)
+        )
+
+    def _remember(self, user_id: str, counts: Dict[str, int]):
+        with self._lock:
+            self._cache[user_id] = dict(counts)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.max_cached_users:
+                self._cache.popitem(last=False)
+
+    def counts(self, user_id: str) -> Dict[str, int]:
+        """The user's current counts, backfilling the counter document if it doesn't exist yet."""
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                self._cache.move_to_end(user_id)
+                return dict(cached)
+
+        snapshot = self._ref(user_id).get()
+        if snapshot.exists:
+            counts = (snapshot.to_dict() or {}).get("counts", {})
+        else:
+            counts = self.backfill(user_id)
+        self._remember(user_id, counts)
+        return dict(counts)
+
+    def backfill(self, user_id: str, force: bool = False) -> Dict[str, int]:
+        """
+        Seed the counter document from the user's existing display names.
+        Without force an existing document wins; with force the counts are
+        raised to at least the scanned values.
+        """
+        items = (
+            self.db.collection("users").document(user_id).collection("wardrobeItems")
+            .select(["display_name"]).stream()
+        )
+        counts = highest_numbers(item.to_dict().get("display_name", "") for item in items)
+        ref = self._ref(user_id)
+        try:
+            ref.create({"counts": counts})
+            print(f"✅ Backfilled name counters for {user_id}: {counts}")
+        except AlreadyExists:
+            if not force:
+                return (ref.get().to_dict() or {}).get("counts", {})
+            counts = self._merge_max(ref, counts)
+        self._remember(user_id, counts)
+        return counts
+
+    def _merge_max(self, ref, counts: Dict[str, int]) -> Dict[str, int]:
+        @self.transactional
+        def merge(transaction):
+            snapshot = ref.get(transaction=transaction)
+            merged = dict((snapshot.to_dict() or {}).get("counts", {}))
+            for base, number in counts.items():
+                merged[base] = max(merged.get(base, 0), number)
+            transaction.set(ref, {"counts": merged})
+            return merged
+
+        return merge(self.db.transaction())
+
+    def next_names(self, user_id: str, base_names: List[str]) -> List[str]:
+        """Reserve the next name for each base name (repeats allowed) in one transaction."""
+        self.counts(user_id)  # make sure the counter document exists
+        ref = self._ref(user_id)
+
+        @self.transactional
+        def reserve(transaction):
+            snapshot = ref.get(transaction=transaction)
+            counts = dict((snapshot.to_dict() or {}).get("counts", {}))
+            names = []
+            for base in base_names:
+                counts[base] = counts.get(base, 0) + 1
+                names.append(f"{base} {counts[base]}")
+            transaction.set(ref, {"counts": counts})
+            return names, counts
+
+        names, counts = reserve(self.db.transaction())
+        self._remember(user_id, counts)
+        return names
+
+    def next_name(self, user_id: str, base_name: str) -> str:
+        return self.next_names(user_id, [base_name])[0]
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+    from google.oauth2 import service_account
+
+    parser = argparse.ArgumentParser(description="Manage smart-name counters")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subparsers.add_parser("backfill", help="seed counters from existing display names")
+    backfill_parser.add_argument("--user", help="only backfill this user id")
+    backfill_parser.add_argument("--force", action="store_true", help="rescan users that already have counters")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    credentials = service_account.Credentials.from_service_account_file(os.environ["GOOGLE_APPLICATION_CREDENTIALS"])
+    db = firestore.Client(credentials=credentials)
+    counters = SmartNameCounters(db)
+
+    user_ids = [args.user] if args.user else [doc.id for doc in db.collection("users").list_documents()]
+    for user_id in user_ids:
+        counters.backfill(user_id, force=args.force)
+    print(f"✅ Processed {len(user_ids)} users")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
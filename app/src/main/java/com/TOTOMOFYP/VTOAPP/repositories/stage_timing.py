@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class StageTimings:
+    """
+    Collects per-stage wall-clock durations (in milliseconds) for one request
+    and renders them as a Server-Timing header.
+    """
+
+    def __init__(self, initial: Optional[Dict[str, float]] = None):
+        self.durations = dict(initial or {})
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000.0)
+
+    def add(self, name: str, duration_ms: float):
+        self.durations[name] = self.durations.get(name, 0.0) + duration_ms
+
+    def update(self, durations: Dict[str, float]):
+        for name, duration_ms in durations.items():
+            self.add(name, duration_ms)
+
+    def total_ms(self) -> float:
+        return (time.perf_counter() - self._started) * 1000.0
+
+    def server_timing(self, **descriptions) -> str:
+        """Server-Timing header value, e.g. 'detect;dur=41.2, total;dur=88.0'."""
+        entries = [f"{name};dur={duration:.1f}" for name, duration in self.durations.items()]
+        entries.extend(f'{name};desc="{desc}"' for name, desc in descriptions.items())
+        entries.append(f"total;dur={self.total_ms():.1f}")
+        return ", ".join(entries)
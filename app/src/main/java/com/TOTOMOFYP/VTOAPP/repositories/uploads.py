@@ -0,0 +1,96 @@
+from typing import Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+READ_CHUNK_BYTES = 1024 * 1024
+MULTIPART_OVERHEAD_BYTES = 64 * 1024  # boundaries, part headers and small form fields
+
+
+def too_large(max_bytes: int) -> str:
+    return f"Image is larger than the {max_bytes // (1024 * 1024)} MB upload limit"
+
+
+async def read_upload(file: UploadFile, max_bytes: int) -> bytes:
+    """
+    Read an upload in chunks, failing with 413 once it exceeds max_bytes.
+    Starlette has already received the whole multipart body by now, so this
+    is the exact per-file check; UploadLimitMiddleware is what stops an
+    oversized request before it is received.
+    """
+    chunks = []
+    total = 0
+    while True:
+        chunk = await file.read(READ_CHUNK_BYTES)
+        if not chunk:
+            break
+        total += len(chunk)
+        if max_bytes and total > max_bytes:
+            raise HTTPException(status_code=413, detail=too_large(max_bytes))
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+class UploadLimitMiddleware:
+    """
+    Refuse multipart uploads over the limit before Starlette parses (and
+    spools to disk) the whole body: straight away when Content-Length is
+    over it, otherwise as soon as the bytes received pass it. max_bytes
+    applies per request; path_limits gives paths starting with a prefix
+    their own, e.g. batch endpoints that carry many files.
+    """
+
+    def __init__(self, app, max_bytes: int, path_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_limits = path_limits or {}
+
+    def limit_for(self, path: str) -> int:
+        for prefix, limit in self.path_limits.items():
+            if path.startswith(prefix):
+                return limit
+        return self.max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        max_bytes = self.limit_for(scope["path"])
+        if not max_bytes or not headers.get("content-type", "").startswith("multipart/form-data"):
+            return await self.app(scope, receive, send)
+
+        limit = max_bytes + MULTIPART_OVERHEAD_BYTES
+        response = JSONResponse({"detail": too_large(max_bytes)}, status_code=413)
+        length = headers.get("content-length", "")
+        if length.isdigit() and int(length) > limit:
+            return await response(scope, receive, send)
+
+        received = 0
+        rejected = False
+        started = False
+
+        async def receive_limited():
+            # Past the limit, answer 413 here and tell the app the client left,
+            # which stops its form parsing; raising instead would reach it
+            # wrapped by BaseHTTPMiddleware and come out as a 400
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit and not started:
+                    rejected = True
+                    await response(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def send_unless_rejected(message):
+            nonlocal started
+            if rejected:
+                return  # the app's reply to the disconnect; the client already has its 413
+            started = True
+            await send(message)
+
+        await self.app(scope, receive_limited, send_unless_rejected)
@@ -0,0 +1,357 @@
+"""
+Garment segmentation over frame sequences (clips and photo bursts) with
+SAM2's video predictor.
+
+GroundingDINO only runs on keyframes; in between, SAM2 propagates every
+garment's mask from its memory of the previous frames, so most frames cost
+one image-encoder pass and a light memory/decoder step. Frames are pulled
+from an iterator as they are needed and everything older than SAM2's memory
+window (frames, features, per-frame outputs, all but the last few
+conditioning frames) is dropped as tracking moves on, so memory stays flat
+however long the input is.
+"""
+import io
+import os
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from image_io import encode_rle
+from stage_timing import StageTimings
+
+FRAME_HEADER = struct.Struct(">I")
+IMG_MEAN = (0.485, 0.456, 0.406)
+IMG_STD = (0.229, 0.224, 0.225)
+
+
+class FrameStreamError(ValueError):
+    """Raised for a malformed frame stream or an undecodable frame."""
+
+
+# -----------------------------
+# Frame sources
+# -----------------------------
+def fit_frame(frame: np.ndarray, max_side: int) -> np.ndarray:
+    height, width = frame.shape[:2]
+    scale = max_side / max(height, width) if max_side else 1.0
+    if scale >= 1.0:
+        return frame
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_frame(data: bytes, max_side: int) -> np.ndarray:
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", (max_side, max_side))
+        return fit_frame(np.array(image.convert("RGB")), max_side)
+    except Exception as e:
+        raise FrameStreamError(f"Undecodable frame: {e}")
+
+
+class FrameStreamParser:
+    """
+    Incremental parser for the frame-stream body: each frame is a 4-byte
+    big-endian length followed by that many bytes of an encoded image (JPEG,
+    PNG, ...). feed() takes body chunks as they arrive and returns the
+    frames completed so far.
+    """
+
+    def __init__(self, max_frame_bytes: int):
+        self.max_frame_bytes = max_frame_bytes
+        self._buffer = bytearray()
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        self._buffer.extend(chunk)
+        frames = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer)
+            if length == 0 or (self.max_frame_bytes and length > self.max_frame_bytes):
+                raise FrameStreamError(f"Invalid frame length {length}")
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append(bytes(self._buffer[FRAME_HEADER.size:end]))
+            del self._buffer[:end]
+        return frames
+
+    def close(self):
+        if self._buffer:
+            raise FrameStreamError("Frame stream ended in the middle of a frame")
+
+
+def video_file_frames(path: str, max_side: int, max_frames: int) -> Iterator[np.ndarray]:
+    """Decode a video file frame by frame as RGB at the working resolution."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise FrameStreamError("Unreadable video")
+    try:
+        count = 0
+        while not max_frames or count < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            count += 1
+            yield fit_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), max_side)
+    finally:
+        capture.release()
+
+
+def spool_path(suffix: str = ".mp4") -> str:
+    handle, path = tempfile.mkstemp(prefix="segment-video-", suffix=suffix)
+    os.close(handle)
+    return path
+
+
+# -----------------------------
+# Streaming SAM2 state
+# -----------------------------
+class FrameWindow:
+    """
+    The "images" of a SAM2 inference state, filled as frames arrive: frames
+    are preprocessed like SAM2's own video loader (square resize, ImageNet
+    normalisation) and those SAM2 no longer needs are released.
+    """
+
+    def __init__(self, image_size: int, device: torch.device):
+        self.image_size = image_size
+        self.device = device
+        self._frames = {}
+        self._count = 0
+        self._mean = torch.tensor(IMG_MEAN, dtype=torch.float32)[:, None, None]
+        self._std = torch.tensor(IMG_STD, dtype=torch.float32)[:, None, None]
+
+    def append(self, frame: np.ndarray) -> int:
+        resized = cv2.resize(frame, (self.image_size, self.image_size), interpolation=cv2.INTER_LINEAR)
+        tensor = torch.from_numpy(resized).permute(2, 0, 1).float() / 255.0
+        self._frames[self._count] = ((tensor - self._mean) / self._std).to(self.device)
+        self._count += 1
+        return self._count - 1
+
+    def release_before(self, frame_idx: int):
+        for idx in [idx for idx in self._frames if idx < frame_idx]:
+            del self._frames[idx]
+
+    def __getitem__(self, frame_idx: int) -> torch.Tensor:
+        return self._frames[frame_idx]
+
+    def __len__(self) -> int:
+        return self._count
+
+
+def init_stream_state(predictor, frames: FrameWindow, height: int, width: int) -> dict:
+    """
+    An inference state for predictor over a FrameWindow. Mirrors
+    SAM2VideoPredictor.init_state (sam2 1.1), which only accepts a video
+    path and loads every frame up front.
+    """
+    device = predictor.device
+    return {
+        "images": frames,
+        "num_frames": len(frames),
+        "offload_video_to_cpu": False,
+        "offload_state_to_cpu": False,
+        "video_height": height,
+        "video_width": width,
+        "device": device,
+        "storage_device": device,
+        "point_inputs_per_obj": {},
+        "mask_inputs_per_obj": {},
+        "cached_features": {},
+        "constants": {},
+        "obj_id_to_idx": OrderedDict(),
+        "obj_idx_to_id": OrderedDict(),
+        "obj_ids": [],
+        "output_dict_per_obj": {},
+        "temp_output_dict_per_obj": {},
+        "frames_tracked_per_obj": {},
+    }
+
+
+def prune_state(state: dict, frames: FrameWindow, before: int, max_cond_frames: int):
+    """Drop everything SAM2 won't read again once tracking has reached frame `before`."""
+    frames.release_before(before)
+    for obj_idx, outputs in state["output_dict_per_obj"].items():
+        for frame_idx in [idx for idx in outputs["non_cond_frame_outputs"] if idx < before]:
+            del outputs["non_cond_frame_outputs"][frame_idx]
+        cond_frames = sorted(outputs["cond_frame_outputs"])
+        for frame_idx in cond_frames[:-max_cond_frames]:
+            del outputs["cond_frame_outputs"][frame_idx]
+        tracked = state["frames_tracked_per_obj"][obj_idx]
+        for frame_idx in [idx for idx in tracked if idx < before]:
+            del tracked[frame_idx]
+        for inputs in (state["point_inputs_per_obj"][obj_idx], state["mask_inputs_per_obj"][obj_idx]):
+            for frame_idx in [idx for idx in inputs if idx < before]:
+                del inputs[frame_idx]
+
+
+def box_iou(a, b) -> float:
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def mask_box(mask: np.ndarray) -> Optional[List[int]]:
+    ys, xs = np.where(mask)
+    if len(xs) == 0:
+        return None
+    return [int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())]
+
+
+class VideoSegmenter:
+    """
+    Track garments through a frame sequence. detect(frame) returns
+    GroundingDINO (boxes, scores, labels) for one RGB frame and runs on
+    every keyframe_interval-th frame (only the first when 0); a keyframe
+    detection overlapping an already tracked garment (box IoU >= match_iou
+    with its mask on the previous frame) re-anchors that garment, anything
+    else starts a new one. A garment no detection matches on retire_after
+    keyframes in a row (an empty mask never matches) is dropped from the
+    SAM2 state so it stops costing propagation; 0 keeps every garment.
+    Frames are propagated chunk_size at a time.
+    """
+
+    def __init__(
+        self,
+        predictor,
+        detect: Callable[[np.ndarray], tuple],
+        keyframe_interval: int = 30,
+        chunk_size: int = 8,
+        max_cond_frames: int = 4,
+        match_iou: float = 0.5,
+        retire_after: int = 2,
+    ):
+        self.predictor = predictor
+        self.detect = detect
+        self.keyframe_interval = max(0, keyframe_interval)
+        self.chunk_size = max(1, chunk_size)
+        self.max_cond_frames = max(1, max_cond_frames)
+        self.match_iou = match_iou
+        self.retire_after = max(0, retire_after)
+        self.labels = {}  # object id -> GroundingDINO label it was first detected as
+        self.next_obj_id = 1
+        self.last_masks = {}  # object id -> mask on the latest tracked frame
+        self.missed = {}  # object id -> keyframes in a row no detection matched it
+        # Frames back SAM2 looks for memories and object pointers
+        self.memory_frames = max(predictor.num_maskmem, getattr(predictor, "max_obj_ptrs_in_encoder", 0)) * max(
+            1, getattr(predictor, "memory_temporal_stride_for_eval", 1)
+        )
+
+    def is_keyframe(self, frame_idx: int) -> bool:
+        if self.keyframe_interval == 0:
+            return frame_idx == 0
+        return frame_idx % self.keyframe_interval == 0
+
+    def run(self, frames: Iterable[np.ndarray], timings: StageTimings) -> Iterator[dict]:
+        """Yield one record per input frame: its index, whether it was a keyframe and every garment's mask."""
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return
+        size = first.shape[:2]
+        window = FrameWindow(self.predictor.image_size, self.predictor.device)
+        state = init_stream_state(self.predictor, window, *size)
+
+        start = 0
+        pending = [first]
+        while pending:
+            # A chunk is up to chunk_size frames, cut short before the next keyframe
+            while len(pending) < self.chunk_size and not self.is_keyframe(start + len(pending)):
+                frame = self.next_frame(frames, size)
+                if frame is None:
+                    break
+                pending.append(frame)
+            for frame in pending:
+                window.append(frame)
+            state["num_frames"] = len(window)
+            end = start + len(pending) - 1
+
+            keyframe = self.is_keyframe(start)
+            if keyframe:
+                with timings.stage("detect"):
+                    self.anchor(state, start, pending[0])
+            yield from self.propagate(state, start, end, keyframe, timings)
+
+            prune_state(state, window, end + 1 - self.memory_frames, self.max_cond_frames)
+            start = end + 1
+            frame = self.next_frame(frames, size)
+            pending = [frame] if frame is not None else []
+
+    @staticmethod
+    def next_frame(frames: Iterator[np.ndarray], size) -> Optional[np.ndarray]:
+        frame = next(frames, None)
+        if frame is not None and frame.shape[:2] != size:
+            frame = cv2.resize(frame, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+        return frame
+
+    def anchor(self, state: dict, frame_idx: int, frame: np.ndarray):
+        boxes, scores, labels = self.detect(frame)
+        previous_boxes = {obj_id: mask_box(mask) for obj_id, mask in self.last_masks.items()}
+        prompts = []
+        for box, label in zip(boxes, labels):
+            box = [float(v) for v in box]
+            matches = [
+                (box_iou(box, previous), obj_id)
+                for obj_id, previous in previous_boxes.items()
+                if previous is not None
+            ]
+            best = max(matches, default=(0.0, None))
+            obj_id = best[1] if best[0] >= self.match_iou else None
+            if obj_id is None:
+                obj_id = self.next_obj_id
+                self.next_obj_id += 1
+                self.labels[obj_id] = label
+            prompts.append((obj_id, box))
+
+        matched = {obj_id for obj_id, _ in prompts}
+        self.retire(state, [obj_id for obj_id in state["obj_ids"] if obj_id not in matched])
+        for obj_id, box in prompts:
+            self.predictor.add_new_points_or_box(state, frame_idx=frame_idx, obj_id=obj_id, box=np.array(box))
+
+    def retire(self, state: dict, unmatched: List[int]):
+        """Count a missed keyframe against each unmatched object and drop those missed retire_after times in a row."""
+        self.missed = {obj_id: self.missed.get(obj_id, 0) + 1 for obj_id in unmatched}
+        if self.retire_after == 0:
+            return
+        for obj_id in [obj_id for obj_id, missed in self.missed.items() if missed >= self.retire_after]:
+            self.predictor.remove_object(state, obj_id, need_output=False)
+            del self.missed[obj_id]
+            self.labels.pop(obj_id, None)
+            self.last_masks.pop(obj_id, None)
+
+    def propagate(self, state: dict, start: int, end: int, keyframe: bool, timings: StageTimings) -> Iterator[dict]:
+        if not state["obj_ids"]:
+            # Nothing found on a keyframe yet: report empty frames until one is
+            for frame_idx in range(start, end + 1):
+                yield {"frame": frame_idx, "keyframe": keyframe and frame_idx == start, "objects": []}
+            return
+
+        tracked = self.predictor.propagate_in_video(state, start_frame_idx=start, max_frame_num_to_track=end - start)
+        while True:
+            started = time.perf_counter()
+            step = next(tracked, None)
+            timings.add("propagate", (time.perf_counter() - started) * 1000.0)
+            if step is None:
+                break
+            frame_idx, obj_ids, mask_logits = step
+            masks = (mask_logits > 0.0).cpu().numpy()[:, 0]
+            self.last_masks = dict(zip(obj_ids, masks))
+            yield self.frame_record(frame_idx, keyframe and frame_idx == start, obj_ids, masks)
+
+    def frame_record(self, frame_idx: int, keyframe: bool, obj_ids: List[int], masks: np.ndarray) -> dict:
+        objects = []
+        for obj_id, mask in zip(obj_ids, masks):
+            box = mask_box(mask)
+            if box is None:
+                continue  # occluded or out of frame
+            objects.append({"id": int(obj_id), "label": self.labels.get(obj_id), "box": box, "rle": encode_rle(mask)})
+        return {"frame": frame_idx, "keyframe": keyframe, "objects": objects}
@@ -19,7 +19,8 @@ data class ClothingItem(
     val style: String = "", // From AI analysis
     val occasion: String = "", // From AI analysis
     val timestamp: Date = Date(),
-    val displayName: String = "" // Smart generated name like "Casual 1"
+    val displayName: String = "", // Smart generated name like "Casual 1"
+    val thumbnailUrls: Map<String, String> = emptyMap() // thumbnail_urls from server, keyed by size
 ) {
     /**
      * Convert the ClothingItem to a Map for Firestore storage
@@ -105,7 +106,10 @@ data class ClothingItem(
                 style = metadata["style"] as? String ?: "",
                 occasion = metadata["occasion"] as? String ?: "",
                 timestamp = timestamp,
-                displayName = map["display_name"] as? String ?: ""
+                displayName = map["display_name"] as? String ?: "",
+                thumbnailUrls = (map["thumbnail_urls"] as? Map<*, *>)
+                    ?.mapNotNull { (size, url) -> (url as? String)?.let { size.toString() to it } }
+                    ?.toMap() ?: emptyMap()
             )
         }
     }
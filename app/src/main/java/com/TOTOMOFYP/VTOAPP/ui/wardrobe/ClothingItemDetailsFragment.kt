@@ -241,8 +241,21 @@ class ClothingItemDetailsFragment : Fragment() {
                                         
                                         // Then delete the image from Firebase Storage
                                         val userId = firestoreRepository.currentUserId
-                                        val storagePath = "users/$userId/wardrobe/${item.id}.png"
-                                        storage.reference.child(storagePath).delete()
+                                        // The file extension depends on the stored format, so resolve it from the URL
+                                        val imageRef = if (item.imageUrl.startsWith("http")) {
+                                            storage.getReferenceFromUrl(item.imageUrl)
+                                        } else {
+                                            storage.reference.child("users/$userId/wardrobe/${item.id}.png")
+                                        }
+                                        // Thumbnails are only a cache of the image, so failures here are just logged
+                                        item.thumbnailUrls.values.forEach { url ->
+                                            runCatching { storage.getReferenceFromUrl(url) }.getOrNull()
+                                                ?.delete()
+                                                ?.addOnFailureListener { e ->
+                                                    android.util.Log.w("ClothingDetails", "Failed to delete thumbnail $url", e)
+                                                }
+                                        }
+                                        imageRef.delete()
                                             .addOnSuccessListener {
                                                 // If both operations succeed, navigate back
                                                 Toast.makeText(context, "Item deleted successfully", Toast.LENGTH_SHORT).show()